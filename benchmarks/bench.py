@@ -0,0 +1,265 @@
+"""
+Офлайн-бенчмарки разбора и подготовки записи на фикстурах (без сети и браузера).
+
+Замеряется скорость (элементов в секунду, лучшее из --repeat прогонов) и пиковая
+память (tracemalloc, отдельным прогоном) для:
+  - parse_wb_product     — card.json + detail из benchmarks/fixtures, сессия подменена;
+  - fetch_ozon_price     — ответ composer-api из фикстуры, разбор widgetStates;
+  - parse_csv/calculate  — выгрузки MPStats на 100 / 1 000 / 10 000 строк;
+  - get_sku_url_data     — расчёт basket/vol/part;
+  - payload Sheets       — coalesce_updates/split_payload, updateCells + заливка, diff_updates.
+
+Результаты сохраняются в benchmarks/results/<время>-<ревизия>.json и сравниваются
+с предыдущим прогоном (или --baseline). Просадка больше --threshold помечается REGRESSION.
+
+    python benchmarks/bench.py
+    python benchmarks/bench.py --only wb ozon --repeat 10
+    python benchmarks/bench.py --baseline benchmarks/results/20261019-120000-abc1234.json --fail-on-regression
+"""
+import argparse
+import csv
+import json
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+sys.path.insert(0, str(ROOT))
+
+import config  # noqa: E402
+import gsheets  # noqa: E402
+import mpstat  # noqa: E402
+import ozon  # noqa: E402
+import wb  # noqa: E402
+
+CSV_SIZES = (100, 1000, 10000)
+MPSTATS_COLUMNS = ["SKU", "Название", "Бренд", "Продавец", "Категория", "Цена", "Цена со скидкой",
+                   "Продажи", "Выручка", "Остаток", "Рейтинг", "Отзывы"]
+
+# (имя, количество элементов, функция одного прогона)
+Case = Tuple[str, int, Callable[[], object]]
+
+
+class _FixtureResponse:
+    def __init__(self, body: bytes):
+        self.content = body
+        self.status_code = 200
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class _FixtureSession:
+    """Подменяет http_session парсера: отдаёт тело фикстуры по подстроке URL"""
+
+    def __init__(self, routes: Dict[str, bytes]):
+        self.routes = routes
+
+    def get(self, url, **kwargs):
+        for marker, body in self.routes.items():
+            if marker in url:
+                return _FixtureResponse(body)
+        raise AssertionError(f"нет фикстуры для {url}")
+
+
+def _fixture(name: str) -> bytes:
+    return (FIXTURES / name).read_bytes()
+
+
+def write_mpstats_csv(path: Path, rows: int, seed: int = 0):
+    """Выгрузка MPStats: ';' и запятая в дробях, как в реальном экспорте; часть строк без продаж"""
+    rnd = random.Random(seed)
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(MPSTATS_COLUMNS)
+        for i in range(rows):
+            price = rnd.randint(500, 150000)
+            sales = rnd.choice((0, 0, rnd.randint(1, 5000)))
+            writer.writerow([
+                100000000 + i, f"Товар {i} с длинным названием для ширины строки", f"Бренд {i % 50}",
+                f"Продавец {i % 200}", "Электроника/Смартфоны", price, f"{price * 0.87:.2f}".replace(".", ","),
+                sales, price * sales, rnd.randint(0, 1000), f"{rnd.uniform(3, 5):.1f}".replace(".", ","),
+                rnd.randint(0, 20000),
+            ])
+
+
+def _sheet_updates(rows: int) -> List[Tuple[int, int, str]]:
+    """Обновления как у WB-парсера: 5 колонок на строку, часть строк с ошибками"""
+    updates = []
+    cols = [gsheets.col_letter_to_index(c) for c in (config.WB_DISPLAY_BATTERY_COLUMN, config.WB_SELLER_COLUMN,
+                                                     config.WB_PRICE_COLUMN, config.WB_RATING_REVIEWS_COLUMN,
+                                                     config.WB_PROMO_COLUMN)]
+    for row in range(2, rows + 2):
+        values = ["OLED / 4422 мА·ч", "Apple", str(100000 + row), f"4.{row % 10} / {row * 3}", "РАСПРОДАЖА"]
+        if row % 17 == 0:
+            values[2] = "ERROR: 404"
+        updates.extend((row, col, val) for col, val in zip(cols, values))
+    return updates
+
+
+def build_cases(tmp: Path) -> List[Case]:
+    cases: List[Case] = []
+
+    wb_session = _FixtureSession({"card.json": _fixture("wb_card.json"),
+                                  "/detail": _fixture("wb_detail.json")})
+    nm_ids = [str(10000000 + i * 7919) for i in range(2000)]
+
+    def run_wb():
+        original = wb.http_session
+        wb.http_session = wb_session
+        try:
+            for nm_id in nm_ids:
+                wb.parse_wb_product(nm_id, {})
+        finally:
+            wb.http_session = original
+    cases.append(("wb.parse_wb_product", len(nm_ids), run_wb))
+
+    ozon_session = _FixtureSession({"composer-api": _fixture("ozon_composer.json")})
+    articles = [str(1000000000 + i) for i in range(500)]
+
+    def run_ozon():
+        original = ozon.http_session
+        ozon.http_session = ozon_session
+        try:
+            for article in articles:
+                ozon.fetch_ozon_price(article, {})
+        finally:
+            ozon.http_session = original
+    cases.append(("ozon.fetch_ozon_price", len(articles), run_ozon))
+
+    for rows in CSV_SIZES:
+        path = tmp / f"mpstats_{rows}.csv"
+        write_mpstats_csv(path, rows, seed=rows)
+        cases.append((f"mpstat.parse_csv[{rows}]", rows,
+                      lambda path=path: mpstat.calculate(mpstat.parse_csv(path))))
+
+    rnd = random.Random(1)
+    skus = [str(rnd.randint(1000000, 400000000)) for _ in range(100000)]
+    cases.append(("wb.get_sku_url_data", len(skus), lambda: [wb.get_sku_url_data(s) for s in skus]))
+
+    updates = _sheet_updates(4000)
+    colors = [(row, col, "#FF0000" if val.startswith("ERROR") else None) for row, col, val in updates]
+    snapshot = [[""] * 40 for _ in range(4002)]
+    for row, col, val in updates[::2]:
+        snapshot[row - 1][col - 1] = val
+    cases.append(("sheets.values_payload", len(updates),
+                  lambda: gsheets.split_payload(gsheets.coalesce_updates(updates))))
+    cases.append(("sheets.colors_payload", len(colors),
+                  lambda: gsheets.split_payload(gsheets.build_color_requests(0, colors))))
+    cases.append(("sheets.diff_updates", len(updates), lambda: gsheets.diff_updates(updates, snapshot)))
+    return cases
+
+
+def measure(fn: Callable[[], object], items: int, repeat: int) -> Dict:
+    fn()  # прогрев: ленивые импорты, кэши regex
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+
+    # Память отдельным прогоном: tracemalloc заметно замедляет выполнение
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "items": items,
+        "seconds": round(best, 6),
+        "items_per_sec": round(items / best, 1) if best else None,
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+
+def git_revision() -> str:
+    try:
+        proc = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, timeout=10)
+        return proc.stdout.strip() or "unknown"
+    except (OSError, subprocess.SubprocessError):
+        return "unknown"
+
+
+def latest_result(exclude: Optional[Path] = None) -> Optional[Path]:
+    files = sorted(p for p in RESULTS_DIR.glob("*.json") if p != exclude)
+    return files[-1] if files else None
+
+
+def compare(current: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """Печатает таблицу сравнения и возвращает имена кейсов с регрессией"""
+    regressions = []
+    print(f"\nСравнение с {baseline.get('revision')} ({baseline.get('created_at')}), порог {threshold:.0%}")
+    for name, result in current["cases"].items():
+        old = baseline.get("cases", {}).get(name)
+        if not old or not old.get("items_per_sec") or not result.get("items_per_sec"):
+            print(f"  {name:28} нет данных в базовом прогоне")
+            continue
+        speed = result["items_per_sec"] / old["items_per_sec"] - 1
+        memory = result["peak_kib"] / old["peak_kib"] - 1 if old["peak_kib"] else 0.0
+        regressed = speed < -threshold or memory > threshold
+        if regressed:
+            regressions.append(name)
+        print(f"  {name:28} скорость {speed:+7.1%}  память {memory:+7.1%}  {'REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарки парсеров на фикстурах")
+    parser.add_argument("--only", nargs="*", default=None, help="префиксы имён кейсов (wb, ozon, mpstat, sheets)")
+    parser.add_argument("--repeat", type=int, default=5, help="прогонов на кейс, берётся лучший")
+    parser.add_argument("--baseline", default=None, help="JSON прошлого прогона (по умолчанию последний в results/)")
+    parser.add_argument("--threshold", type=float, default=0.15, help="допустимая просадка, доля")
+    parser.add_argument("--fail-on-regression", action="store_true", help="код возврата 1 при регрессии")
+    parser.add_argument("--no-save", action="store_true", help="не сохранять результат")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench-") as tmp:
+        cases = build_cases(Path(tmp))
+        if args.only:
+            cases = [c for c in cases if any(c[0].startswith(prefix) for prefix in args.only)]
+
+        current = {
+            "revision": git_revision(),
+            "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+            "cases": {},
+        }
+        for name, items, fn in cases:
+            result = measure(fn, items, args.repeat)
+            current["cases"][name] = result
+            print(f"{name:28} {result['items_per_sec']:>12,.0f} эл/с  {result['seconds'] * 1000:9.2f} мс  "
+                  f"пик {result['peak_kib']:>10,.1f} КиБ")
+
+    saved = None
+    if not args.no_save:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        saved = RESULTS_DIR / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{current['revision']}.json"
+        saved.write_text(json.dumps(current, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"\nРезультат: {saved}")
+
+    baseline_path = Path(args.baseline) if args.baseline else latest_result(exclude=saved)
+    if baseline_path is None:
+        return
+    regressions = compare(current, json.loads(baseline_path.read_text(encoding="utf-8")), args.threshold)
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
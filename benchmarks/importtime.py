@@ -0,0 +1,94 @@
+"""
+Бюджет времени импорта точек входа (python -X importtime).
+
+Для каждого модуля проверяет:
+  - суммарное время импорта (лучшее из --repeat запусков) не превышает бюджет;
+  - тяжёлые пакеты (selenium remote webdriver, seleniumwire, uc, pandas, openpyxl, gspread)
+    не загружаются при импорте — они должны подгружаться по месту использования.
+
+    python benchmarks/importtime.py
+    python benchmarks/importtime.py --scale 2     # на медленной машине
+
+Код возврата 1, если бюджет превышен.
+"""
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Бюджеты в миллисекундах (с запасом относительно замеров на рабочей машине)
+BUDGETS_MS = {
+    "main": 150,
+    "daemon": 150,
+    "wb": 300,
+    "ozon": 300,
+    "mpstat": 300,
+    "sharding": 300,
+}
+
+HEAVY_MODULES = (
+    "selenium.webdriver.remote.webdriver",
+    "seleniumwire",
+    "undetected_chromedriver",
+    "pandas",
+    "openpyxl",
+    "gspread",
+)
+
+
+def measure(module: str) -> Tuple[float, Dict[str, float]]:
+    """Возвращает (суммарное время импорта модуля в мс, {импортированный модуль: мс})"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True, encoding="utf-8", errors="replace",
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} завершился с ошибкой:\n{proc.stderr[-2000:]}")
+
+    imported = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        # import time: self [us] | cumulative | imported package
+        _, cumulative, name = line[len("import time:"):].split("|", 2)
+        imported[name.strip()] = int(cumulative) / 1000
+    return imported.get(module, 0.0), imported
+
+
+def check(modules: List[str], scale: float, repeat: int) -> bool:
+    ok = True
+    for module in modules:
+        runs = [measure(module) for _ in range(repeat)]
+        total, imported = min(runs, key=lambda r: r[0])
+        budget = BUDGETS_MS[module] * scale
+        heavy = [name for name in HEAVY_MODULES if name in imported]
+        status = "OK" if total <= budget and not heavy else "FAIL"
+        ok = ok and status == "OK"
+        print(f"{status:4} {module:10} {total:7.1f} мс (бюджет {budget:.0f} мс)")
+        for name in heavy:
+            print(f"     тяжёлый импорт при загрузке: {name} ({imported[name]:.1f} мс)")
+        if total > budget:
+            top = sorted(((ms, name) for name, ms in imported.items() if name != module), reverse=True)[:5]
+            for ms, name in top:
+                print(f"     {ms:7.1f} мс  {name}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка бюджета времени импорта")
+    parser.add_argument("modules", nargs="*", default=list(BUDGETS_MS), help="модули для проверки")
+    parser.add_argument("--scale", type=float, default=1.0, help="множитель бюджетов")
+    parser.add_argument("--repeat", type=int, default=3, help="запусков на модуль, берётся лучший")
+    args = parser.parse_args()
+
+    unknown = [m for m in args.modules if m not in BUDGETS_MS]
+    if unknown:
+        parser.error(f"нет бюджета для: {', '.join(unknown)}")
+    sys.exit(0 if check(args.modules, args.scale, args.repeat) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Офлайн-нагрузочный прогон всего конвейера: чтение листа -> запросы к API -> запись в лист.
+
+Поднимает в процессе fake_sheets.py (лист с --skus артикулами) и replay_server.py
+(ответы WB и Ozon с задержкой, ошибками и всплесками 429), направляет на них парсеры
+и прогоняет process_tasks для каждой комбинации --concurrency и --rate. Куки не нужны:
+браузер не запускается.
+
+    python benchmarks/loadtest.py --skus 10000 --concurrency 1 8 16 --rate 0 40 \\
+        --latency 0.05 --jitter 0.05 --error-rate 0.01 --burst-every 30 --burst-length 3
+
+Сводка печатается таблицей и сохраняется в benchmarks/results/loadtest-<время>-<ревизия>.json.
+"""
+import argparse
+import itertools
+import json
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+sys.path.insert(0, str(ROOT))
+
+import config  # noqa: E402
+import fake_sheets  # noqa: E402
+import gsheets  # noqa: E402
+import ozon  # noqa: E402
+import replay_server  # noqa: E402
+import wb  # noqa: E402
+from bench import git_revision  # noqa: E402
+from planner import load_plan  # noqa: E402
+
+
+def run_engine(engine: str, sheet, concurrency: int, rate: float) -> dict:
+    plan = load_plan(sheet)
+    updates, promo_cells = [], []
+    tasks = plan.wb_tasks if engine == "wb" else plan.ozon_tasks
+
+    start = time.perf_counter()
+    if engine == "wb":
+        parsed, errors = wb.process_tasks(tasks, {}, updates, promo_cells,
+                                          concurrency=concurrency, rate_limit=rate)
+    else:
+        parsed, errors = ozon.process_tasks(tasks, {}, updates, concurrency=concurrency, rate_limit=rate)
+    fetch_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    colors = wb.build_color_cells(updates, promo_cells, gsheets.col_letter_to_index(config.WB_PROMO_COLUMN)) \
+        if engine == "wb" else []
+    gsheets.write_values_and_colors(sheet, updates, colors, snapshot=plan.snapshot)
+    write_seconds = time.perf_counter() - start
+
+    return {
+        "engine": engine,
+        "concurrency": concurrency,
+        "rate": rate,
+        "items": len(tasks),
+        "parsed": parsed,
+        "errors": errors,
+        "fetch_seconds": round(fetch_seconds, 3),
+        "items_per_sec": round(len(tasks) / fetch_seconds, 1) if fetch_seconds else None,
+        "write_seconds": round(write_seconds, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-нагрузочный прогон на replay-сервере")
+    parser.add_argument("--skus", type=int, default=10000, help="артикулов в листе")
+    parser.add_argument("--engines", nargs="+", default=["wb", "ozon"], choices=["wb", "ozon"])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8], help="значения для перебора")
+    parser.add_argument("--rate", nargs="+", type=float, default=[0], help="лимиты запросов/с (0 — без лимита)")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--not-found-rate", type=float, default=0.0)
+    parser.add_argument("--max-rps", type=float, default=0.0, help="серверный лимит запросов/с")
+    parser.add_argument("--burst-every", type=float, default=0.0)
+    parser.add_argument("--burst-length", type=float, default=0.0)
+    parser.add_argument("--sheets-latency", type=float, default=0.0)
+    parser.add_argument("--no-save", action="store_true", help="не сохранять сводку")
+    args = parser.parse_args()
+
+    sheets = fake_sheets.start_server(rows=args.skus, sheet_gid=config.SHEET_GID, latency=args.sheets_latency)
+    replay = replay_server.start_server(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                                        not_found_rate=args.not_found_rate, max_rps=args.max_rps,
+                                        burst_every=args.burst_every, burst_length=args.burst_length)
+    config.SHEETS_API_BASE_URL = sheets.base_url
+    config.WB_BASKET_URL_TEMPLATE = f"{replay.base_url}/basket-{{basket}}"
+    config.WB_DETAIL_BASE_URL = replay.base_url
+    config.OZON_API_BASE_URL = replay.base_url
+    _, sheet = gsheets.get_sheet_client()
+
+    runs = []
+    for engine, concurrency, rate in itertools.product(args.engines, args.concurrency, args.rate):
+        before = dict(replay.stats)
+        result = run_engine(engine, sheet, concurrency, rate)
+        result["requests"] = replay.stats["requests"] - before["requests"]
+        result["throttled"] = replay.stats["throttled"] - before["throttled"]
+        runs.append(result)
+
+    print(f"\n{'движок':6} {'потоки':>6} {'лимит':>6} {'товаров':>8} {'ошибок':>7} {'эл/с':>8} "
+          f"{'запросов':>9} {'429':>6} {'запись, с':>10}")
+    for r in runs:
+        print(f"{r['engine']:6} {r['concurrency']:>6} {r['rate'] or '-':>6} {r['items']:>8} {r['errors']:>7} "
+              f"{r['items_per_sec']:>8.1f} {r['requests']:>9} {r['throttled']:>6} {r['write_seconds']:>10.2f}")
+
+    if not args.no_save:
+        RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+        path = RESULTS_DIR / f"loadtest-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{git_revision()}.json"
+        report = {"revision": git_revision(), "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                  "options": vars(args), "runs": runs}
+        path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"\nСводка: {path}")
+
+    replay.shutdown()
+    sheets.shutdown()
+
+
+if __name__ == "__main__":
+    main()
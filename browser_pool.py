@@ -0,0 +1,146 @@
+"""
+Пул «тёплых» браузеров: один драйвер на профиль Chrome, выдаётся парсерам по запросу
+и пересоздаётся после N использований или при превышении лимита памяти
+"""
+import logging
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+import config
+
+logger = logging.getLogger("browser_pool")
+
+DriverFactory = Callable[[], Tuple[object, object]]
+
+
+def _driver_memory_mb(driver) -> Optional[float]:
+    """RSS Chrome вместе с дочерними процессами (нужен psutil; без него — None)"""
+    pid = getattr(driver, "browser_pid", None)
+    if not pid:
+        return None
+    try:
+        import psutil
+    except ImportError:
+        return None
+    try:
+        proc = psutil.Process(pid)
+        procs = [proc] + proc.children(recursive=True)
+        return sum(p.memory_info().rss for p in procs) / (1024 * 1024)
+    except psutil.Error:
+        return None
+
+
+def _is_alive(driver) -> bool:
+    try:
+        driver.current_url
+        return True
+    except Exception:
+        return False
+
+
+class _PooledBrowser:
+    def __init__(self, driver, tunnel):
+        self.driver = driver
+        self.tunnel = tunnel
+        self.uses = 0
+
+    def close(self):
+        # Туннель закрывает и свой драйвер
+        self.tunnel.close()
+
+
+class DriverLease:
+    """Выданный драйвер; release() возвращает его в пул (или закрывает, если пула нет)"""
+
+    def __init__(self, driver, on_release: Callable[[bool], None]):
+        self.driver = driver
+        self._on_release = on_release
+        self._released = False
+
+    def release(self, broken: bool = False):
+        if self._released:
+            return
+        self._released = True
+        self._on_release(broken)
+
+
+class BrowserPool:
+    def __init__(self, max_uses: Optional[int] = None, max_memory_mb: Optional[float] = None):
+        self.max_uses = max_uses if max_uses is not None else config.BROWSER_MAX_USES
+        self.max_memory_mb = max_memory_mb if max_memory_mb is not None else config.BROWSER_MAX_MEMORY_MB
+        self._browsers: Dict[str, _PooledBrowser] = {}
+        self._busy = set()
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def acquire(self, profile: str, factory: DriverFactory) -> DriverLease:
+        """Выдаёт драйвер профиля; если он занят другим парсером — ждёт освобождения"""
+        with self._cond:
+            while profile in self._busy:
+                self._cond.wait()
+            if self._closed:
+                raise RuntimeError("Пул браузеров закрыт")
+            self._busy.add(profile)
+            browser = self._browsers.get(profile)
+
+        try:
+            if browser and not _is_alive(browser.driver):
+                logger.warning(f"Драйвер профиля {profile} не отвечает, пересоздаю")
+                browser.close()
+                browser = None
+            if browser is None:
+                logger.info(f"Запуск браузера для профиля {profile}")
+                browser = _PooledBrowser(*factory())
+            else:
+                logger.info(f"Используется тёплый браузер профиля {profile} (использований: {browser.uses})")
+        except BaseException:
+            with self._cond:
+                self._browsers.pop(profile, None)
+                self._busy.discard(profile)
+                self._cond.notify_all()
+            raise
+
+        with self._cond:
+            self._browsers[profile] = browser
+        browser.uses += 1
+        return DriverLease(browser.driver, lambda broken: self._release(profile, browser, broken))
+
+    def _should_recycle(self, browser: _PooledBrowser) -> Optional[str]:
+        if self.max_uses and browser.uses >= self.max_uses:
+            return f"достигнут лимит использований ({browser.uses})"
+        if self.max_memory_mb:
+            memory = _driver_memory_mb(browser.driver)
+            if memory is not None and memory > self.max_memory_mb:
+                return f"память {memory:.0f} МБ > {self.max_memory_mb:.0f} МБ"
+        return None
+
+    def _release(self, profile: str, browser: _PooledBrowser, broken: bool):
+        reason = "драйвер помечен как неисправный" if broken else self._should_recycle(browser)
+        with self._cond:
+            if reason or self._closed:
+                self._browsers.pop(profile, None)
+        if reason or self._closed:
+            if reason:
+                logger.info(f"Перезапуск браузера профиля {profile}: {reason}")
+            browser.close()
+        with self._cond:
+            self._busy.discard(profile)
+            self._cond.notify_all()
+
+    def close(self):
+        """Закрывает все свободные браузеры; занятые закроются при возврате"""
+        with self._cond:
+            self._closed = True
+            idle = {p: b for p, b in self._browsers.items() if p not in self._busy}
+            for profile in idle:
+                self._browsers.pop(profile)
+        for browser in idle.values():
+            browser.close()
+
+
+def lease_driver(pool: Optional[BrowserPool], profile: str, factory: DriverFactory) -> DriverLease:
+    """Берёт драйвер из пула, а без пула создаёт собственный, который закроется при release()"""
+    if pool is not None:
+        return pool.acquire(profile, factory)
+    browser = _PooledBrowser(*factory())
+    return DriverLease(browser.driver, lambda broken: browser.close())
@@ -0,0 +1,99 @@
+"""
+Журнал прогресса парсера: append-only JSONL, одна строка на завершённую задачу.
+
+Каждая строка содержит ключ задачи (строка + значение входной ячейки) и её обновления.
+При запуске с --resume задачи из журнала не обрабатываются повторно, а их результаты
+попадают в итоговую запись (при повторах ключа действует последняя строка).
+Без --resume задачи выполняются заново, а журнал дописывается; удаляется он
+только после успешной записи в таблицу.
+"""
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import config
+
+logger = logging.getLogger("checkpoint")
+
+# Остановка парсеров в потоках (main.py --mode thread): Ctrl+C приходит только в главный поток,
+# поэтому циклы задач проверяют флаг сами и выходят так же, как по KeyboardInterrupt
+stop_requested = threading.Event()
+
+
+def raise_if_stopped():
+    if stop_requested.is_set():
+        raise KeyboardInterrupt
+
+
+def task_key(task) -> str:
+    """Ключ задачи: если значение в ячейке поменялось, задача считается новой"""
+    return "|".join("" if part is None else str(part) for part in task)
+
+
+class Checkpoint:
+    def __init__(self, name: str, resume: bool = False, directory: Optional[Path] = None):
+        self.path = Path(directory or config.CHECKPOINT_DIR) / f"{name}.jsonl"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._done: Dict[str, Dict] = self._load() if resume else {}
+        self._lock = threading.Lock()
+        # Журнал только дописывается и удаляется после успешной записи (clear): запуск без --resume
+        # после сбоя выполняет задачи заново, но не стирает прогресс прерванного запуска
+        if not resume and self.path.exists() and self.path.stat().st_size:
+            logger.warning(f"Журнал {self.path.name} остался от незавершённого запуска и сохранён; "
+                           f"чтобы пропустить выполненные задачи, запустите с --resume")
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def _load(self) -> Dict[str, Dict]:
+        done = {}
+        if not self.path.exists():
+            return done
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    done[entry["key"]] = entry
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    # Последняя строка могла оборваться при аварийном завершении
+                    continue
+        logger.info(f"Журнал {self.path.name}: выполнено задач — {len(done)}")
+        return done
+
+    def restore(self, tasks, all_updates: list, extra: Optional[list] = None) -> List:
+        """
+        Дописывает в all_updates (и extra) результаты задач из журнала
+        и возвращает задачи, которые ещё нужно выполнить.
+        """
+        remaining = []
+        for task in tasks:
+            entry = self._done.get(task_key(task))
+            if entry is None:
+                remaining.append(task)
+                continue
+            all_updates.extend(tuple(u) for u in entry.get("updates", []))
+            if extra is not None:
+                extra.extend(tuple(e) for e in entry.get("extra", []))
+        if len(remaining) < len(tasks):
+            logger.info(f"Возобновление: пропущено {len(tasks) - len(remaining)} из {len(tasks)} задач")
+        return remaining
+
+    def record(self, task, updates, extra=()):
+        entry = {"key": task_key(task), "updates": list(updates)}
+        if extra:
+            entry["extra"] = list(extra)
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def clear(self):
+        """Результаты записаны в таблицу — журнал больше не нужен"""
+        self.close()
+        self.path.unlink(missing_ok=True)
@@ -3,8 +3,15 @@
 Все настройки загружаются из .env файла для безопасности
 """
 
+import atexit
+import copy
+import json
 import os
 import logging
+import logging.handlers
+import queue
+import sys
+import threading
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -26,12 +33,53 @@ GOOGLE_SHEETS_SCOPE = [
     "https://spreadsheets.google.com/feeds",
     "https://www.googleapis.com/auth/drive"
 ]
+# Адрес локальной замены Sheets API (fake_sheets.py) для офлайн-бенчмарков; пусто — Google
+SHEETS_API_BASE_URL = os.getenv("SHEETS_API_BASE_URL", "")
+
+
+def _user_cache_dir() -> Path:
+    if os.name == "nt":
+        base = Path(os.getenv("LOCALAPPDATA") or Path.home() / "AppData" / "Local")
+    elif sys.platform == "darwin":
+        base = Path.home() / "Library" / "Caches"
+    else:
+        base = Path(os.getenv("XDG_CACHE_HOME") or Path.home() / ".cache")
+    return base / "zakaz2"
+
+
+# Кэш токена и метаданных листа (общий для всех парсеров). В нём живой токен доступа,
+# поэтому по умолчанию он лежит в пользовательском кэше, а не в рабочей копии
+SHEETS_AUTH_CACHE_FILE = (BASE_DIR / os.environ["SHEETS_AUTH_CACHE_FILE"] if os.getenv("SHEETS_AUTH_CACHE_FILE")
+                          else _user_cache_dir() / "sheets_auth_cache.json")
+# Лимит размера одного запроса на запись (рекомендация Google — не более 2 МБ)
+SHEETS_MAX_PAYLOAD_BYTES = int(os.getenv("SHEETS_MAX_PAYLOAD_BYTES", str(2 * 1024 * 1024)))
+# Квота на запись (по умолчанию Google даёт 60 запросов в минуту на пользователя); 0 — без ограничения
+SHEETS_WRITE_QUOTA_PER_MINUTE = int(os.getenv("SHEETS_WRITE_QUOTA_PER_MINUTE", "60"))
+SHEETS_WRITE_WORKERS = int(os.getenv("SHEETS_WRITE_WORKERS", "4"))
+SHEETS_MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", "5"))
 
 # MPStats
 MPSTATS_EMAIL = os.getenv("MPSTATS_EMAIL", "")
 MPSTATS_PASSWORD = os.getenv("MPSTATS_PASSWORD", "")
 MPSTATS_API_TOKEN = os.getenv("MPSTATS_API_TOKEN", "")
 
+# Кэш агрегатов MPStats (данные пересчитываются раз в сутки)
+MPSTATS_CACHE_FILE = BASE_DIR / os.getenv("MPSTATS_CACHE_FILE", "mpstats_cache.json")
+MPSTATS_CACHE_TTL_HOURS = float(os.getenv("MPSTATS_CACHE_TTL_HOURS", "24"))
+MPSTATS_REFRESH_HOUR = int(os.getenv("MPSTATS_REFRESH_HOUR")) if os.getenv("MPSTATS_REFRESH_HOUR") else None
+
+# Адреса API маркетплейсов; для офлайн-нагрузочных прогонов — replay_server.py, например
+# WB_BASKET_URL_TEMPLATE=http://127.0.0.1:8766/basket-{basket}, WB_DETAIL_BASE_URL=http://127.0.0.1:8766
+WB_BASKET_URL_TEMPLATE = os.getenv("WB_BASKET_URL_TEMPLATE", "https://basket-{basket}.wbbasket.ru")
+WB_DETAIL_BASE_URL = os.getenv("WB_DETAIL_BASE_URL", "https://www.wildberries.ru").rstrip("/")
+OZON_API_BASE_URL = os.getenv("OZON_API_BASE_URL", "https://www.ozon.ru").rstrip("/")
+
+# Параллельные HTTP-запросы к API и лимит запросов в секунду (0 — без лимита)
+WB_CONCURRENCY = int(os.getenv("WB_CONCURRENCY", "1"))
+WB_RATE_LIMIT = float(os.getenv("WB_RATE_LIMIT", "0"))
+OZON_CONCURRENCY = int(os.getenv("OZON_CONCURRENCY", "1"))
+OZON_RATE_LIMIT = float(os.getenv("OZON_RATE_LIMIT", "0"))
+
 # Колонки Wildberries
 WB_SKU_COLUMN = "K"
 WB_LINK_COLUMN = "K"
@@ -54,11 +102,38 @@ MPSTATS_SALES_COLUMN = "Z"
 # Прокси
 PROXY_FILE = BASE_DIR / os.getenv("PROXY_FILE", "proxies.txt")
 USE_PROXY = os.getenv("USE_PROXY", "False").lower() == "true"
+# Ротация прокси: исключение после N ошибок подряд или бана, охлаждение удваивается до максимума
+PROXY_FAILURE_THRESHOLD = int(os.getenv("PROXY_FAILURE_THRESHOLD", "3"))
+PROXY_COOLDOWN_SECONDS = float(os.getenv("PROXY_COOLDOWN_SECONDS", "120"))
+PROXY_MAX_COOLDOWN_SECONDS = float(os.getenv("PROXY_MAX_COOLDOWN_SECONDS", "1800"))
+# Фоновая проверка прокси (0 — выключена)
+PROXY_PROBE_INTERVAL = float(os.getenv("PROXY_PROBE_INTERVAL", "0"))
+PROXY_PROBE_URL = os.getenv("PROXY_PROBE_URL", "https://www.gstatic.com/generate_204")
+PROXY_PROBE_TIMEOUT = float(os.getenv("PROXY_PROBE_TIMEOUT", "10"))
 
 # Selenium/UC
 HEADLESS_MODE = os.getenv("HEADLESS_MODE", "False").lower() == "true"
 PAGE_LOAD_TIMEOUT = int(os.getenv("PAGE_LOAD_TIMEOUT", "30"))
 IMPLICIT_WAIT = int(os.getenv("IMPLICIT_WAIT", "10"))
+# MITM-туннель selenium-wire: auto — только для прокси с авторизацией, true — всегда, false — никогда
+_browser_intercept = os.getenv("BROWSER_INTERCEPT", "auto").lower()
+BROWSER_INTERCEPT = None if _browser_intercept == "auto" else _browser_intercept == "true"
+# Сохранение перехваченных туннелем запросов: False — выключено, иначе кольцевой буфер
+# последних N запросов, тела больше MAX_BODY байт не сохраняются, SCOPES — regex URL через запятую
+BROWSER_CAPTURE = {
+    "scopes": [s.strip() for s in os.getenv("BROWSER_CAPTURE_SCOPES", "").split(",") if s.strip()],
+    "max_entries": int(os.getenv("BROWSER_CAPTURE_MAX_ENTRIES", "200")),
+    "max_body": int(os.getenv("BROWSER_CAPTURE_MAX_BODY", "262144")),
+} if os.getenv("BROWSER_CAPTURE", "True").lower() == "true" else False
+# Шаблон для новых профилей Chrome (пусто — пустой профиль) и очистка кэшей профиля перед запуском
+CHROME_PROFILE_TEMPLATE = os.getenv("CHROME_PROFILE_TEMPLATE", "")
+CHROME_SLIM_PROFILE = os.getenv("CHROME_SLIM_PROFILE", "False").lower() == "true"
+# Блокировать картинки, шрифты, видео и счётчики на страницах кук WB/Ozon и MPStats
+BLOCK_RESOURCES = os.getenv("BLOCK_RESOURCES", "True").lower() == "true"
+
+# Пул браузеров: перезапуск после N выдач или при превышении памяти (МБ, нужен psutil)
+BROWSER_MAX_USES = int(os.getenv("BROWSER_MAX_USES", "20"))
+BROWSER_MAX_MEMORY_MB = float(os.getenv("BROWSER_MAX_MEMORY_MB", "1500"))
 
 # User Agents
 USER_AGENTS = [
@@ -66,6 +141,43 @@ USER_AGENTS = [
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/119.0.0.0 Safari/537.36",
 ]
 
+# Режим запуска main.py: thread | process | subprocess (последовательно)
+PARSERS_RUN_MODE = os.getenv("PARSERS_RUN_MODE", "thread").lower()
+
+# Режим демона (daemon.py): интервалы запуска в минутах и адрес управления
+DAEMON_WB_INTERVAL_MIN = float(os.getenv("DAEMON_WB_INTERVAL_MIN", "60"))
+DAEMON_OZON_INTERVAL_MIN = float(os.getenv("DAEMON_OZON_INTERVAL_MIN", "60"))
+DAEMON_MPSTATS_INTERVAL_MIN = float(os.getenv("DAEMON_MPSTATS_INTERVAL_MIN", "1440"))
+DAEMON_HOST = os.getenv("DAEMON_HOST", "127.0.0.1")
+DAEMON_PORT = int(os.getenv("DAEMON_PORT", "8770"))
+# Сколько секунд при остановке ждать, пока запущенные парсеры запишут собранное
+DAEMON_SHUTDOWN_TIMEOUT = float(os.getenv("DAEMON_SHUTDOWN_TIMEOUT", "120"))
+
+# Отчёты о запуске (metrics.py): JSON всегда, текстовый формат Prometheus — по флагу
+METRICS_DIR = BASE_DIR / os.getenv("METRICS_DIR", "metrics")
+METRICS_PROMETHEUS = os.getenv("METRICS_PROMETHEUS", "False").lower() == "true"
+
+# Профилирование (--profile): auto | cprofile | pyinstrument, папка дампов, размер топа в логе
+PROFILER = os.getenv("PROFILER", "auto").lower()
+PROFILE_DIR = BASE_DIR / os.getenv("PROFILE_DIR", "profiles")
+PROFILE_TOP_N = int(os.getenv("PROFILE_TOP_N", "25"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.001"))
+
+# Журналы прогресса парсеров для --resume
+CHECKPOINT_DIR = BASE_DIR / os.getenv("CHECKPOINT_DIR", "checkpoints")
+
+# Шардирование (sharding.py): координатор раздаёт шарды воркерам на других машинах
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "8"))
+SHARD_DB_FILE = BASE_DIR / os.getenv("SHARD_DB_FILE", "shards.sqlite3")
+SHARD_LEASE_SECONDS = int(os.getenv("SHARD_LEASE_SECONDS", "300"))
+SHARD_MAX_ATTEMPTS = int(os.getenv("SHARD_MAX_ATTEMPTS", "3"))
+# По умолчанию координатор доступен только локально; для воркеров на других хостах задайте 0.0.0.0
+SHARD_COORDINATOR_HOST = os.getenv("SHARD_COORDINATOR_HOST", "127.0.0.1")
+SHARD_COORDINATOR_PORT = int(os.getenv("SHARD_COORDINATOR_PORT", "8780"))
+SHARD_COORDINATOR_URL = os.getenv("SHARD_COORDINATOR_URL", f"http://127.0.0.1:{SHARD_COORDINATOR_PORT}")
+# Общий секрет координатора и воркеров (заголовок X-Shard-Token), обязателен
+SHARD_TOKEN = os.getenv("SHARD_TOKEN", "")
+
 # Задержки
 DELAY_BETWEEN_SCRIPTS = int(os.getenv("DELAY_BETWEEN_SCRIPTS", "10"))
 RANDOM_DELAY_MIN = float(os.getenv("RANDOM_DELAY_MIN", "0.4"))
@@ -76,6 +188,13 @@ LOG_FILE = BASE_DIR / "parser.log"
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Файл лога в формате JSON lines (консоль остаётся текстовой)
+LOG_JSON = os.getenv("LOG_JSON", "False").lower() == "true"
+# Ротация по размеру (0 — без ротации)
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+# Отдельный файл для каждого процесса: parser-<скрипт>-<pid>.log
+LOG_PER_PROCESS = os.getenv("LOG_PER_PROCESS", "False").lower() == "true"
 
 # Автосоздание директорий
 DOWNLOAD_DIR.mkdir(exist_ok=True)
@@ -84,23 +203,153 @@ CHROME_PROFILE_WB.mkdir(exist_ok=True)
 CHROME_PROFILE_OZON.mkdir(exist_ok=True)
 
 
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, LOG_DATE_FORMAT),
+            "level": record.levelname,
+            "logger": record.name,
+            "process": record.process,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler, который не вклеивает трассировку в сообщение: она остаётся в exc_text
+    (поле exc в JSON, обычный хвост в текстовом формате)
+    """
+
+    def prepare(self, record):
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        # exc_info с объектом трассировки не передаётся между процессами
+        record.exc_info = None
+        return record
+
+
+# Все логгеры пишут в одну очередь, файл и консоль обслуживает фоновый поток QueueListener
+_log_lock = threading.Lock()
+_log_queue_handler = None
+_log_listener = None
+_child_log_listeners = []
+
+
+def _log_file() -> Path:
+    if not LOG_PER_PROCESS:
+        return LOG_FILE
+    script = (Path(sys.argv[0]).stem.lstrip("-") if sys.argv and sys.argv[0] else "") or "python"
+    return LOG_FILE.with_name(f"{LOG_FILE.stem}-{script}-{os.getpid()}{LOG_FILE.suffix}")
+
+
+def _log_handlers():
+    level = getattr(logging, LOG_LEVEL)
+    text = logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT)
+
+    if LOG_MAX_BYTES > 0:
+        file_handler = logging.handlers.RotatingFileHandler(
+            _log_file(), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    else:
+        file_handler = logging.FileHandler(_log_file(), encoding='utf-8')
+    file_handler.setLevel(level)
+    file_handler.setFormatter(JsonFormatter() if LOG_JSON else text)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(level)
+    console_handler.setFormatter(text)
+    return file_handler, console_handler
+
+
+def _start_log_listener():
+    global _log_queue_handler, _log_listener
+    log_queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(log_queue, *_log_handlers(), respect_handler_level=True)
+    _log_listener.start()
+    if _log_queue_handler is None:
+        _log_queue_handler = _QueueHandler(log_queue)
+        atexit.register(_stop_logging)
+    else:
+        _log_queue_handler.queue = log_queue
+
+
+def _stop_logging():
+    """Дописывает очередь в файл при выходе"""
+    for listener in [_log_listener] + _child_log_listeners:
+        if listener is not None:
+            try:
+                listener.stop()
+            except Exception:
+                pass
+    _child_log_listeners.clear()
+
+
+def _restart_logging_after_fork():
+    # Поток слушателя не переживает fork: дочернему процессу нужны свои очередь и слушатель
+    global _log_listener
+    if _log_queue_handler is not None:
+        _log_listener = None
+        _child_log_listeners.clear()
+        _start_log_listener()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_logging_after_fork)
+
+
+def start_child_log_queue():
+    """
+    Очередь для логов дочерних процессов (пул процессов main.py): записи детей пишет
+    слушатель этого процесса, так что общий файл не ротируется из нескольких процессов.
+    Передаётся в пул через initializer=attach_log_queue.
+    """
+    import multiprocessing
+
+    with _log_lock:
+        if _log_queue_handler is None:
+            _start_log_listener()
+        child_queue = multiprocessing.Queue(-1)
+        listener = logging.handlers.QueueListener(child_queue, *_log_listener.handlers, respect_handler_level=True)
+        listener.start()
+        _child_log_listeners.append(listener)
+    return child_queue
+
+
+def attach_log_queue(parent_queue):
+    """initializer дочернего процесса: логи уходят в очередь родителя"""
+    global _log_listener
+    with _log_lock:
+        if _log_queue_handler is None:
+            _start_log_listener()
+        listener, _log_listener = _log_listener, None
+        _log_queue_handler.queue = parent_queue
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+
 def setup_logging(script_name: str = "zakaz2"):
-    """Настраивает логирование для скрипта"""
+    """Настраивает логирование для скрипта: запись в файл и консоль идёт в фоновом потоке"""
     logger = logging.getLogger(script_name)
     logger.setLevel(getattr(logging, LOG_LEVEL))
     logger.handlers.clear()
 
-    formatter = logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT)
-
-    file_handler = logging.FileHandler(LOG_FILE, encoding='utf-8')
-    file_handler.setLevel(getattr(logging, LOG_LEVEL))
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
-
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(getattr(logging, LOG_LEVEL))
-    console_handler.setFormatter(formatter)
-    logger.addHandler(console_handler)
+    with _log_lock:
+        if _log_queue_handler is None:
+            _start_log_listener()
+    logger.addHandler(_log_queue_handler)
 
     return logger
 
@@ -0,0 +1,212 @@
+"""
+Режим демона: парсеры запускаются по расписанию в одном долгоживущем процессе.
+
+Клиент Google Sheets, браузеры (BrowserPool) и HTTP-сессии остаются «тёплыми» между запусками,
+поэтому очередное обновление не тратит время на импорт, авторизацию и старт Chrome.
+Внеочередной запуск — через локальный HTTP:
+
+    curl -X POST http://127.0.0.1:8770/run/wb      # wb | ozon | mpstats | all
+    curl http://127.0.0.1:8770/status
+    curl http://127.0.0.1:8770/metrics             # формат Prometheus
+"""
+import importlib
+import json
+import signal
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+import config
+import metrics
+from checkpoint import stop_requested
+from config import setup_logging
+from browser_pool import BrowserPool
+
+logger = setup_logging("daemon")
+
+PARSERS = {
+    "mpstats": {"module": "mpstat", "interval": lambda: config.DAEMON_MPSTATS_INTERVAL_MIN},
+    "wb": {"module": "wb", "interval": lambda: config.DAEMON_WB_INTERVAL_MIN},
+    "ozon": {"module": "ozon", "interval": lambda: config.DAEMON_OZON_INTERVAL_MIN},
+}
+
+
+class _Job:
+    def __init__(self, name: str, module_name: str, interval_min: float):
+        self.name = name
+        self.module_name = module_name
+        self.interval = interval_min * 60
+        self.next_run = time.time()
+        self.running = False
+        self.triggered = False
+        self.last_status: Optional[str] = None
+        self.last_started: Optional[float] = None
+        self.last_duration: Optional[float] = None
+        self.runs = 0
+
+    def status(self) -> Dict:
+        return {
+            "running": self.running,
+            "interval_min": self.interval / 60,
+            "next_run": time.strftime(config.LOG_DATE_FORMAT, time.localtime(self.next_run)),
+            "last_started": time.strftime(config.LOG_DATE_FORMAT, time.localtime(self.last_started))
+            if self.last_started else None,
+            "last_status": self.last_status,
+            "last_duration": round(self.last_duration, 1) if self.last_duration is not None else None,
+            "runs": self.runs,
+        }
+
+
+class ParserDaemon:
+    def __init__(self):
+        self.jobs = {name: _Job(name, spec["module"], spec["interval"]()) for name, spec in PARSERS.items()}
+        self.browser_pool = BrowserPool()
+        self.stop_event = threading.Event()
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._threads: Dict[str, threading.Thread] = {}
+
+    def trigger(self, name: str) -> bool:
+        """Ставит парсер (или all) на немедленный запуск"""
+        names = list(self.jobs) if name == "all" else [name]
+        if any(n not in self.jobs for n in names):
+            return False
+        with self._lock:
+            for n in names:
+                job = self.jobs[n]
+                # Запрос во время выполнения — перезапуск сразу после завершения
+                if job.running:
+                    job.triggered = True
+                else:
+                    job.next_run = time.time()
+        self._wakeup.set()
+        return True
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {name: job.status() for name, job in self.jobs.items()}
+
+    def _run_job(self, job: _Job):
+        from gsheets import get_sheet_client
+        from planner import load_plan
+
+        start = time.time()
+        job.last_started = start
+        try:
+            _, sheet = get_sheet_client()
+            plan = load_plan(sheet)
+            module = importlib.import_module(job.module_name)
+            ok = module.run(sheet=sheet, plan=plan, browser_pool=self.browser_pool)
+            job.last_status = "ok" if ok else "failed"
+        except Exception as e:
+            job.last_status = f"error: {e}"
+            logger.error(f"{job.name}: аварийное завершение: {e}", exc_info=True)
+        finally:
+            job.last_duration = time.time() - start
+            metrics.observe("job_seconds", job.last_duration, parser=job.name, status=(job.last_status or "error").split(":")[0])
+            with self._lock:
+                job.running = False
+                job.runs += 1
+                job.next_run = time.time() if job.triggered else start + job.interval
+                job.triggered = False
+            logger.info(f"{job.name}: {job.last_status} за {job.last_duration:.1f} сек, "
+                        f"следующий запуск через {max(job.next_run - time.time(), 0) / 60:.0f} мин")
+            metrics.write_report("daemon", {"jobs": self.status()})
+            self._wakeup.set()
+
+    def run_forever(self):
+        logger.info("Демон запущен: " + ", ".join(
+            f"{name} каждые {job.interval / 60:.0f} мин" for name, job in self.jobs.items()))
+        while not self.stop_event.is_set():
+            now = time.time()
+            with self._lock:
+                due = [job for job in self.jobs.values() if not job.running and job.next_run <= now]
+                for job in due:
+                    job.running = True
+                pending = [job.next_run for job in self.jobs.values() if not job.running]
+            for job in due:
+                thread = threading.Thread(target=self._run_job, args=(job,), name=f"job-{job.name}", daemon=True)
+                self._threads[job.name] = thread
+                thread.start()
+            timeout = max(min(pending) - time.time(), 0.5) if pending else 60
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def stop(self):
+        """Запрос остановки (из обработчика сигнала): новые запуски не начинаются, парсеры выходят из циклов"""
+        self.stop_event.set()
+        stop_requested.set()
+        self._wakeup.set()
+
+    def shutdown(self, timeout: Optional[float] = None):
+        """Останавливает демон: ждёт, пока парсеры запишут собранное, и только затем закрывает браузеры"""
+        logger.info("Остановка демона...")
+        self.stop()
+        timeout = config.DAEMON_SHUTDOWN_TIMEOUT if timeout is None else timeout
+        deadline = time.time() + timeout
+        for name, thread in self._threads.items():
+            thread.join(max(deadline - time.time(), 0))
+            if thread.is_alive():
+                logger.warning(f"{name}: не завершился за {timeout:.0f} сек, браузеры закрываются принудительно")
+        self.browser_pool.close()
+
+
+def _make_handler(daemon: ParserDaemon):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            logger.debug(f"HTTP {self.address_string()} {format % args}")
+
+        def _send(self, status: int, payload: Dict):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/status":
+                self._send(200, daemon.status())
+            elif self.path.rstrip("/") == "/metrics":
+                body = metrics.registry.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            parts = self.path.strip("/").split("/")
+            if len(parts) == 2 and parts[0] == "run" and daemon.trigger(parts[1]):
+                logger.info(f"Внеочередной запуск по запросу: {parts[1]}")
+                self._send(202, {"queued": parts[1]})
+            else:
+                self._send(404, {"error": "unknown parser", "parsers": list(daemon.jobs) + ["all"]})
+
+    return Handler
+
+
+def main():
+    daemon = ParserDaemon()
+    server = ThreadingHTTPServer((config.DAEMON_HOST, config.DAEMON_PORT), _make_handler(daemon))
+    threading.Thread(target=server.serve_forever, name="daemon-http", daemon=True).start()
+    logger.info(f"Управление: http://{config.DAEMON_HOST}:{config.DAEMON_PORT}/status")
+
+    def handle_signal(sig, frame):
+        daemon.stop()
+
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+    try:
+        daemon.run_forever()
+    finally:
+        daemon.shutdown()
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
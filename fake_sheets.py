@@ -0,0 +1,322 @@
+"""
+Локальная замена Google Sheets API для офлайн-бенчмарков записи и чтения.
+
+Реализует вызовы, которые делает gspread: метаданные таблицы, values.get,
+values.batchUpdate и spreadsheets.batchUpdate (updateCells / repeatCell).
+Поддерживает искусственную задержку, квоты на чтение/запись в минуту и
+случайные ответы 429.
+
+Запуск:
+    python fake_sheets.py --port 8765 --rows 50000 --latency 0.05 --error-rate 0.02
+и в .env:
+    SHEETS_API_BASE_URL=http://127.0.0.1:8765
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+
+from gsheets import col_letter_to_index, col_index_to_letter
+
+_A1_RE = re.compile(r"^([A-Z]*)(\d*)$")
+_PATH_RE = re.compile(r"^/v4/spreadsheets/([^/:]+)(?:(:batchUpdate)|/values:batchUpdate|/values/(.+))?$")
+
+
+def _parse_a1(a1: str) -> Tuple[int, int, Optional[int], Optional[int]]:
+    """'M2:N10' -> (2, 13, 10, 14); отсутствующие границы -> None (до конца листа)"""
+    if "!" in a1:
+        a1 = a1.split("!", 1)[1]
+    if a1.startswith("'"):
+        return 1, 1, None, None
+    start, _, end = a1.partition(":")
+    end = end or start
+    c1, r1 = _A1_RE.match(start.upper()).groups()
+    c2, r2 = _A1_RE.match(end.upper()).groups()
+    return (
+        int(r1) if r1 else 1,
+        col_letter_to_index(c1) if c1 else 1,
+        int(r2) if r2 else None,
+        col_letter_to_index(c2) if c2 else None,
+    )
+
+
+class _Quota:
+    """Скользящее окно в 60 секунд: не более limit запросов"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.calls: List[float] = []
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        if self.limit <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self.calls = [t for t in self.calls if now - t < 60]
+            if len(self.calls) >= self.limit:
+                return False
+            self.calls.append(now)
+            return True
+
+
+class FakeSpreadsheet:
+    def __init__(self, sheet_gid: int, title: str = "Лист1", columns: int = 40):
+        self.sheet_gid = sheet_gid
+        self.title = title
+        self.columns = columns
+        self.rows: List[List[str]] = []
+        self.formats: Dict[Tuple[int, int], dict] = {}
+        self.lock = threading.Lock()
+
+    def seed(self, rows: int, column: str = "K"):
+        """Заполняет лист заголовком и артикулами WB в колонке column"""
+        col = col_letter_to_index(column)
+        header = [col_index_to_letter(c) for c in range(1, self.columns + 1)]
+        self.rows = [header]
+        for i in range(rows):
+            row = [""] * self.columns
+            row[col - 1] = str(10000000 + i * 37)
+            self.rows.append(row)
+
+    def metadata(self, spreadsheet_id: str) -> dict:
+        return {
+            "spreadsheetId": spreadsheet_id,
+            "properties": {"title": "Fake spreadsheet", "locale": "ru_RU"},
+            "sheets": [{
+                "properties": {
+                    "sheetId": self.sheet_gid,
+                    "title": self.title,
+                    "index": 0,
+                    "sheetType": "GRID",
+                    "gridProperties": {"rowCount": max(len(self.rows), 1000), "columnCount": self.columns},
+                }
+            }],
+        }
+
+    def _set(self, row: int, col: int, value: str):
+        while len(self.rows) < row:
+            self.rows.append([])
+        line = self.rows[row - 1]
+        if len(line) < col:
+            line.extend([""] * (col - len(line)))
+        line[col - 1] = value
+
+    def get_values(self, a1: str) -> List[List[str]]:
+        r1, c1, r2, c2 = _parse_a1(a1)
+        with self.lock:
+            rows = self.rows[r1 - 1:r2]
+            values = [row[c1 - 1:c2] for row in rows]
+        # Как и Google, не возвращаем хвостовые пустые ячейки и строки
+        values = [self._rstrip(v) for v in values]
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    @staticmethod
+    def _rstrip(values: List[str]) -> List[str]:
+        end = len(values)
+        while end and values[end - 1] == "":
+            end -= 1
+        return values[:end]
+
+    def write_range(self, a1: str, values: List[List]) -> int:
+        r1, c1, _, _ = _parse_a1(a1)
+        count = 0
+        with self.lock:
+            for dr, row_values in enumerate(values):
+                for dc, val in enumerate(row_values):
+                    self._set(r1 + dr, c1 + dc, "" if val is None else str(val))
+                    count += 1
+        return count
+
+    def apply_request(self, request: dict) -> int:
+        if "updateCells" in request:
+            body = request["updateCells"]
+            grid = body["range"]
+            count = 0
+            with self.lock:
+                for dr, row in enumerate(body.get("rows", [])):
+                    for dc, cell in enumerate(row.get("values", [])):
+                        entered = cell.get("userEnteredValue", {})
+                        value = next(iter(entered.values()), "")
+                        if isinstance(value, float) and value.is_integer():
+                            value = int(value)
+                        self._set(grid["startRowIndex"] + dr + 1, grid["startColumnIndex"] + dc + 1, str(value))
+                        count += 1
+            return count
+        if "repeatCell" in request:
+            body = request["repeatCell"]
+            grid = body["range"]
+            fmt = body.get("cell", {}).get("userEnteredFormat", {})
+            count = 0
+            with self.lock:
+                for r in range(grid["startRowIndex"] + 1, grid["endRowIndex"] + 1):
+                    for c in range(grid["startColumnIndex"] + 1, grid["endColumnIndex"] + 1):
+                        if fmt:
+                            self.formats[(r, c)] = fmt
+                        else:
+                            self.formats.pop((r, c), None)
+                        count += 1
+            return count
+        return 0
+
+
+class FakeSheetsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, spreadsheet: FakeSpreadsheet, latency: float = 0.0,
+                 read_quota: int = 0, write_quota: int = 0, error_rate: float = 0.0):
+        super().__init__(address, _Handler)
+        self.spreadsheet = spreadsheet
+        self.latency = latency
+        self.read_quota = _Quota(read_quota)
+        self.write_quota = _Quota(write_quota)
+        self.error_rate = error_rate
+        self.stats = {"requests": 0, "reads": 0, "writes": 0, "throttled": 0,
+                      "cells_written": 0, "bytes_in": 0, "bytes_out": 0}
+        self.stats_lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, **deltas):
+        with self.stats_lock:
+            for key, value in deltas.items():
+                self.stats[key] += value
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: FakeSheetsServer
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, payload: dict, headers: Optional[dict] = None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(bytes_out=len(body))
+
+    def _throttle(self, quota: _Quota) -> bool:
+        """Возвращает True, если запрос отклонён с 429"""
+        if quota.allow() and random.random() >= self.server.error_rate:
+            return False
+        self.server.count(throttled=1)
+        self._send(429, {"error": {
+            "code": 429,
+            "message": "Quota exceeded for quota metric 'Requests' of service 'sheets.googleapis.com'",
+            "status": "RESOURCE_EXHAUSTED",
+        }}, headers={"Retry-After": "1"})
+        return True
+
+    def _route(self):
+        path = urlsplit(self.path).path
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.server.count(requests=1)
+        return _PATH_RE.match(path)
+
+    def do_GET(self):
+        if urlsplit(self.path).path == "/_stats":
+            self._send(200, dict(self.server.stats))
+            return
+        match = self._route()
+        if not match or match.group(2):
+            self._send(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+            return
+        self.server.count(reads=1)
+        if self._throttle(self.server.read_quota):
+            return
+        spreadsheet_id, _, a1 = match.groups()
+        if a1 is None:
+            self._send(200, self.server.spreadsheet.metadata(spreadsheet_id))
+            return
+        a1 = unquote(a1)
+        self._send(200, {"range": a1, "majorDimension": "ROWS",
+                         "values": self.server.spreadsheet.get_values(a1)})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length)
+        self.server.count(bytes_in=len(raw))
+        match = self._route()
+        if not match or match.group(3):
+            self._send(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+            return
+        self.server.count(writes=1)
+        if self._throttle(self.server.write_quota):
+            return
+        body = json.loads(raw or b"{}")
+        spreadsheet_id, batch, _ = match.groups()
+        sheet = self.server.spreadsheet
+        if batch:
+            replies = []
+            cells = 0
+            for request in body.get("requests", []):
+                cells += sheet.apply_request(request)
+                replies.append({})
+            self.server.count(cells_written=cells)
+            self._send(200, {"spreadsheetId": spreadsheet_id, "replies": replies})
+            return
+        cells = 0
+        for entry in body.get("data", []):
+            cells += sheet.write_range(entry["range"], entry.get("values", []))
+        self.server.count(cells_written=cells)
+        self._send(200, {"spreadsheetId": spreadsheet_id, "totalUpdatedCells": cells,
+                         "totalUpdatedRanges": len(body.get("data", []))})
+
+
+def start_server(host: str = "127.0.0.1", port: int = 0, rows: int = 1000, sheet_gid: int = 0,
+                 **options) -> FakeSheetsServer:
+    """Запускает сервер в фоновом потоке (для бенчмарков внутри процесса)"""
+    spreadsheet = FakeSpreadsheet(sheet_gid)
+    spreadsheet.seed(rows)
+    server = FakeSheetsServer((host, port), spreadsheet, **options)
+    threading.Thread(target=server.serve_forever, name="fake-sheets", daemon=True).start()
+    return server
+
+
+def main():
+    import config
+
+    parser = argparse.ArgumentParser(description="Локальная замена Google Sheets API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rows", type=int, default=1000, help="строк с артикулами в листе")
+    parser.add_argument("--sheet-gid", type=int, default=config.SHEET_GID)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, сек")
+    parser.add_argument("--read-quota", type=int, default=0, help="чтений в минуту (0 — без лимита)")
+    parser.add_argument("--write-quota", type=int, default=0, help="записей в минуту (0 — без лимита)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля случайных ответов 429")
+    args = parser.parse_args()
+
+    spreadsheet = FakeSpreadsheet(args.sheet_gid)
+    spreadsheet.seed(args.rows)
+    server = FakeSheetsServer((args.host, args.port), spreadsheet, latency=args.latency,
+                              read_quota=args.read_quota, write_quota=args.write_quota,
+                              error_rate=args.error_rate)
+    print(f"Fake Sheets API: {server.base_url} (лист gid={args.sheet_gid}, строк: {args.rows})")
+    print(f"Статистика: {server.base_url}/_stats")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,129 @@
 """
 Общие функции для работы с Google Sheets
 """
+import json
+import os
+import re
+import threading
 import time
 import logging
-from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from typing import List, Tuple, Dict, Optional
 
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import requests
+from tenacity import Retrying, stop_after_attempt, retry_if_exception, wait_exponential_jitter
 
 import config
+import metrics
+from rate_limit import TokenBucket
 
 logger = logging.getLogger("gsheets")
 
+_A1_RE = re.compile(r"([A-Z]+)(\d+)")
+RETRYABLE_STATUSES = {500, 502, 503, 504}
+GOOGLE_SHEETS_API_ROOT = "https://sheets.googleapis.com"
+# Кэш авторизации считается устаревшим за 5 минут до истечения токена
+AUTH_CACHE_MARGIN_SECONDS = 300
+
+
+_write_bucket: Optional[TokenBucket] = None
+_write_bucket_lock = threading.Lock()
+
+
+def _get_write_bucket() -> Optional[TokenBucket]:
+    """Общий ограничитель записи; None при SHEETS_WRITE_QUOTA_PER_MINUTE <= 0 (без ограничения)"""
+    global _write_bucket
+    if config.SHEETS_WRITE_QUOTA_PER_MINUTE <= 0:
+        return None
+    with _write_bucket_lock:
+        if _write_bucket is None:
+            _write_bucket = TokenBucket(config.SHEETS_WRITE_QUOTA_PER_MINUTE, target="sheets")
+        return _write_bucket
+
+
+def _error_status(e: BaseException) -> Optional[int]:
+    response = getattr(e, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+def _is_retryable(e: BaseException) -> bool:
+    """429 и 5xx повторяем, прочие ответы API (400/403/404) — нет; сетевые сбои повторяем"""
+    status = _error_status(e)
+    if status is None:
+        return isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+    return status == 429 or status in RETRYABLE_STATUSES
+
+
+def _retry_after(e: BaseException) -> Optional[float]:
+    response = getattr(e, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+
+_backoff = wait_exponential_jitter(initial=1, max=64)
+
+
+def _wait_for_retry(retry_state) -> float:
+    e = retry_state.outcome.exception()
+    delay = _retry_after(e)
+    if delay is None:
+        delay = _backoff(retry_state)
+    if _error_status(e) == 429:
+        metrics.inc("throttled_total", target="sheets")
+        bucket = _get_write_bucket()
+        if bucket:
+            bucket.pause(delay)
+    return delay
+
+
+def _log_retry(retry_state):
+    e = retry_state.outcome.exception()
+    status = _error_status(e) or type(e).__name__
+    metrics.inc("retries_total", target="sheets")
+    logger.warning(f"Sheets API: {status}, повтор через {retry_state.next_action.sleep:.1f} сек "
+                   f"(попытка {retry_state.attempt_number})")
+
+
+def _call_with_retries(fn, max_retries: Optional[int] = None):
+    def attempt():
+        bucket = _get_write_bucket()
+        if bucket:
+            bucket.acquire()
+        return fn()
+
+    retrying = Retrying(
+        stop=stop_after_attempt(max_retries or config.SHEETS_MAX_RETRIES),
+        wait=_wait_for_retry,
+        retry=retry_if_exception(_is_retryable),
+        before_sleep=_log_retry,
+        reraise=True
+    )
+    return retrying(attempt)
+
+
+def _run_chunks(send, chunks: List, max_retries: Optional[int] = None):
+    """Отправляет независимые части запроса параллельно; первая ошибка пробрасывается"""
+    workers = min(config.SHEETS_WRITE_WORKERS, len(chunks))
+    if workers <= 1:
+        for chunk in chunks:
+            _call_with_retries(lambda: send(chunk), max_retries)
+        return
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sheets-writer") as pool:
+        futures = [pool.submit(_call_with_retries, partial(send, chunk), max_retries) for chunk in chunks]
+        for future in as_completed(futures):
+            if future.exception():
+                errors.append(future.exception())
+    if errors:
+        logger.error(f"Не записано частей: {len(errors)} из {len(chunks)}")
+        raise errors[0]
+
 
 def col_letter_to_index(letter: str) -> int:
     result = 0
@@ -29,93 +141,373 @@ def col_index_to_letter(col: int) -> str:
     return result
 
 
-def get_sheet_client(max_retries=3, delay=2):
-    for attempt in range(1, max_retries + 1):
+def _load_auth_cache() -> Optional[Dict]:
+    """Возвращает кэш токена и метаданных, если он относится к текущей таблице и ещё не истёк"""
+    path = config.SHEETS_AUTH_CACHE_FILE
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        expiry = datetime.fromisoformat(cached["expiry"])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if cached.get("spreadsheet_id") != config.SPREADSHEET_ID or cached.get("sheet_gid") != config.SHEET_GID:
+        return None
+    if expiry - timedelta(seconds=AUTH_CACHE_MARGIN_SECONDS) <= datetime.now(timezone.utc).replace(tzinfo=None):
+        return None
+    cached["expiry"] = expiry
+    return cached
+
+
+def _save_auth_cache(creds, spreadsheet, sheet):
+    if not creds.token or not creds.expiry:
+        return
+    path = config.SHEETS_AUTH_CACHE_FILE
+    data = {
+        "spreadsheet_id": config.SPREADSHEET_ID,
+        "sheet_gid": config.SHEET_GID,
+        "token": creds.token,
+        "expiry": creds.expiry.isoformat(),
+        "spreadsheet": spreadsheet._properties,
+        "worksheet": sheet._properties,
+    }
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    try:
+        path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.debug(f"Не удалось сохранить кэш авторизации: {e}")
+
+
+def _restore_sheet(client, cached: Dict):
+    """
+    Собирает Spreadsheet/Worksheet из сохранённых свойств без запросов метаданных.
+    Публичный конструктор Spreadsheet запрашивает метаданные, поэтому объект создаётся
+    через __new__ (внутренности gspread 6.x, версия закреплена в requirements.txt;
+    проверяется tests/test_gsheets.py на fake_sheets).
+    """
+    import gspread
+
+    spreadsheet = gspread.Spreadsheet.__new__(gspread.Spreadsheet)
+    spreadsheet.client = client.http_client
+    spreadsheet._properties = cached["spreadsheet"]
+    return gspread.Worksheet(spreadsheet, cached["worksheet"], spreadsheet.id, client.http_client)
+
+
+class _RedirectSession(requests.Session):
+    """Сессия, отправляющая запросы gspread на локальный сервер вместо sheets.googleapis.com"""
+
+    def __init__(self, base_url: str):
+        super().__init__()
+        self.base_url = base_url.rstrip("/")
+
+    def request(self, method, url, *args, **kwargs):
+        if url.startswith(GOOGLE_SHEETS_API_ROOT):
+            url = self.base_url + url[len(GOOGLE_SHEETS_API_ROOT):]
+        return super().request(method, url, *args, **kwargs)
+
+
+def _connect():
+    # gspread и google-auth нужны только для подключения — не загружаем их при импорте модуля
+    import gspread
+    from google.oauth2 import service_account
+
+    if config.SHEETS_API_BASE_URL:
+        logger.info(f"Google Sheets API заменён локальным сервером: {config.SHEETS_API_BASE_URL}")
+        session = metrics.instrument_session(_RedirectSession(config.SHEETS_API_BASE_URL))
+        client = gspread.Client(auth=None, session=session)
+        spreadsheet = client.open_by_key(config.SPREADSHEET_ID)
+        return client, spreadsheet.get_worksheet_by_id(config.SHEET_GID)
+
+    creds = service_account.Credentials.from_service_account_file(
+        str(config.CREDENTIALS_FILE), scopes=config.GOOGLE_SHEETS_SCOPE
+    )
+    cached = _load_auth_cache()
+    if cached:
+        creds.token = cached["token"]
+        creds.expiry = cached["expiry"]
+    client = gspread.authorize(creds)
+    metrics.instrument_session(client.http_client.session)
+
+    if cached:
         try:
-            creds = ServiceAccountCredentials.from_json_keyfile_name(
-                str(config.CREDENTIALS_FILE), config.GOOGLE_SHEETS_SCOPE
-            )
-            client = gspread.authorize(creds)
-            spreadsheet = client.open_by_key(config.SPREADSHEET_ID)
-            sheet = spreadsheet.get_worksheet_by_id(config.SHEET_GID)
-            logger.info("Подключение к Google Sheets успешно")
+            sheet = _restore_sheet(client, cached)
+            logger.info("Подключение к Google Sheets из кэша авторизации")
             return client, sheet
         except Exception as e:
-            logger.warning(f"Ошибка подключения (попытка {attempt}/{max_retries}): {e}")
-            if hasattr(e, 'response') and e.response:
-                logger.warning(f"Статус: {e.response.status_code}, тело: {e.response.text[:200]}")
-            if attempt == max_retries:
-                logger.error("Не удалось подключиться к Google Sheets")
-                raise
-            time.sleep(delay * attempt)
+            logger.warning(f"Кэш авторизации не подошёл ({e}), подключаемся заново")
 
+    spreadsheet = client.open_by_key(config.SPREADSHEET_ID)
+    sheet = spreadsheet.get_worksheet_by_id(config.SHEET_GID)
+    _save_auth_cache(creds, spreadsheet, sheet)
+    return client, sheet
 
-def safe_batch_update(sheet, updates: List[Tuple[int, int, str]], max_retries=3) -> bool:
-    if not updates:
-        return True
 
-    batch_data = []
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+
+def reset_shared_client():
+    """
+    Забывает клиент процесса. Вызывается в дочернем процессе после fork: иначе он унаследует
+    клиент родителя вместе с keep-alive соединениями и будет делить с ним одно TLS-соединение.
+    """
+    global _shared_client, _shared_client_lock
+    _shared_client = None
+    _shared_client_lock = threading.Lock()
+
+
+def get_sheet_client(max_retries=3, delay=2):
+    """
+    Возвращает (client, sheet). Внутри процесса клиент создаётся один раз и переиспользуется
+    всеми парсерами; токен и метаданные листа кэшируются на диске до истечения токена.
+    """
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is not None:
+            return _shared_client
+
+        for attempt in range(1, max_retries + 1):
+            try:
+                with metrics.timer("stage_seconds", stage="sheets_connect"):
+                    _shared_client = _connect()
+                logger.info("Подключение к Google Sheets успешно")
+                return _shared_client
+            except Exception as e:
+                logger.warning(f"Ошибка подключения (попытка {attempt}/{max_retries}): {e}")
+                if hasattr(e, 'response') and e.response:
+                    logger.warning(f"Статус: {e.response.status_code}, тело: {e.response.text[:200]}")
+                if attempt == max_retries:
+                    logger.error("Не удалось подключиться к Google Sheets")
+                    raise
+                time.sleep(delay * attempt)
+
+
+def _coalesce_blocks(cells: Dict[Tuple[int, int], object]) -> List[Tuple[int, int, List[List]]]:
+    """
+    Склеивает ячейки в прямоугольные блоки: сначала соседние колонки в строке,
+    затем одинаковые отрезки в подряд идущих строках.
+    Возвращает [(start_row, start_col, values_2d)].
+    """
+    # Горизонтальные отрезки: row -> [(start_col, [values])]
+    row_spans = {}
+    for (row, col) in sorted(cells):
+        spans = row_spans.setdefault(row, [])
+        if spans and spans[-1][0] + len(spans[-1][1]) == col:
+            spans[-1][1].append(cells[(row, col)])
+        else:
+            spans.append((col, [cells[(row, col)]]))
+
+    # Вертикальное объединение отрезков с одинаковыми колонками
+    open_blocks = {}  # (start_col, width) -> [start_row, end_row, values]
+    blocks = []
+    for row in sorted(row_spans):
+        for start_col, values in row_spans[row]:
+            key = (start_col, len(values))
+            block = open_blocks.get(key)
+            if block and block[1] == row - 1:
+                block[1] = row
+                block[2].append(values)
+            else:
+                if block:
+                    blocks.append((key, block))
+                open_blocks[key] = [row, row, [values]]
+    blocks.extend(open_blocks.items())
+
+    return [
+        (start_row, start_col, values)
+        for (start_col, _), (start_row, _, values) in sorted(blocks, key=lambda b: (b[1][0], b[0][0]))
+    ]
+
+
+def coalesce_updates(updates: List[Tuple[int, int, str]]) -> List[Dict]:
+    """
+    Превращает точечные обновления в A1-диапазоны для values.batchUpdate.
+    При повторной записи в ту же ячейку побеждает последнее значение.
+    """
+    cells = {}
     for row, col, val in updates:
-        col_letter = col_index_to_letter(col)
+        cells[(row, col)] = val
+
+    batch_data = []
+    for start_row, start_col, values in _coalesce_blocks(cells):
+        start = f"{col_index_to_letter(start_col)}{start_row}"
+        end = f"{col_index_to_letter(start_col + len(values[0]) - 1)}{start_row + len(values) - 1}"
         batch_data.append({
-            'range': f"{col_letter}{row}",
-            'values': [[val]]
+            'range': start if start == end else f"{start}:{end}",
+            'values': values
         })
+    return batch_data
+
+
+def _grid_range(sheet_id: int, start_row: int, start_col: int, values: List[List]) -> Dict:
+    return {
+        "sheetId": sheet_id,
+        "startRowIndex": start_row - 1,
+        "endRowIndex": start_row - 1 + len(values),
+        "startColumnIndex": start_col - 1,
+        "endColumnIndex": start_col - 1 + len(values[0])
+    }
+
+
+def _hex_to_rgb(hex_color: str) -> Dict:
+    hex_color = hex_color.lstrip('#')
+    return {
+        "red": int(hex_color[0:2], 16) / 255.0,
+        "green": int(hex_color[2:4], 16) / 255.0,
+        "blue": int(hex_color[4:6], 16) / 255.0
+    }
+
+
+def build_color_requests(sheet_id: int, color_cells: List[Tuple[int, int, Optional[str]]]) -> List[Dict]:
+    """
+    Строит repeatCell-запросы заливки. Соседние ячейки одного цвета объединяются в один диапазон,
+    цвет None сбрасывает заливку ячейки.
+    """
+    by_color = {}
+    for row, col, hex_color in color_cells:
+        by_color.setdefault(hex_color, {})[(row, col)] = True
+
+    batch_requests = []
+    for hex_color, cells in by_color.items():
+        cell_format = {"backgroundColor": _hex_to_rgb(hex_color)} if hex_color else {}
+        for start_row, start_col, values in _coalesce_blocks(cells):
+            batch_requests.append({
+                "repeatCell": {
+                    "range": _grid_range(sheet_id, start_row, start_col, values),
+                    "cell": {"userEnteredFormat": cell_format},
+                    "fields": "userEnteredFormat.backgroundColor"
+                }
+            })
+    return batch_requests
+
+
+def _estimate_size(entry: Dict) -> int:
+    return len(json.dumps(entry, ensure_ascii=False).encode('utf-8'))
 
-    for attempt in range(max_retries):
-        try:
-            sheet.batch_update(batch_data, value_input_option='USER_ENTERED')
-            return True
-        except Exception as e:
-            if "quota" in str(e).lower() or "rate" in str(e).lower():
-                wait = 2 ** attempt
-                logger.warning(f"Лимит API, ожидание {wait} сек...")
-                time.sleep(wait)
-            else:
-                logger.error(f"Ошибка batch update: {e}")
-                if attempt == max_retries - 1:
-                    raise
-    return False
 
+def _slice_rows(entry: Dict, start: int, stop: int) -> Dict:
+    """Часть блока значений со строками [start, stop)"""
+    col, row = _A1_RE.match(entry["range"]).groups()
+    values = entry["values"][start:stop]
+    first = f"{col}{int(row) + start}"
+    last = f"{col_index_to_letter(col_letter_to_index(col) + len(values[0]) - 1)}{int(row) + stop - 1}"
+    return {"range": first if first == last else f"{first}:{last}", "values": values}
 
-def apply_cell_colors(sheet, color_requests: List[Tuple[int, int, str]], max_retries=3) -> bool:
+
+def _split_oversize(entry: Dict, size: int, max_bytes: int) -> List[Tuple[Dict, int]]:
+    """
+    Блок значений больше лимита делится по строкам (одна строка больше лимита остаётся как есть).
+    repeatCell не содержит данных ячеек: его размер не зависит от диапазона.
+    """
+    rows = len(entry["values"]) if "values" in entry else 1
+    if size <= max_bytes or rows < 2:
+        return [(entry, size)]
+    per_part = max(1, rows * max_bytes // size)
+    parts = []
+    for start in range(0, rows, per_part):
+        part = _slice_rows(entry, start, min(rows, start + per_part))
+        parts.extend(_split_oversize(part, _estimate_size(part), max_bytes))
+    return parts
+
+
+def split_payload(entries: List[Dict], max_bytes: int = None) -> List[List[Dict]]:
+    """Делит список блоков на части, каждая из которых укладывается в лимит размера запроса"""
+    max_bytes = max_bytes or config.SHEETS_MAX_PAYLOAD_BYTES
+    chunks = []
+    current = []
+    current_size = 0
+    for entry, size in (part for entry in entries for part in _split_oversize(entry, _estimate_size(entry), max_bytes)):
+        if current and current_size + size > max_bytes:
+            chunks.append(current)
+            current = []
+            current_size = 0
+        current.append(entry)
+        current_size += size
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _normalize_cell(value) -> str:
+    text = str(value if value is not None else "").replace("\xa0", " ").strip()
+    compact = text.replace(" ", "").replace(",", ".")
+    try:
+        return repr(float(compact))
+    except ValueError:
+        return text
+
+
+def diff_updates(updates: List[Tuple[int, int, str]],
+                 snapshot: List[List[str]]) -> Tuple[List[Tuple[int, int, str]], int]:
+    """
+    Отбрасывает обновления, значение которых совпадает со снимком get_all_values().
+    Числа сравниваются без учёта пробелов-разделителей и десятичной запятой.
+    Возвращает (изменённые обновления, количество пропущенных).
+    """
+    changed = []
+    skipped = 0
+    for row, col, val in updates:
+        current = ""
+        if row - 1 < len(snapshot) and col - 1 < len(snapshot[row - 1]):
+            current = snapshot[row - 1][col - 1]
+        if _normalize_cell(current) == _normalize_cell(val):
+            skipped += 1
+        else:
+            changed.append((row, col, val))
+    return changed, skipped
+
+
+def safe_batch_update(sheet, updates: List[Tuple[int, int, str]], max_retries=None,
+                      snapshot: Optional[List[List[str]]] = None) -> bool:
+    """
+    Записывает значения через values.batchUpdate. Части запроса отправляются параллельно
+    в пределах квоты; при неустранимой ошибке API исключение пробрасывается.
+    """
+    if snapshot is not None:
+        total = len(updates)
+        updates, skipped = diff_updates(updates, snapshot)
+        metrics.inc("sheets_cells_total", skipped, result="unchanged")
+        logger.info(f"Без изменений: {skipped} из {total} ячеек, к записи: {len(updates)}")
+
+    if not updates:
+        return True
+
+    batch_data = coalesce_updates(updates)
+    chunks = split_payload(batch_data)
+    logger.info(f"Обновлений: {len(updates)}, диапазонов: {len(batch_data)}, запросов: {len(chunks)}")
+
+    def send(chunk):
+        sheet.batch_update(chunk, value_input_option='USER_ENTERED')
+
+    with metrics.timer("stage_seconds", stage="sheets_write"):
+        _run_chunks(send, chunks, max_retries)
+    metrics.inc("sheets_cells_total", len(updates), result="written")
+    return True
+
+
+def write_values_and_colors(sheet, updates: List[Tuple[int, int, str]],
+                            color_cells: List[Tuple[int, int, Optional[str]]], max_retries=None,
+                            snapshot: Optional[List[List[str]]] = None) -> bool:
+    """
+    Записывает значения, затем заливку. Значения идут через values.batchUpdate с USER_ENTERED:
+    таблица сама разбирает числа по своей локали ("4,8", "1 234"), ведущие нули и апостроф,
+    чего не повторить вручную в updateCells. Поэтому это минимум два вызова API, а не один;
+    заливка отправляется только после записи всех значений.
+    """
+    safe_batch_update(sheet, updates, max_retries, snapshot)
+    if color_cells:
+        logger.info(f"Ячеек с заливкой: {len(color_cells)}")
+        apply_cell_colors(sheet, color_cells, max_retries)
+    return True
+
+
+def apply_cell_colors(sheet, color_requests: List[Tuple[int, int, Optional[str]]], max_retries=None) -> bool:
     if not color_requests:
         return True
 
-    for attempt in range(max_retries):
-        try:
-            requests = []
-            for row, col, hex_color in color_requests:
-                hex_color = hex_color.lstrip('#')
-                r = int(hex_color[0:2], 16) / 255.0
-                g = int(hex_color[2:4], 16) / 255.0
-                b = int(hex_color[4:6], 16) / 255.0
-                requests.append({
-                    "repeatCell": {
-                        "range": {
-                            "sheetId": sheet.id,
-                            "startRowIndex": row - 1,
-                            "endRowIndex": row,
-                            "startColumnIndex": col - 1,
-                            "endColumnIndex": col
-                        },
-                        "cell": {
-                            "userEnteredFormat": {
-                                "backgroundColor": {"red": r, "green": g, "blue": b}
-                            }
-                        },
-                        "fields": "userEnteredFormat.backgroundColor"
-                    }
-                })
-            sheet.spreadsheet.batch_update({"requests": requests})
-            return True
-        except Exception as e:
-            if "quota" in str(e).lower() or "rate" in str(e).lower():
-                wait = 2 ** attempt
-                logger.warning(f"Лимит API (форматирование), ожидание {wait} сек...")
-                time.sleep(wait)
-            else:
-                logger.error(f"Ошибка заливки цветом: {e}")
-                if attempt == max_retries - 1:
-                    return False
-    return False
+    chunks = split_payload(build_color_requests(sheet.id, color_requests))
+    _run_chunks(lambda chunk: sheet.spreadsheet.batch_update({"requests": chunk}), chunks, max_retries)
+    return True
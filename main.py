@@ -1,11 +1,19 @@
+import argparse
+import importlib
+import importlib.util
 import subprocess
 import sys
 import time
 import io
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from pathlib import Path
+from typing import List, Dict, Optional, Tuple
 from tqdm import tqdm
 
 import config
+import metrics
+import profiling
+from checkpoint import stop_requested
 from config import setup_logging
 
 # Устанавливаем кодировку stdout для корректного отображения русских символов
@@ -16,13 +24,15 @@ logger = setup_logging("main")
 PYTHON_EXECUTABLE = sys.executable
 
 SCRIPTS = [
-    {"name": "MPStats parser", "path": "mpstat.py"},
-    {"name": "Wildberries parser", "path": "wb.py"},
-    {"name": "Ozon parser", "path": "ozon.py"}
+    {"name": "MPStats parser", "path": "mpstat.py", "module": "mpstat"},
+    {"name": "Wildberries parser", "path": "wb.py", "module": "wb"},
+    {"name": "Ozon parser", "path": "ozon.py", "module": "ozon"}
 ]
 
+RUN_MODES = ("thread", "process", "subprocess")
 
-def run_script(script_path: str, name: str) -> bool:
+
+def run_script(script_path: str, name: str, resume: bool = False, profile_out: Optional[str] = None) -> bool:
     logger.info("\n" + "=" * 70)
     logger.info(f"🚀 ЗАПУСК: {name}")
     logger.info("=" * 70)
@@ -31,10 +41,16 @@ def run_script(script_path: str, name: str) -> bool:
         logger.error(f"Файл не найден: {script_path}")
         return False
 
+    args = [PYTHON_EXECUTABLE, script_path]
+    if resume:
+        args.append("--resume")
+    if profile_out:
+        args += ["--profile", "--profile-out", profile_out]
+
     try:
         start = time.time()
         process = subprocess.run(
-            [PYTHON_EXECUTABLE, script_path],
+            args,
             text=True,
             encoding="utf-8",
             errors="replace"
@@ -50,6 +66,129 @@ def run_script(script_path: str, name: str) -> bool:
         return False
 
 
+def run_parser(module_name: str, sheet=None, plan=None, browser_pool=None,
+               resume: bool = False, profile_out: Optional[str] = None) -> Tuple[bool, float]:
+    """
+    Импортирует модуль парсера и выполняет его run() в текущем процессе.
+    С profile_out профилируется поток парсера, дамп сохраняется в эту папку.
+    """
+    start = time.time()
+    module = importlib.import_module(module_name)
+    with profiling.profile_run(module_name, profile_out is not None, profile_out):
+        ok = bool(module.run(sheet=sheet, plan=plan, browser_pool=browser_pool, resume=resume))
+    return ok, time.time() - start
+
+
+def run_parser_process(module_name: str, plan=None, resume: bool = False,
+                       profile_out: Optional[str] = None) -> Tuple[bool, float, Dict]:
+    """run_parser для пула процессов: метрики дочернего процесса возвращаются родителю"""
+    ok, duration = run_parser(module_name, plan=plan, resume=resume, profile_out=profile_out)
+    return ok, duration, metrics.registry.snapshot()
+
+
+def init_child_process(log_queue):
+    """
+    initializer пула процессов: логи уходят родителю, клиент Sheets создаётся заново,
+    метрики считаются с нуля (родитель сложит их со своими)
+    """
+    config.attach_log_queue(log_queue)
+    metrics.registry.reset()
+    from gsheets import reset_shared_client
+    reset_shared_client()
+
+
+def run_concurrent(mode: str, resume: bool = False, profile_out: Optional[str] = None) -> List[Dict]:
+    """
+    Запускает все парсеры одновременно: в потоках одного процесса (общий клиент Sheets)
+    или в пуле процессов. Парсеры пишут в разные колонки и ходят на разные хосты.
+    """
+    from gsheets import get_sheet_client
+    from planner import load_plan
+    from browser_pool import BrowserPool
+
+    # Лист читается и классифицируется один раз; задачи раздаются парсерам
+    _, sheet = get_sheet_client()
+    plan = load_plan(sheet)
+    logger.info(f"📋 План: {plan.summary()}")
+
+    stop_requested.clear()
+    executor_cls = ThreadPoolExecutor if mode == "thread" else ProcessPoolExecutor
+    browser_pool = BrowserPool() if mode == "thread" else None
+    statuses = {script["name"]: {"name": script["name"], "status": "running", "ok": False, "duration": 0.0}
+                for script in SCRIPTS}
+    pbar = tqdm(total=len(SCRIPTS), desc="Общий прогресс", unit="парсер", colour="cyan")
+
+    # Логи дочерних процессов пишет этот процесс: parser.log не ротируется из нескольких процессов сразу
+    pool_kwargs = {} if mode == "thread" else {"initializer": init_child_process,
+                                               "initargs": (config.start_child_log_queue(),)}
+    with executor_cls(max_workers=len(SCRIPTS), **pool_kwargs) as pool:
+        if mode == "thread":
+            futures = {pool.submit(run_parser, script["module"], sheet, plan, browser_pool,
+                                   resume, profile_out): script
+                       for script in SCRIPTS}
+        else:
+            # В пул процессов объект листа не передаётся: после init_child_process дочерний процесс
+            # подключается сам (из кэша авторизации), не деля соединения с родителем
+            futures = {pool.submit(run_parser_process, script["module"], plan, resume, profile_out): script
+                       for script in SCRIPTS}
+        def collect(future):
+            name = futures[future]["name"]
+            status = statuses[name]
+            try:
+                result = future.result()
+                status["ok"], status["duration"] = result[:2]
+                if len(result) > 2:
+                    metrics.registry.merge(result[2])
+                status["status"] = "ok" if status["ok"] else "failed"
+            except BaseException as e:
+                status["status"] = "error"
+                status["error"] = str(e) or type(e).__name__
+                logger.error(f"{name} аварийно завершился: {status['error']}")
+            logger.info(f"{'✅' if status['ok'] else '❌'} {name}: {status['status']} за {status['duration']:.1f} сек")
+            running = [s["name"] for s in statuses.values() if s["status"] == "running"]
+            pbar.set_postfix_str(f"Выполняются: {', '.join(running)}" if running else "")
+            pbar.update(1)
+
+        pending = set(futures)
+        try:
+            for future in as_completed(futures):
+                pending.discard(future)
+                collect(future)
+        except KeyboardInterrupt:
+            # Ctrl+C получает только главный поток: парсеры в потоках останавливаются по флагу
+            # и записывают собранное (в пуле процессов сигнал получают сами дочерние процессы)
+            logger.warning("Прервано пользователем — ждём, пока парсеры запишут собранные данные")
+            stop_requested.set()
+            pool.shutdown(wait=False, cancel_futures=True)
+            for future in as_completed(pending):
+                collect(future)
+
+    pbar.close()
+    if browser_pool:
+        browser_pool.close()
+    return list(statuses.values())
+
+
+def run_sequential(resume: bool = False, profile_out: Optional[str] = None) -> List[Dict]:
+    """Прежний режим: парсеры по очереди в отдельных процессах с паузой между ними"""
+    results = []
+    pbar = tqdm(total=len(SCRIPTS), desc="Общий прогресс", unit="парсер", colour="cyan")
+
+    for script in SCRIPTS:
+        pbar.set_postfix_str(f"Запуск: {script['name']}")
+        start = time.time()
+        success = run_script(script["path"], script["name"], resume, profile_out)
+        results.append({"name": script["name"], "status": "ok" if success else "failed",
+                        "ok": success, "duration": time.time() - start})
+        pbar.update(1)
+        if script != SCRIPTS[-1]:
+            logger.info(f"⏸️ Пауза {config.DELAY_BETWEEN_SCRIPTS} сек...")
+            time.sleep(config.DELAY_BETWEEN_SCRIPTS)
+
+    pbar.close()
+    return results
+
+
 def check_dependencies():
     logger.info("\n" + "=" * 70)
     logger.info("🔍 ПРОВЕРКА ЗАВИСИМОСТЕЙ")
@@ -62,12 +201,15 @@ def check_dependencies():
             logger.error(f"   {e}")
         return False
 
-    required = ["selenium", "seleniumwire", "undetected_chromedriver", "gspread", "oauth2client", "pandas", "dotenv", "requests", "tenacity", "tqdm"]
+    required = ["selenium", "seleniumwire", "undetected_chromedriver", "gspread", "google.auth", "pandas", "dotenv", "requests", "tenacity", "tqdm"]
+    # find_spec только ищет пакет, не выполняя его: проверка не тратит секунды на импорт selenium и pandas
     missing = []
     for pkg in required:
         try:
-            __import__(pkg)
-        except ImportError:
+            if importlib.util.find_spec(pkg) is None:
+                missing.append(pkg)
+        except ModuleNotFoundError:
+            # Для "google.auth" без установленного родительского пакета google
             missing.append(pkg)
 
     if missing:
@@ -80,7 +222,19 @@ def check_dependencies():
     return True
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Запуск всех парсеров")
+    parser.add_argument("--mode", choices=RUN_MODES, default=config.PARSERS_RUN_MODE,
+                        help="thread — параллельно в одном процессе, process — параллельно в пуле процессов, "
+                             "subprocess — последовательно, как раньше")
+    parser.add_argument("--resume", action="store_true",
+                        help="пропустить задачи, уже выполненные прерванным запуском (по журналам в checkpoints/)")
+    profiling.add_arguments(parser)
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
     logger.info("\n🔥 ОБЩИЙ ЗАПУСК ВСЕХ ПАРСЕРОВ")
     logger.info("=" * 70)
 
@@ -89,27 +243,26 @@ def main():
 
     config.print_config_info()
 
-    results = []
-    pbar = tqdm(total=len(SCRIPTS), desc="Общий прогресс", unit="парсер", colour="cyan")
-
-    for idx, script in enumerate(SCRIPTS, 1):
-        pbar.set_postfix_str(f"Запуск: {script['name']}")
-        success = run_script(script["path"], script["name"])
-        results.append((script["name"], success))
-        pbar.update(1)
-        if script != SCRIPTS[-1]:
-            logger.info(f"⏸️ Пауза {config.DELAY_BETWEEN_SCRIPTS} сек...")
-            time.sleep(config.DELAY_BETWEEN_SCRIPTS)
-
-    pbar.close()
+    start = time.time()
+    logger.info(f"Режим запуска: {args.mode}")
+    # Каждый парсер профилируется отдельно и сохраняет свой дамп
+    profile_out = (args.profile_out or str(config.PROFILE_DIR)) if args.profile else None
+    if args.mode == "subprocess":
+        results = run_sequential(args.resume, profile_out)
+    else:
+        results = run_concurrent(args.mode, args.resume, profile_out)
 
     logger.info("\n" + "=" * 70)
     logger.info("📊 ИТОГ ЗАПУСКА")
     logger.info("=" * 70)
-    for name, ok in results:
-        logger.info(f"{'✅' if ok else '❌'} {name}")
+    for result in results:
+        logger.info(f"{'✅' if result['ok'] else '❌'} {result['name']} ({result['duration']:.1f} сек)")
+    logger.info(f"Общее время: {time.time() - start:.1f} сек")
+    metrics.write_report("main", {"mode": args.mode, "parsers": results})
     logger.info("\n🏁 ВСЕ СКРИПТЫ ОТРАБОТАЛИ")
     logger.info("=" * 70)
+    if not all(result["ok"] for result in results):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,245 @@
+"""
+Метрики запуска: счётчики, гистограммы задержек и таймеры этапов.
+
+Реестр общий для процесса (все парсеры в режиме thread пишут в него одновременно).
+В конце запуска write_report() сохраняет JSON-отчёт в METRICS_DIR и, если включено
+METRICS_PROMETHEUS, тот же набор метрик в текстовом формате Prometheus
+(подходит для textfile collector node_exporter).
+
+    with metrics.timer("stage_seconds", parser="wb", stage="cookies"):
+        ...
+    metrics.inc("retries_total", target="sheets")
+"""
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import config
+
+logger = logging.getLogger("metrics")
+
+# Границы корзин гистограмм в секундах: от быстрых HTTP-запросов до загрузки страниц Selenium
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+PREFIX = "ecomstats_"
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def observe(self, value: float):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Оценка квантиля по верхней границе корзины (как histogram_quantile без интерполяции)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+    def to_dict(self) -> Dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "min": self.min,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "buckets": self.counts,
+        }
+
+    def merge(self, data: Dict):
+        for i, n in enumerate(data["buckets"]):
+            self.counts[i] += n
+        self.count += data["count"]
+        self.sum += data["sum"]
+        for attr, pick in (("min", min), ("max", max)):
+            if data[attr] is not None:
+                current = getattr(self, attr)
+                setattr(self, attr, data[attr] if current is None else pick(current, data[attr]))
+
+
+class Registry:
+    def __init__(self):
+        self.started = time.time()
+        self._counters: Dict[str, Dict[LabelKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelKey, _Histogram]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = _Histogram()
+            series[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name: str, **labels):
+        """Декоратор: время каждого вызова функции попадает в гистограмму name"""
+        def decorator(fn):
+            @wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def reset(self):
+        """Очищает метрики. В дочернем процессе после fork: иначе метрики родителя посчитаются дважды"""
+        self.__init__()
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            return {
+                "counters": {name: [{"labels": dict(k), "value": v} for k, v in series.items()]
+                             for name, series in self._counters.items()},
+                "histograms": {name: [{"labels": dict(k), **h.to_dict()} for k, h in series.items()]
+                               for name, series in self._histograms.items()},
+            }
+
+    def merge(self, snapshot: Dict):
+        """Добавляет метрики, собранные в другом процессе (режим process)"""
+        for name, series in snapshot.get("counters", {}).items():
+            for entry in series:
+                self.inc(name, entry["value"], **entry["labels"])
+        with self._lock:
+            for name, series in snapshot.get("histograms", {}).items():
+                target = self._histograms.setdefault(name, {})
+                for entry in series:
+                    key = _label_key(entry["labels"])
+                    if key not in target:
+                        target[key] = _Histogram()
+                    target[key].merge(entry)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                for key, value in series.items():
+                    lines.append(f"{PREFIX}{name}{_format_labels(key)} {value}")
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                for key, hist in series.items():
+                    cumulative = 0
+                    for bound, n in zip(BUCKETS + ("+Inf",), hist.counts):
+                        cumulative += n
+                        lines.append(f"{PREFIX}{name}_bucket{_format_labels(key + (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{PREFIX}{name}_sum{_format_labels(key)} {hist.sum}")
+                    lines.append(f"{PREFIX}{name}_count{_format_labels(key)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(key: LabelKey) -> str:
+    if not key:
+        return ""
+    def escape(value: str) -> str:
+        return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in key) + "}"
+
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
+timed = registry.timed
+
+
+def record_response(response, *args, **kwargs):
+    """Хук requests.Session: задержка, статус и объём ответа по хосту"""
+    host = urlsplit(response.url).hostname or ""
+    inc("http_requests_total", host=host, status=response.status_code)
+    observe("http_request_seconds", response.elapsed.total_seconds(), host=host)
+    size = response.headers.get("Content-Length")
+    if size is None or not size.isdigit():
+        # Без Content-Length (chunked) считаем по телу; для обычных запросов оно всё равно читается
+        size = len(response.content)
+    inc("http_response_bytes_total", int(size), host=host)
+    if response.request is not None and response.request.body:
+        inc("http_request_bytes_total", len(response.request.body), host=host)
+
+
+def instrument_session(session):
+    """Подключает record_response к сессии requests (однократно)"""
+    hooks = session.hooks.setdefault("response", [])
+    if record_response not in hooks:
+        hooks.append(record_response)
+    return session
+
+
+def count_retry(target: str):
+    """before_sleep для tenacity: считает повторы по цели (wb, ozon, sheets...)"""
+    def before_sleep(retry_state):
+        inc("retries_total", target=target)
+    return before_sleep
+
+
+def write_report(run_name: str, extra: Optional[Dict] = None) -> Optional[str]:
+    """Сохраняет JSON-отчёт (и .prom при METRICS_PROMETHEUS) в METRICS_DIR; возвращает путь к отчёту"""
+    directory = config.METRICS_DIR
+    report = {
+        "run": run_name,
+        "started_at": datetime.fromtimestamp(registry.started).strftime(config.LOG_DATE_FORMAT),
+        "duration": round(time.time() - registry.started, 3),
+        **(extra or {}),
+        **registry.snapshot(),
+    }
+    path = directory / f"{run_name}.json"
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".json.tmp")
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+        os.replace(tmp, path)
+        if config.METRICS_PROMETHEUS:
+            prom = directory / f"{run_name}.prom"
+            tmp = prom.with_suffix(".prom.tmp")
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(registry.render_prometheus())
+            os.replace(tmp, prom)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить отчёт метрик: {e}")
+        return None
+    logger.info(f"Отчёт метрик: {path}")
+    return str(path)
@@ -1,23 +1,30 @@
+import argparse
 import sys
 import time
 import random
 from pathlib import Path
-from typing import List, Tuple, Optional
+from typing import Optional
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
-import pandas as pd
 from tqdm import tqdm
 
+# WebDriverWait и expected_conditions импортируются внутри функций: selenium.webdriver.support
+# подтягивает весь remote webdriver, а запуску без браузера (кэш, --resume) он не нужен
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.common.action_chains import ActionChains
 
 import config
+import metrics
+import profiling
 from config import setup_logging
-from uc_wire_tunnel import UCWithTunnel
-from proxy_manager import ProxyManager
+from uc_wire_tunnel import BLOCK_DEFAULT, UCWithTunnel
+from proxy_manager import get_proxy_manager, proxy_key
+from result_cache import ResultCache
+from planner import Plan, load_plan
+from browser_pool import BrowserPool, lease_driver
+from checkpoint import Checkpoint, raise_if_stopped
 from gsheets import safe_batch_update, col_letter_to_index, get_sheet_client
 
 logger = setup_logging("mpstats_parser")
@@ -52,17 +59,20 @@ def setup_browser(headless=False):
     logger.info("Инициализация UC драйвера для MPStats...")
     proxy_config = None
     if config.USE_PROXY:
-        pm = ProxyManager(str(config.PROXY_FILE))
-        if pm.has_proxies():
-            proxy = pm.get_first()
-            if proxy:
-                proxy_config = pm.format_for_selenium_wire(proxy)
-                logger.info(f"Использование прокси: {proxy['host']}:{proxy['port']}")
-
-    tunnel = UCWithTunnel(proxy_config=proxy_config)
+        pm = get_proxy_manager()
+        proxy = pm.acquire()
+        if proxy:
+            proxy_config = pm.format_for_selenium_wire(proxy)
+            logger.info(f"Использование прокси: {proxy_key(proxy)}")
+
+    tunnel = UCWithTunnel(proxy_config=proxy_config, intercept=config.BROWSER_INTERCEPT,
+                          capture=config.BROWSER_CAPTURE)
     driver = tunnel.create_driver(
         headless=headless,
-        user_data_dir=str(config.CHROME_PROFILE_MPSTATS)
+        user_data_dir=str(config.CHROME_PROFILE_MPSTATS),
+        block_resources=BLOCK_DEFAULT if config.BLOCK_RESOURCES else None,
+        profile_template=config.CHROME_PROFILE_TEMPLATE,
+        slim_profile=config.CHROME_SLIM_PROFILE
     )
 
     # Настройка папки загрузок
@@ -77,7 +87,11 @@ def setup_browser(headless=False):
     return driver, tunnel
 
 
+@metrics.timed("stage_seconds", parser="mpstats", stage="login")
 def check_and_login_mpstats(driver) -> bool:
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+
     try:
         logger.info("Проверка авторизации на MPStats...")
         driver.get("https://mpstats.io/login")
@@ -177,6 +191,9 @@ def check_and_login_mpstats(driver) -> bool:
 
 
 def clear_all_filters(driver):
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+
     try:
         logger.debug("Очистка фильтров...")
         inp = WebDriverWait(driver, 10).until(
@@ -190,6 +207,9 @@ def clear_all_filters(driver):
 
 
 def fill_name_filter(driver, name):
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+
     try:
         logger.debug(f"Заполнение фильтра: {name}")
         inp = WebDriverWait(driver, 10).until(
@@ -205,6 +225,9 @@ def fill_name_filter(driver, name):
 
 
 def click_download_csv(driver):
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+
     logger.info("📥 Скачивание CSV...")
     wait = WebDriverWait(driver, 30)
 
@@ -269,6 +292,8 @@ def wait_new_file(timeout=60):
 
 
 def parse_csv(file_path):
+    import pandas as pd
+
     logger.debug(f"Парсинг CSV: {file_path}")
     separators = [';', ',']
     encodings = ['utf-8', 'cp1251']
@@ -331,27 +356,31 @@ def calculate(items):
     return str(avg), f"{sales} / {len(items)}"
 
 
-def get_all_filled_rows(sheet, column_letter: str) -> List[Tuple[int, str]]:
-    col_idx = col_letter_to_index(column_letter) - 1
-    values = sheet.get_all_values()
-    rows = []
-    for i, row in enumerate(values, start=1):
-        if i == 1:
-            continue
-        if len(row) > col_idx and row[col_idx].strip():
-            rows.append((i, row[col_idx].strip()))
-    return rows
+def normalize_link(link: str) -> str:
+    """Приводит ссылку MPStats к каноничному виду для ключа кэша"""
+    parts = urlsplit(link.strip())
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    path = parts.path.rstrip("/") or "/"
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), path, query, parts.fragment))
 
 
-def get_name_filter(sheet, row: int) -> Optional[str]:
-    try:
-        val = sheet.cell(row, col_letter_to_index(config.MPSTATS_FILTER_NAME_COLUMN)).value
-        return val.strip() if val else None
-    except:
-        return None
+def make_cache_key(link: str, filter_name: Optional[str]) -> str:
+    name = " ".join((filter_name or "").split()).casefold()
+    return f"{normalize_link(link)}|{name}"
+
+
+def open_cache() -> ResultCache:
+    return ResultCache(
+        config.MPSTATS_CACHE_FILE,
+        ttl_seconds=config.MPSTATS_CACHE_TTL_HOURS * 3600,
+        refresh_hour=config.MPSTATS_REFRESH_HOUR,
+    )
 
 
 def wait_for_table(driver, timeout=30):
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+
     try:
         WebDriverWait(driver, timeout).until(
             EC.presence_of_element_located((By.CSS_SELECTOR, ".ag-root, .ag-grid, table"))
@@ -363,122 +392,204 @@ def wait_for_table(driver, timeout=30):
         return False
 
 
-def main():
+def apply_cached(tasks, cache: ResultCache, all_updates: list) -> list:
+    """Дописывает в all_updates результаты из кэша и возвращает задачи, которым нужен браузер"""
+    col_price = col_letter_to_index(config.MPSTATS_AVG_PRICE_COLUMN)
+    col_sales = col_letter_to_index(config.MPSTATS_SALES_COLUMN)
+    pending = []
+    for row_num, link_value, filter_name in tasks:
+        cached = cache.get(make_cache_key(link_value, filter_name))
+        if cached:
+            all_updates.append((row_num, col_price, cached["avg_price"]))
+            all_updates.append((row_num, col_sales, cached["sales"]))
+        else:
+            pending.append((row_num, link_value, filter_name))
+    return pending
+
+
+def process_tasks(driver, tasks, cache: ResultCache, all_updates: list,
+                  checkpoint: Optional[Checkpoint] = None):
+    """
+    Выгружает CSV по задачам (row, ссылка, фильтр) в авторизованном браузере
+    и дописывает результаты в all_updates. Успешные задачи фиксируются в checkpoint.
+    Возвращает (parsed, errors).
+    """
+    col_price = col_letter_to_index(config.MPSTATS_AVG_PRICE_COLUMN)
+    col_sales = col_letter_to_index(config.MPSTATS_SALES_COLUMN)
+
+    parsed = 0
+    errors = 0
+
+    pbar = tqdm(total=len(tasks), desc="Парсинг MPStats", unit="фильтров", colour="yellow")
+
+    for row_num, link_value, filter_name in tasks:
+        raise_if_stopped()
+        display = filter_name or link_value or ""
+        pbar.set_postfix_str(f"Фильтр: {display[:20]}...")
+
+        try:
+            if link_value and link_value.startswith(("http://", "https://")):
+                logger.info(f"Переход по ссылке: {link_value}")
+                with metrics.timer("stage_seconds", parser="mpstats", stage="page_load"):
+                    driver.get(link_value)
+                    time.sleep(5)
+                    loaded = wait_for_table(driver)
+                if not loaded:
+                    raise Exception("Таблица не загрузилась после перехода по ссылке")
+            else:
+                logger.warning(f"Пропускаем строку {row_num}: нет ссылки для перехода")
+                errors += 1
+                all_updates.append((row_num, col_price, "Нет ссылки"))
+                all_updates.append((row_num, col_sales, "Нет ссылки"))
+                if checkpoint:
+                    checkpoint.record((row_num, link_value, filter_name), all_updates[-2:])
+                pbar.update(1)
+                continue
+
+            if filter_name:
+                with metrics.timer("stage_seconds", parser="mpstats", stage="filter"):
+                    clear_all_filters(driver)
+                    fill_name_filter(driver, filter_name)
+                    time.sleep(3)
+
+            with metrics.timer("stage_seconds", parser="mpstats", stage="csv_download"):
+                click_download_csv(driver)
+                file_path = wait_new_file(timeout=30)
+
+            if not file_path:
+                errors += 1
+                all_updates.append((row_num, col_price, "Ошибка скачивания"))
+                all_updates.append((row_num, col_sales, "Ошибка скачивания"))
+                pbar.update(1)
+                continue
+
+            with metrics.timer("stage_seconds", parser="mpstats", stage="parse"):
+                items = parse_csv(file_path)
+                avg_price, sales_str = calculate(items)
+            if items:
+                cache.set(make_cache_key(link_value, filter_name), {"avg_price": avg_price, "sales": sales_str})
+
+            parsed += 1
+            all_updates.append((row_num, col_price, avg_price))
+            all_updates.append((row_num, col_sales, sales_str))
+            if checkpoint:
+                checkpoint.record((row_num, link_value, filter_name), all_updates[-2:])
+
+        except Exception as e:
+            logger.error(f"Ошибка обработки строки {row_num}: {e}")
+            errors += 1
+            all_updates.append((row_num, col_price, "Ошибка"))
+            all_updates.append((row_num, col_sales, "Ошибка"))
+
+        pbar.update(1)
+
+    pbar.close()
+    metrics.inc("items_total", parsed, parser="mpstats", result="ok")
+    metrics.inc("items_total", errors, parser="mpstats", result="error")
+    return parsed, errors
+
+
+def run(sheet=None, plan: Optional[Plan] = None, browser_pool: Optional[BrowserPool] = None,
+        resume: bool = False) -> bool:
+    """
+    Полный цикл парсинга MPStats. Возвращает False, если запуск завершился ошибкой.
+    sheet и plan передаёт оркестратор, чтобы лист читался один раз на все парсеры,
+    browser_pool — чтобы переиспользовать тёплый браузер.
+    resume — пропустить задачи, уже выполненные прерванным запуском (по журналу).
+    """
     logger.info("=" * 70)
     logger.info("🚀 ЗАПУСК MPSTATS PARSER (STANDALONE)")
     logger.info("=" * 70)
 
     # Подключаемся к Google Sheets с повторными попытками
     max_retries = 3
-    sheet = None
     for attempt in range(1, max_retries + 1):
+        if sheet is not None:
+            break
         try:
             _, sheet = get_sheet_client()
             logger.info("Подключение к Google Sheets успешно")
-            break
         except Exception as e:
             logger.error(f"Ошибка подключения к Google Sheets (попытка {attempt}): {e}")
             if attempt == max_retries:
                 logger.critical("Не удалось подключиться к Google Sheets после нескольких попыток. Выход.")
-                sys.exit(1)
+                return False
             time.sleep(5)
 
-    driver, tunnel = setup_browser(headless=False)
-    all_updates = []
-
-    try:
-        if not check_and_login_mpstats(driver):
-            logger.error("Не удалось авторизоваться")
-            driver.quit()
-            tunnel.close()
-            sys.exit(1)
-
-        rows = get_all_filled_rows(sheet, config.MPSTATS_LINK_COLUMN)
-        if not rows:
-            logger.warning("Нет данных для обработки")
-            driver.quit()
-            tunnel.close()
-            sys.exit(0)
-
-        total = len(rows)
-        parsed = 0
-        errors = 0
-        logger.info(f"Найдено фильтров: {total}")
-
-        col_price = col_letter_to_index(config.MPSTATS_AVG_PRICE_COLUMN)
-        col_sales = col_letter_to_index(config.MPSTATS_SALES_COLUMN)
-
-        pbar = tqdm(total=total, desc="Парсинг MPStats", unit="фильтров", colour="yellow")
+    if plan is None:
+        plan = load_plan(sheet)
+    all_values = plan.snapshot
+    rows = plan.mpstat_tasks
+    if not rows:
+        logger.warning("Нет данных для обработки")
+        return True
 
-        for row_num, link_value in rows:
-            filter_name = get_name_filter(sheet, row_num)
-            display = filter_name or link_value or ""
-            pbar.set_postfix_str(f"Фильтр: {display[:20]}...")
+    total = len(rows)
 
-            try:
-                if link_value and link_value.startswith(("http://", "https://")):
-                    logger.info(f"Переход по ссылке: {link_value}")
-                    driver.get(link_value)
-                    time.sleep(5)
-                    if not wait_for_table(driver):
-                        raise Exception("Таблица не загрузилась после перехода по ссылке")
-                else:
-                    logger.warning(f"Пропускаем строку {row_num}: нет ссылки для перехода")
-                    errors += 1
-                    all_updates.append((row_num, col_price, "Нет ссылки"))
-                    all_updates.append((row_num, col_sales, "Нет ссылки"))
-                    pbar.update(1)
-                    continue
-
-                if filter_name:
-                    clear_all_filters(driver)
-                    fill_name_filter(driver, filter_name)
-                    time.sleep(3)
-
-                click_download_csv(driver)
-                file_path = wait_new_file(timeout=30)
-
-                if not file_path:
-                    errors += 1
-                    all_updates.append((row_num, col_price, "Ошибка скачивания"))
-                    all_updates.append((row_num, col_sales, "Ошибка скачивания"))
-                    pbar.update(1)
-                    continue
+    # Строки со свежим результатом в кэше не требуют браузера
+    cache = open_cache()
+    checkpoint = Checkpoint("mpstats", resume=resume)
+    all_updates = []
+    pending = apply_cached(checkpoint.restore(rows, all_updates), cache, all_updates)
 
-                items = parse_csv(file_path)
-                avg_price, sales_str = calculate(items)
+    logger.info(f"Найдено фильтров: {total}, к обработке: {len(pending)}")
 
-                parsed += 1
-                all_updates.append((row_num, col_price, avg_price))
-                all_updates.append((row_num, col_sales, sales_str))
+    if not pending:
+        logger.info(f"Запись {len(all_updates)} обновлений...")
+        try:
+            safe_batch_update(sheet, all_updates, snapshot=all_values)
+        finally:
+            checkpoint.close()
+        checkpoint.clear()
+        logger.info(f"Готово! Обработано: {total}, Ошибок: 0")
+        return True
 
-            except Exception as e:
-                logger.error(f"Ошибка обработки строки {row_num}: {e}")
-                errors += 1
-                all_updates.append((row_num, col_price, "Ошибка"))
-                all_updates.append((row_num, col_sales, "Ошибка"))
+    lease = lease_driver(browser_pool, "mpstats", setup_browser)
+    driver = lease.driver
 
-            pbar.update(1)
+    try:
+        if not check_and_login_mpstats(driver):
+            logger.error("Не удалось авторизоваться")
+            if all_updates:
+                safe_batch_update(sheet, all_updates, snapshot=all_values)
+            return False
 
-        pbar.close()
+        parsed, errors = process_tasks(driver, pending, cache, all_updates, checkpoint)
+        parsed += total - len(pending)
 
         if all_updates:
             logger.info(f"Запись {len(all_updates)} обновлений...")
-            safe_batch_update(sheet, all_updates)
+            safe_batch_update(sheet, all_updates, snapshot=all_values)
+        checkpoint.clear()
 
         logger.info(f"Готово! Обработано: {parsed}, Ошибок: {errors}")
+        return True
 
     except KeyboardInterrupt:
         logger.warning("\nПрервано пользователем")
         if all_updates:
-            safe_batch_update(sheet, all_updates)
+            safe_batch_update(sheet, all_updates, snapshot=all_values)
+        return False
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}", exc_info=True)
         if all_updates:
-            safe_batch_update(sheet, all_updates)
+            safe_batch_update(sheet, all_updates, snapshot=all_values)
+        return False
     finally:
-        driver.quit()
-        tunnel.close()
+        cache.save()
+        checkpoint.close()
+        lease.release()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Парсер MPStats")
+    parser.add_argument("--resume", action="store_true", help="продолжить прерванный запуск по журналу")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    with profiling.profile_run("mpstats", args.profile, args.profile_out):
+        ok = run(resume=args.resume)
+    metrics.write_report("mpstats", {"ok": ok})
+    sys.exit(0 if ok else 1)
 
 
 if __name__ == "__main__":
@@ -1,22 +1,35 @@
+import argparse
+import sys
 import time
 import random
 import re
 import json
-from typing import Optional, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 import requests
 from tqdm import tqdm
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 
+# WebDriverWait и expected_conditions импортируются внутри функций: selenium.webdriver.support
+# подтягивает весь remote webdriver, а запуску без браузера (кэш, --resume) он не нужен
 from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 
 import config
+import metrics
+import profiling
 from config import setup_logging
-from uc_wire_tunnel import UCWithTunnel
-from proxy_manager import ProxyManager
+from uc_wire_tunnel import BLOCK_DEFAULT, UCWithTunnel
+from proxy_manager import ProxySessionPool, attach_proxy, get_proxy_manager, proxy_key, proxy_of
+from planner import Plan, load_plan
+from browser_pool import BrowserPool, lease_driver
+from checkpoint import Checkpoint, raise_if_stopped
+from rate_limit import TokenBucket, throttled_get
 from gsheets import safe_batch_update, col_letter_to_index, get_sheet_client
 
+# Общий пул сессий: соединения с API переиспользуются между запросами и запусками (в режиме демона);
+# с USE_PROXY у каждого прокси своя сессия с куками, полученными через него
+http_session = ProxySessionPool("ozon", pool_size=max(10, config.OZON_CONCURRENCY))
+
 logger = setup_logging("ozon_parser")
 
 
@@ -33,38 +46,35 @@ def build_ozon_url(value: str) -> str:
     return f"https://www.ozon.ru/product/{value}/"
 
 
-def detect_link_type(url: str) -> str:
-    v = url.strip()
-    if v.isdigit():
-        return 'ozon'
-    if not v.lower().startswith('http'):
-        return 'skip'
-    if 'ozon.ru' in v.lower() or 'ozon.by' in v.lower():
-        return 'ozon'
-    if 'wildberries' in v.lower() or 'wb.ru' in v.lower():
-        return 'wb'
-    return 'skip'
-
-
 def init_driver(headless=None):
     if headless is None:
         headless = config.HEADLESS_MODE
     logger.info("Инициализация драйвера для Ozon...")
     proxy_config = None
+    proxy = None
     if config.USE_PROXY:
-        pm = ProxyManager(str(config.PROXY_FILE))
-        if pm.has_proxies():
-            proxy = pm.get_first()
-            if proxy:
-                proxy_config = pm.format_for_selenium_wire(proxy)
-    tunnel = UCWithTunnel(proxy_config=proxy_config)
-    driver = tunnel.create_driver(headless=headless, user_data_dir=str(config.CHROME_PROFILE_OZON))
+        pm = get_proxy_manager()
+        proxy = pm.acquire()
+        if proxy:
+            proxy_config = pm.format_for_selenium_wire(proxy)
+            logger.info(f"Использование прокси: {proxy_key(proxy)}")
+    tunnel = UCWithTunnel(proxy_config=proxy_config, intercept=config.BROWSER_INTERCEPT,
+                          capture=config.BROWSER_CAPTURE)
+    driver = tunnel.create_driver(headless=headless, user_data_dir=str(config.CHROME_PROFILE_OZON),
+                                  block_resources=BLOCK_DEFAULT if config.BLOCK_RESOURCES else None,
+                                  profile_template=config.CHROME_PROFILE_TEMPLATE,
+                                  slim_profile=config.CHROME_SLIM_PROFILE)
+    attach_proxy(driver, proxy)
     driver.set_page_load_timeout(config.PAGE_LOAD_TIMEOUT)
     driver.implicitly_wait(config.IMPLICIT_WAIT)
     return driver, tunnel
 
 
+@metrics.timed("stage_seconds", parser="ozon", stage="cookies")
 def get_cookies_from_ozon(driver) -> Optional[dict]:
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+
     try:
         logger.info("Загружаем ozon.ru для получения кук...")
         driver.get("https://www.ozon.ru/")
@@ -72,6 +82,7 @@ def get_cookies_from_ozon(driver) -> Optional[dict]:
         random_pause(1, 2)
         cookies = {c['name']: c['value'] for c in driver.get_cookies()}
         logger.info(f"Получено кук: {len(cookies)}")
+        http_session.bind_cookies(proxy_of(driver), cookies)
         return cookies
     except Exception as e:
         logger.error(f"Не удалось получить куки: {e}")
@@ -82,19 +93,27 @@ def get_cookies_from_ozon(driver) -> Optional[dict]:
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=2, max=10),
     retry=retry_if_exception_type((requests.RequestException, json.JSONDecodeError)),
+    before_sleep=metrics.count_retry("ozon"),
     reraise=True
 )
-def fetch_ozon_price(article: str, cookies: dict) -> Optional[str]:
-    url = f"https://www.ozon.ru/api/composer-api.bx/page/json/v2?url=/product/{article}"
+def fetch_ozon_price(article: str, cookies: dict, limiter: Optional[TokenBucket] = None) -> Optional[str]:
+    url = f"{config.OZON_API_BASE_URL}/api/composer-api.bx/page/json/v2?url=/product/{article}"
     headers = {
         'User-Agent': random.choice(config.USER_AGENTS),
         'Accept': 'application/json',
         'X-Requested-With': 'XMLHttpRequest',
     }
-    resp = requests.get(url, headers=headers, cookies=cookies, timeout=15)
-    resp.raise_for_status()
-    data = resp.json()
+    with metrics.timer("stage_seconds", parser="ozon", stage="fetch"):
+        resp = throttled_get(http_session, url, limiter, "ozon", headers=headers, cookies=cookies,
+                             timeout=15)
+        resp.raise_for_status()
+        data = resp.json()
+    with metrics.timer("stage_seconds", parser="ozon", stage="parse"):
+        return extract_ozon_price(data)
 
+
+def extract_ozon_price(data: dict) -> Optional[str]:
+    """Находит цену в widgetStates ответа composer-api (без сетевых запросов)"""
     widget_states = data.get('widgetStates', {})
     for key, value in widget_states.items():
         if key.startswith('webPrice'):
@@ -111,72 +130,46 @@ def fetch_ozon_price(article: str, cookies: dict) -> Optional[str]:
     return None
 
 
-def parse_ozon_price(article: str, cookies: dict) -> Optional[str]:
+def parse_ozon_price(article: str, cookies: dict, limiter: Optional[TokenBucket] = None) -> Optional[str]:
     try:
-        return fetch_ozon_price(article, cookies)
+        return fetch_ozon_price(article, cookies, limiter)
     except Exception as e:
         logger.warning(f"Ошибка получения цены для {article}: {e}")
         return None
 
 
-def main():
-    logger.info("=" * 70)
-    logger.info("🚀 ЗАПУСК OZON PARSER (STANDALONE)")
-    logger.info("=" * 70)
+def process_tasks(tasks, cookies: dict, all_updates: list, checkpoint: Optional[Checkpoint] = None,
+                  concurrency: Optional[int] = None, rate_limit: Optional[float] = None):
+    """
+    Получает цены для задач (row, значение ячейки) и дописывает их в all_updates.
+    Каждая завершённая задача фиксируется в checkpoint. Возвращает (parsed, errors).
+    concurrency и rate_limit (запросов в секунду) по умолчанию берутся из OZON_CONCURRENCY / OZON_RATE_LIMIT.
+    """
+    col_price = col_letter_to_index(config.OZON_PRICE_COLUMN)   # V
 
-    _, sheet = get_sheet_client()
-    driver, tunnel = init_driver()
-    all_updates = []
+    parsed = 0
+    errors = 0
+
+    concurrency = concurrency or config.OZON_CONCURRENCY
+    rate_limit = config.OZON_RATE_LIMIT if rate_limit is None else rate_limit
+    limiter = TokenBucket(rate_limit, period=1.0, target="ozon") if rate_limit > 0 else None
+
+    def fetch(task):
+        _, raw = task
+        article = re.sub(r'.*/product/(\d+).*', r'\1', raw)
+        if not article.isdigit():
+            article = raw
+        return parse_ozon_price(article, cookies, limiter)
+
+    # Запросы — в пуле, запись результатов и журнала — здесь, в порядке задач
+    pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="ozon-fetch") if concurrency > 1 else None
+    results = pool.map(fetch, tasks) if pool else map(fetch, tasks)
+    pbar = tqdm(total=len(tasks), desc="Парсинг Ozon", unit="товаров", colour="blue")
 
     try:
-        cookies = get_cookies_from_ozon(driver)
-        if not cookies:
-            logger.error("Не удалось получить куки, выходим")
-            driver.quit()
-            tunnel.close()
-            return
-
-        all_values = sheet.get_all_values()
-        if len(all_values) < 2:
-            logger.warning("Нет данных")
-            driver.quit()
-            tunnel.close()
-            return
-
-        col_wb = col_letter_to_index(config.WB_SKU_COLUMN)          # K
-        col_price = col_letter_to_index(config.OZON_PRICE_COLUMN)   # V
-
-        ozon_tasks = []
-
-        for row_idx in range(2, len(all_values) + 1):
-            row = all_values[row_idx - 1]
-
-            if len(row) >= col_wb:
-                val = row[col_wb - 1].strip()
-                if val and detect_link_type(val) == 'ozon':
-                    ozon_tasks.append((row_idx, val))
-
-        if not ozon_tasks:
-            logger.warning("Нет Ozon ссылок для обработки")
-            driver.quit()
-            tunnel.close()
-            return
-
-        total = len(ozon_tasks)
-        parsed = 0
-        errors = 0
-
-        logger.info(f"Найдено Ozon ссылок: {total}")
-
-        pbar = tqdm(total=total, desc="Парсинг Ozon", unit="товаров", colour="blue")
-
-        for row_idx, raw in ozon_tasks:
-            article = re.sub(r'.*/product/(\d+).*', r'\1', raw)
-            if not article.isdigit():
-                article = raw
+        for (row_idx, raw), price in zip(tasks, results):
+            raise_if_stopped()
             pbar.set_postfix_str(f"{raw[:20]}...")
-
-            price = parse_ozon_price(article, cookies)
             if price:
                 parsed += 1
             else:
@@ -184,27 +177,97 @@ def main():
                 price = ""
 
             all_updates.append((row_idx, col_price, price))
+            if checkpoint and price:
+                checkpoint.record((row_idx, raw), [(row_idx, col_price, price)])
             pbar.update(1)
-
+    finally:
         pbar.close()
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    metrics.inc("items_total", parsed, parser="ozon", result="ok")
+    metrics.inc("items_total", errors, parser="ozon", result="error")
+    return parsed, errors
+
+
+def run(sheet=None, plan: Optional[Plan] = None, browser_pool: Optional[BrowserPool] = None,
+        resume: bool = False) -> bool:
+    """
+    Полный цикл парсинга Ozon. Возвращает False, если запуск завершился ошибкой.
+    sheet и plan передаёт оркестратор, чтобы лист читался один раз на все парсеры,
+    browser_pool — чтобы переиспользовать тёплый браузер.
+    resume — пропустить задачи, уже выполненные прерванным запуском (по журналу).
+    """
+    logger.info("=" * 70)
+    logger.info("🚀 ЗАПУСК OZON PARSER (STANDALONE)")
+    logger.info("=" * 70)
+
+    if sheet is None:
+        _, sheet = get_sheet_client()
+    if plan is None:
+        plan = load_plan(sheet)
+
+    all_values = plan.snapshot
+    if len(all_values) < 2:
+        logger.warning("Нет данных")
+        return True
+
+    ozon_tasks = plan.ozon_tasks
+    if not ozon_tasks:
+        logger.warning("Нет Ozon ссылок для обработки")
+        return True
+
+    checkpoint = Checkpoint("ozon", resume=resume)
+    all_updates = []
+    pending = checkpoint.restore(ozon_tasks, all_updates)
+    lease = lease_driver(browser_pool, "ozon", init_driver) if pending else None
+
+    try:
+        parsed, errors = 0, 0
+        if pending:
+            cookies = get_cookies_from_ozon(lease.driver)
+            # Браузер нужен только для получения кук — сразу возвращаем его в пул
+            lease.release(broken=not cookies)
+            if not cookies:
+                logger.error("Не удалось получить куки, выходим")
+                return False
+
+            logger.info(f"Найдено Ozon ссылок: {len(ozon_tasks)}, к обработке: {len(pending)}")
+            parsed, errors = process_tasks(pending, cookies, all_updates, checkpoint)
 
         if all_updates:
             logger.info(f"Запись {len(all_updates)} обновлений...")
-            safe_batch_update(sheet, all_updates)
+            safe_batch_update(sheet, all_updates, snapshot=all_values)
 
+        checkpoint.clear()
         logger.info(f"Готово! Обработано: {parsed}, Ошибок: {errors}")
+        return True
 
     except KeyboardInterrupt:
         logger.warning("\nПрервано пользователем")
         if all_updates:
-            safe_batch_update(sheet, all_updates)
+            safe_batch_update(sheet, all_updates, snapshot=all_values)
+        return False
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}", exc_info=True)
         if all_updates:
-            safe_batch_update(sheet, all_updates)
+            safe_batch_update(sheet, all_updates, snapshot=all_values)
+        return False
     finally:
-        driver.quit()
-        tunnel.close()
+        checkpoint.close()
+        if lease:
+            lease.release()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Парсер Ozon")
+    parser.add_argument("--resume", action="store_true", help="продолжить прерванный запуск по журналу")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    with profiling.profile_run("ozon", args.profile, args.profile_out):
+        ok = run(resume=args.resume)
+    metrics.write_report("ozon", {"ok": ok})
+    sys.exit(0 if ok else 1)
 
 
 if __name__ == "__main__":
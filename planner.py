@@ -0,0 +1,90 @@
+"""
+Планирование запуска: одно чтение листа и одна классификация строк для всех парсеров
+"""
+import logging
+from typing import List, Tuple, Optional
+
+import config
+import metrics
+from gsheets import col_letter_to_index
+
+logger = logging.getLogger("planner")
+
+
+def detect_link_type(value: str) -> str:
+    """
+    Классифицирует значение входной колонки: 'wb', 'ozon', 'sku' (голый артикул —
+    обрабатывается и WB, и Ozon) или 'skip'.
+    """
+    v = value.strip()
+    if v.isdigit():
+        return 'sku'
+    if not v.lower().startswith('http'):
+        return 'skip'
+    if 'wildberries' in v.lower() or 'wb.ru' in v.lower():
+        return 'wb'
+    if 'ozon.ru' in v.lower() or 'ozon.by' in v.lower():
+        return 'ozon'
+    return 'skip'
+
+
+class Plan:
+    """Снимок листа и списки задач для каждого парсера"""
+
+    def __init__(self, snapshot: List[List[str]]):
+        self.snapshot = snapshot
+        self.wb_tasks: List[Tuple[int, str]] = []
+        self.ozon_tasks: List[Tuple[int, str]] = []
+        self.mpstat_tasks: List[Tuple[int, str, Optional[str]]] = []
+
+    def summary(self) -> str:
+        return (f"строк: {max(len(self.snapshot) - 1, 0)}, WB: {len(self.wb_tasks)}, "
+                f"Ozon: {len(self.ozon_tasks)}, MPStats: {len(self.mpstat_tasks)}")
+
+
+def _cell(row: List[str], col: int) -> str:
+    return row[col - 1].strip() if len(row) >= col else ""
+
+
+def build_plan(snapshot: List[List[str]]) -> Plan:
+    plan = Plan(snapshot)
+
+    # WB_SKU_COLUMN и OZON_INPUT_COLUMN по умолчанию совпадают — сканируем каждую колонку один раз
+    input_cols = list(dict.fromkeys([
+        col_letter_to_index(config.WB_SKU_COLUMN),
+        col_letter_to_index(config.OZON_INPUT_COLUMN),
+    ]))
+    col_mp_link = col_letter_to_index(config.MPSTATS_LINK_COLUMN)
+    col_mp_filter = col_letter_to_index(config.MPSTATS_FILTER_NAME_COLUMN)
+
+    for row_idx in range(2, len(snapshot) + 1):
+        row = snapshot[row_idx - 1]
+
+        for col in input_cols:
+            val = _cell(row, col)
+            if not val:
+                continue
+            kind = detect_link_type(val)
+            if kind in ('wb', 'sku'):
+                plan.wb_tasks.append((row_idx, val))
+            if kind in ('ozon', 'sku'):
+                plan.ozon_tasks.append((row_idx, val))
+
+        link = _cell(row, col_mp_link)
+        if link:
+            plan.mpstat_tasks.append((row_idx, link, _cell(row, col_mp_filter) or None))
+
+    plan.wb_tasks = list(dict.fromkeys(plan.wb_tasks))
+    plan.ozon_tasks = list(dict.fromkeys(plan.ozon_tasks))
+    return plan
+
+
+def load_plan(sheet) -> Plan:
+    """Читает лист (get_all_values) и строит план"""
+    with metrics.timer("stage_seconds", stage="sheets_read"):
+        values = sheet.get_all_values()
+    with metrics.timer("stage_seconds", stage="plan"):
+        plan = build_plan(values)
+    metrics.inc("sheets_rows_read_total", len(values))
+    logger.info(f"План запуска — {plan.summary()}")
+    return plan
@@ -0,0 +1,120 @@
+"""
+Профилирование запусков парсеров (--profile / --profile-out).
+
+По умолчанию используется сэмплирующий профилировщик pyinstrument, если он установлен
+(почти не замедляет Selenium-ожидания и сетевые вызовы), иначе — cProfile.
+Профиль снимается с потока, в котором выполняется парсер, поэтому в режиме thread
+каждый парсер получает собственный дамп. Потоки, которые парсер запускает сам
+(параллельная запись в Sheets), в профиль не попадают. На Python 3.12+ cProfile может
+работать только в одном потоке процесса: остальные парсеры тогда профилируются
+pyinstrument (если установлен) или не профилируются.
+
+Дампы: <out>/<парсер>-<время>.prof (cProfile, открывается snakeviz / pstats)
+или .html + .pyisession (pyinstrument). Топ горячих функций пишется в лог.
+"""
+import cProfile
+import importlib.util
+import io
+import pstats
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import config
+from config import setup_logging
+
+logger = setup_logging("profiling")
+
+PROFILERS = ("auto", "cprofile", "pyinstrument")
+
+
+def _pick_profiler(name: str) -> str:
+    if name == "auto":
+        return "pyinstrument" if importlib.util.find_spec("pyinstrument") else "cprofile"
+    if name == "pyinstrument" and not importlib.util.find_spec("pyinstrument"):
+        logger.warning("pyinstrument не установлен, используется cProfile")
+        return "cprofile"
+    return name
+
+
+def _cprofile_summary(profiler: cProfile.Profile, top: int) -> str:
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.strip_dirs().sort_stats("cumulative").print_stats(top)
+    stream.write("\n--- по собственному времени ---\n")
+    stats.sort_stats("tottime").print_stats(top)
+    return stream.getvalue()
+
+
+def _pyinstrument_hot_functions(root, top: int) -> List[Tuple[float, str]]:
+    """Суммирует собственное время кадров по функциям дерева вызовов pyinstrument"""
+    totals: Dict[str, float] = {}
+    stack = [root] if root is not None else []
+    while stack:
+        frame = stack.pop()
+        if not frame.is_synthetic:
+            key = f"{frame.function} ({frame.file_path_short}:{frame.line_no})"
+            totals[key] = totals.get(key, 0.0) + frame.total_self_time
+        stack.extend(frame.children)
+    return sorted(((t, k) for k, t in totals.items()), reverse=True)[:top]
+
+
+@contextmanager
+def profile_run(name: str, enabled: bool = True, out_dir=None, top: Optional[int] = None,
+                profiler: Optional[str] = None):
+    """Профилирует блок кода и сохраняет дамп; при enabled=False ничего не делает"""
+    if not enabled:
+        yield
+        return
+
+    out = Path(out_dir or config.PROFILE_DIR)
+    out.mkdir(parents=True, exist_ok=True)
+    top = top or config.PROFILE_TOP_N
+    kind = _pick_profiler(profiler or config.PROFILER)
+    base = out / f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+
+    if kind == "cprofile":
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # Python 3.12+: в процессе уже работает другой cProfile (соседний парсер в режиме thread)
+            if not importlib.util.find_spec("pyinstrument"):
+                logger.warning(f"Профилирование {name} пропущено: cProfile уже занят другим потоком")
+                yield
+                return
+            logger.warning(f"cProfile уже занят другим потоком, {name} профилируется pyinstrument")
+            kind = "pyinstrument"
+
+    logger.info(f"Профилирование {name}: {kind}")
+    if kind == "pyinstrument":
+        from pyinstrument import Profiler
+
+        prof = Profiler(interval=config.PROFILE_INTERVAL)
+        prof.start()
+        try:
+            yield
+        finally:
+            session = prof.stop()
+            session.save(str(base.with_suffix(".pyisession")))
+            base.with_suffix(".html").write_text(prof.output_html(), encoding="utf-8")
+            hot = _pyinstrument_hot_functions(session.root_frame(), top)
+            lines = [f"{seconds:9.3f} с  {function}" for seconds, function in hot]
+            logger.info(f"Профиль {name} ({session.duration:.1f} с): {base.with_suffix('.html')}\n"
+                        f"Топ-{top} по собственному времени:\n" + "\n".join(lines))
+        return
+
+    try:
+        yield
+    finally:
+        prof.disable()
+        prof.dump_stats(str(base.with_suffix(".prof")))
+        logger.info(f"Профиль {name}: {base.with_suffix('.prof')}\n{_cprofile_summary(prof, top)}")
+
+
+def add_arguments(parser):
+    """Добавляет --profile / --profile-out в argparse-парсер точки входа"""
+    parser.add_argument("--profile", action="store_true", help="профилировать запуск")
+    parser.add_argument("--profile-out", default=None,
+                        help=f"папка для дампов профиля (по умолчанию {config.PROFILE_DIR.name}/)")
@@ -1,16 +1,93 @@
 """
 Менеджер для управления прокси серверами
+
+Для каждого прокси ведётся статистика: доля успешных запросов, задержка (EWMA)
+и признаки бана (403/429/капча). acquire() выбирает прокси случайно с весом по
+этой оценке, так что нагрузка распределяется по всем прокси, а плохие получают
+меньше запросов. После серии ошибок или бана срабатывает circuit breaker: прокси
+исключается на время охлаждения (растёт с каждым повторным срабатыванием), затем
+получает пробный запрос. Фоновые проверки (PROXY_PROBE_INTERVAL) обновляют оценку
+и возвращают прокси в строй, не дожидаясь рабочих запросов.
 """
+import logging
 import random
-from typing import Optional, Dict
+import threading
+import time
+from typing import Optional, Dict, Set
 from urllib.parse import urlparse
 
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+import metrics
+
+logger = logging.getLogger("proxy_manager")
+
+BAN_STATUSES = {403, 429}
+_CAPTCHA_MARKERS = ("captcha", "showcaptcha", "antibot", "challenge")
+# Сглаживание средней задержки: вес последнего замера
+_EWMA_ALPHA = 0.3
+
+
+def proxy_key(proxy: Dict) -> str:
+    return f"{proxy['host']}:{proxy['port']}"
+
+
+def is_ban_response(response) -> bool:
+    """403/429 или HTML-страница капчи вместо ответа API"""
+    if response.status_code in BAN_STATUSES:
+        return True
+    content_type = response.headers.get("Content-Type", "")
+    if "html" not in content_type:
+        return False
+    head = response.text[:2048].lower()
+    return any(marker in head for marker in _CAPTCHA_MARKERS)
+
+
+class ProxyStats:
+    """Состояние одного прокси: счётчики, задержка и circuit breaker"""
+
+    def __init__(self):
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.bans = 0
+        self.latency: Optional[float] = None
+        self.consecutive_failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+
+    def is_open(self, now: float) -> bool:
+        return now < self.open_until
+
+    def score(self) -> float:
+        # Сглаживание Лапласа: новый прокси получает оценку 0.5, а не 0 или 1;
+        # 1 сек средней задержки вдвое снижает вероятность выбора
+        success_rate = (self.successes + 1) / (self.requests + 2)
+        return success_rate / (1.0 + (self.latency or 0.0))
+
+    def to_dict(self, now: float) -> Dict:
+        return {
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "bans": self.bans,
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+            "score": round(self.score(), 3),
+            "open_for": round(max(0.0, self.open_until - now), 1),
+        }
+
 
 class ProxyManager:
     def __init__(self, proxy_file: str = "proxies.txt"):
         self.proxy_file = proxy_file
         self.proxies = []
         self._load_proxies()
+        self._stats: Dict[str, ProxyStats] = {proxy_key(p): ProxyStats() for p in self.proxies}
+        self._lock = threading.Lock()
+        self._probe_thread: Optional[threading.Thread] = None
+        self._probe_stop = threading.Event()
 
     def _load_proxies(self):
         try:
@@ -81,16 +158,248 @@ class ProxyManager:
     def get_random(self) -> Optional[Dict]:
         return random.choice(self.proxies) if self.proxies else None
 
+    def acquire(self, keys: Optional[Set[str]] = None) -> Optional[Dict]:
+        """
+        Взвешенный выбор по оценке среди прокси с закрытым circuit breaker
+        (только из keys, если задано и такие прокси есть).
+        Если исключены все — прокси, чьё охлаждение закончится раньше.
+        """
+        candidates = [p for p in self.proxies if proxy_key(p) in keys] if keys else []
+        candidates = candidates or self.proxies
+        if not candidates:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            available = [p for p in candidates if not self._stats[proxy_key(p)].is_open(now)]
+            if not available:
+                proxy = min(candidates, key=lambda p: self._stats[proxy_key(p)].open_until)
+                logger.warning(f"Все прокси на охлаждении, используется {proxy_key(proxy)}")
+                return proxy
+            weights = [self._stats[proxy_key(p)].score() for p in available]
+        return random.choices(available, weights=weights)[0]
+
+    def report_success(self, proxy: Optional[Dict], latency: Optional[float] = None):
+        if not proxy:
+            return
+        key = proxy_key(proxy)
+        with self._lock:
+            stats = self._stats[key]
+            stats.requests += 1
+            stats.successes += 1
+            stats.consecutive_failures = 0
+            if latency is not None:
+                stats.latency = latency if stats.latency is None else \
+                    _EWMA_ALPHA * latency + (1 - _EWMA_ALPHA) * stats.latency
+            if stats.trips:
+                logger.info(f"Прокси {key} снова в работе")
+            stats.trips = 0
+            stats.open_until = 0.0
+        metrics.inc("proxy_requests_total", proxy=key, result="ok")
+
+    def report_failure(self, proxy: Optional[Dict], ban: bool = False, reason: str = ""):
+        """Ошибка соединения/5xx или бан; бан сразу выводит прокси из ротации"""
+        if not proxy:
+            return
+        key = proxy_key(proxy)
+        with self._lock:
+            stats = self._stats[key]
+            stats.requests += 1
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            if ban:
+                stats.bans += 1
+            now = time.monotonic()
+            # Ответы запросов, начатых до срабатывания, не продлевают охлаждение;
+            # после охлаждения (half-open) до первого успеха хватает одной ошибки
+            tripped = not stats.is_open(now) and (
+                ban or stats.trips > 0 or stats.consecutive_failures >= config.PROXY_FAILURE_THRESHOLD)
+            if tripped:
+                stats.trips += 1
+                cooldown = min(config.PROXY_COOLDOWN_SECONDS * 2 ** (stats.trips - 1),
+                               config.PROXY_MAX_COOLDOWN_SECONDS)
+                stats.open_until = now + cooldown
+                stats.consecutive_failures = 0
+        metrics.inc("proxy_requests_total", proxy=key, result="ban" if ban else "error")
+        if tripped:
+            metrics.inc("proxy_circuit_open_total", proxy=key)
+            logger.warning(f"Прокси {key} исключён на {cooldown:.0f} сек "
+                           f"({'бан' if ban else 'серия ошибок'}{': ' + reason if reason else ''})")
+
+    def report_response(self, proxy: Optional[Dict], response, latency: Optional[float] = None):
+        """Классифицирует ответ requests: бан, ошибка сервера или успех"""
+        if is_ban_response(response):
+            self.report_failure(proxy, ban=True, reason=f"HTTP {response.status_code}")
+        elif response.status_code >= 500:
+            self.report_failure(proxy, reason=f"HTTP {response.status_code}")
+        else:
+            self.report_success(proxy, latency)
+
+    def stats(self) -> Dict[str, Dict]:
+        now = time.monotonic()
+        with self._lock:
+            return {key: s.to_dict(now) for key, s in self._stats.items()}
+
+    def probe(self, proxy: Dict) -> bool:
+        """Проверочный запрос через прокси; результат учитывается в оценке"""
+        start = time.monotonic()
+        try:
+            resp = requests.get(config.PROXY_PROBE_URL, proxies=self.format_for_requests(proxy),
+                                timeout=config.PROXY_PROBE_TIMEOUT)
+        except requests.RequestException as e:
+            self.report_failure(proxy, reason=type(e).__name__)
+            return False
+        self.report_response(proxy, resp, time.monotonic() - start)
+        return resp.ok
+
+    def _probe_loop(self, interval: float):
+        while not self._probe_stop.wait(interval):
+            now = time.monotonic()
+            with self._lock:
+                # Исключённые проверяются только после охлаждения: удачная проверка возвращает их в ротацию
+                targets = [p for p in self.proxies if not self._stats[proxy_key(p)].is_open(now)]
+            for proxy in targets:
+                if self._probe_stop.is_set():
+                    return
+                self.probe(proxy)
+
+    def start_probes(self, interval: Optional[float] = None):
+        interval = config.PROXY_PROBE_INTERVAL if interval is None else interval
+        if interval <= 0 or not self.proxies or self._probe_thread:
+            return
+        self._probe_stop.clear()
+        self._probe_thread = threading.Thread(target=self._probe_loop, args=(interval,),
+                                              name="proxy-probes", daemon=True)
+        self._probe_thread.start()
+        logger.info(f"Фоновая проверка прокси: раз в {interval:.0f} сек")
+
+    def stop_probes(self):
+        self._probe_stop.set()
+        if self._probe_thread:
+            self._probe_thread.join(timeout=config.PROXY_PROBE_TIMEOUT + 1)
+            self._probe_thread = None
+
+    @staticmethod
+    def proxy_url(proxy: Dict) -> str:
+        if proxy['username'] and proxy['password']:
+            return f"{proxy['protocol']}://{proxy['username']}:{proxy['password']}@{proxy['host']}:{proxy['port']}"
+        return f"{proxy['protocol']}://{proxy['host']}:{proxy['port']}"
+
     def format_for_selenium_wire(self, proxy: Dict) -> Dict:
         """Форматирует прокси для selenium-wire"""
         if not proxy:
             return {}
-        if proxy['username'] and proxy['password']:
-            url = f"{proxy['protocol']}://{proxy['username']}:{proxy['password']}@{proxy['host']}:{proxy['port']}"
-        else:
-            url = f"{proxy['protocol']}://{proxy['host']}:{proxy['port']}"
+        url = self.proxy_url(proxy)
         return {
             'http': url,
             'https': url,
             'no_proxy': 'localhost,127.0.0.1'
         }
+
+    def format_for_requests(self, proxy: Dict) -> Dict:
+        """Форматирует прокси для параметра proxies= в requests"""
+        if not proxy:
+            return {}
+        url = self.proxy_url(proxy)
+        return {'http': url, 'https': url}
+
+
+def attach_proxy(driver, proxy: Optional[Dict]):
+    """Запоминает прокси, через который работает браузер (для привязки его кук)"""
+    driver._pool_proxy = proxy
+
+
+def proxy_of(driver) -> Optional[Dict]:
+    return getattr(driver, "_pool_proxy", None)
+
+
+_shared_manager: Optional[ProxyManager] = None
+_shared_manager_lock = threading.Lock()
+
+
+def get_proxy_manager() -> ProxyManager:
+    """
+    Общий для процесса менеджер: оценки прокси накапливаются между парсерами
+    и запусками демона. Фоновые проверки запускаются при PROXY_PROBE_INTERVAL > 0.
+    """
+    global _shared_manager
+    with _shared_manager_lock:
+        if _shared_manager is None:
+            _shared_manager = ProxyManager(str(config.PROXY_FILE))
+            _shared_manager.start_probes()
+        return _shared_manager
+
+
+
+class ProxySessionPool:
+    """
+    HTTP-запросы парсера через пул прокси: у каждого прокси своя requests.Session,
+    то есть свой пул соединений и свои куки. Куки, полученные браузером через прокси,
+    привязываются к нему (bind_cookies) и через другие прокси не отправляются;
+    через прокси без своих кук уходят куки, переданные в запрос явно.
+    Исход каждого запроса попадает в оценку прокси. Без USE_PROXY или без прокси
+    в файле запросы идут напрямую одной сессией, как раньше.
+    """
+
+    def __init__(self, name: str, pool_size: int = 10):
+        self.name = name
+        self.pool_size = pool_size
+        self._sessions: Dict[str, requests.Session] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _manager() -> Optional[ProxyManager]:
+        return get_proxy_manager() if config.USE_PROXY else None
+
+    def _session(self, proxy: Optional[Dict]) -> requests.Session:
+        key = proxy_key(proxy) if proxy else ""
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                if proxy:
+                    url = ProxyManager.proxy_url(proxy)
+                    session.proxies.update({'http': url, 'https': url})
+                    # Адрес прокси задан явно: переменные окружения HTTP(S)_PROXY не должны его подменять
+                    session.trust_env = False
+                self._sessions[key] = metrics.instrument_session(session)
+            return session
+
+    def bind_cookies(self, proxy: Optional[Dict], cookies: Optional[dict]):
+        # Без прокси куки передаются в каждый запрос явно; в общую прямую сессию их не кладём,
+        # иначе куки прошлых запусков демона уходили бы вместе со свежими
+        if not cookies or proxy is None:
+            return
+        self._session(proxy).cookies.update(cookies)
+        logger.info(f"{self.name}: куки привязаны к прокси {proxy_key(proxy)}")
+
+    def get(self, url: str, **kwargs):
+        """
+        GET через выбранный прокси (из всего пула). Если к прокси привязаны куки браузера,
+        куки запроса заменяются ими; иначе отправляются куки, переданные явно.
+        """
+        manager = self._manager()
+        proxy = manager.acquire() if manager else None
+        if proxy is None:
+            return self._session(None).get(url, **kwargs)
+
+        session = self._session(proxy)
+        if len(session.cookies):
+            kwargs.pop("cookies", None)
+        start = time.monotonic()
+        try:
+            resp = session.get(url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            manager.report_failure(proxy, reason=type(e).__name__)
+            raise
+        manager.report_response(proxy, resp, time.monotonic() - start)
+        return resp
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
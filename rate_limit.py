@@ -0,0 +1,71 @@
+"""
+Ограничение частоты запросов: token bucket, общий для всех потоков.
+
+Используется для квоты записи Google Sheets и для API маркетплейсов
+(WB_RATE_LIMIT / OZON_RATE_LIMIT). После ответа 429 выдача токенов
+приостанавливается для всех потоков на время Retry-After.
+"""
+import threading
+import time
+from typing import Optional
+
+import metrics
+
+
+class TokenBucket:
+    """Ограничитель запросов: не более rate запросов за period секунд, общий для всех потоков"""
+
+    def __init__(self, rate: float, period: float = 60.0, target: str = "sheets"):
+        if rate <= 0 or period <= 0:
+            raise ValueError(f"TokenBucket: rate и period должны быть больше 0 (rate={rate}, period={period})")
+        self.capacity = max(1.0, float(rate))
+        self.tokens = self.capacity
+        self.fill_rate = rate / period
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.target = target
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.fill_rate
+            metrics.inc("throttle_wait_seconds_total", wait, target=self.target)
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (после 429 квота исчерпана для всех потоков)"""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+
+def retry_after(response, default: float = 1.0) -> float:
+    value = response.headers.get("Retry-After", "")
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return default
+
+
+def throttled_get(session, url: str, limiter: Optional[TokenBucket], target: str, **kwargs):
+    """
+    GET через ограничитель. На 429 считает throttled_total и приостанавливает limiter
+    на Retry-After; сам ответ возвращается как есть (повторы — на стороне вызывающего).
+    """
+    if limiter:
+        limiter.acquire()
+    resp = session.get(url, **kwargs)
+    if resp.status_code == 429:
+        metrics.inc("throttled_total", target=target)
+        if limiter:
+            limiter.pause(retry_after(resp))
+    return resp
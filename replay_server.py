@@ -0,0 +1,278 @@
+"""
+Локальный replay-сервер API маркетплейсов для офлайн-нагрузочных прогонов.
+
+Отдаёт записанные ответы WB (basket card.json и u-card detail) и Ozon (composer-api).
+Если в папке фикстур есть ответ конкретного товара (wb_card-<nm_id>.json,
+wb_detail-<nm_id>.json, ozon_composer-<артикул>.json), он отдаётся как есть,
+иначе — общий шаблон (wb_card.json, wb_detail.json, ozon_composer.json), в котором
+подставляется артикул и детерминированная цена.
+
+Поддерживает задержку с разбросом, долю ответов 503 и 404, серверный лимит
+запросов в секунду и периодические «всплески» 429 для всех запросов.
+
+Запуск:
+    python replay_server.py --port 8766 --latency 0.08 --jitter 0.05 --error-rate 0.01 \\
+        --burst-every 60 --burst-length 5
+и в .env:
+    WB_BASKET_URL_TEMPLATE=http://127.0.0.1:8766/basket-{basket}
+    WB_DETAIL_BASE_URL=http://127.0.0.1:8766
+    OZON_API_BASE_URL=http://127.0.0.1:8766
+"""
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+
+DEFAULT_FIXTURES = Path(__file__).parent.absolute() / "benchmarks" / "fixtures"
+
+_CARD_RE = re.compile(r"/vol\d+/part\d+/(\d+)/info/ru/card\.json$")
+_DETAIL_PATH = "/__internal/u-card/cards/v4/detail"
+_COMPOSER_PATH = "/api/composer-api.bx/page/json/v2"
+_PRODUCT_RE = re.compile(r"/product/(?:[^/?]*-)?(\d+)")
+
+
+def _price(key: str) -> int:
+    """Цена товара в рублях, стабильная между запусками"""
+    return 500 + int(key) * 7919 % 150000 if key.isdigit() else 9990
+
+
+class ReplayData:
+    """Шаблоны ответов и записанные ответы отдельных товаров"""
+
+    def __init__(self, directory=None):
+        self.directory = Path(directory or DEFAULT_FIXTURES)
+        self.card = self._load("wb_card.json")
+        self.detail = self._load("wb_detail.json")
+        self.composer = self._load("ozon_composer.json")
+        states = self.composer.get("widgetStates", {})
+        self.price_key = next((k for k in states if k.startswith("webPrice")), None)
+        self.price_state = json.loads(states[self.price_key]) if self.price_key else {}
+        self._recorded: Dict[str, Optional[bytes]] = {}
+        self._lock = threading.Lock()
+
+    def _load(self, name: str) -> dict:
+        with open(self.directory / name, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def recorded(self, kind: str, key: str) -> Optional[bytes]:
+        name = f"{kind}-{key}.json"
+        with self._lock:
+            if name not in self._recorded:
+                path = self.directory / name
+                self._recorded[name] = path.read_bytes() if path.exists() else None
+            return self._recorded[name]
+
+    @staticmethod
+    def _encode(payload: dict) -> bytes:
+        return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+    def wb_card(self, nm_id: str) -> bytes:
+        return self.recorded("wb_card", nm_id) or self._encode(dict(self.card, nm_id=int(nm_id)))
+
+    def wb_detail(self, nm_id: str) -> bytes:
+        recorded = self.recorded("wb_detail", nm_id)
+        if recorded:
+            return recorded
+        kopecks = _price(nm_id) * 100
+        products = []
+        for product in self.detail.get("products", [])[:1]:
+            sizes = [dict(size, price=dict(size.get("price", {}), product=kopecks, total=kopecks))
+                     for size in product.get("sizes", [])]
+            products.append(dict(product, id=int(nm_id), sizes=sizes))
+        return self._encode(dict(self.detail, products=products))
+
+    def ozon_page(self, article: str) -> bytes:
+        recorded = self.recorded("ozon_composer", article)
+        if recorded or not self.price_key:
+            return recorded or self._encode(self.composer)
+        price = f"{_price(article):,}".replace(",", " ") + " ₽"
+        state = dict(self.price_state, price=price, cardPrice=price)
+        states = dict(self.composer["widgetStates"], **{self.price_key: json.dumps(state, ensure_ascii=False)})
+        return self._encode(dict(self.composer, widgetStates=states))
+
+
+class _RateWindow:
+    """Серверный лимит: не более limit запросов за последнюю секунду"""
+
+    def __init__(self, limit: float):
+        self.limit = limit
+        self.calls: List[float] = []
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        if self.limit <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            while self.calls and now - self.calls[0] >= 1.0:
+                self.calls.pop(0)
+            if len(self.calls) >= self.limit:
+                return False
+            self.calls.append(now)
+            return True
+
+
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, data: ReplayData, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, not_found_rate: float = 0.0, max_rps: float = 0.0,
+                 burst_every: float = 0.0, burst_length: float = 0.0):
+        super().__init__(address, _Handler)
+        self.data = data
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.not_found_rate = not_found_rate
+        self.rate_window = _RateWindow(max_rps)
+        self.burst_every = burst_every
+        self.burst_length = burst_length
+        self.started = time.monotonic()
+        self.stats = {"requests": 0, "wb_card": 0, "wb_detail": 0, "ozon": 0, "ok": 0,
+                      "errors": 0, "not_found": 0, "throttled": 0, "bursts": 0, "bytes_out": 0}
+        self.stats_lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, **deltas):
+        with self.stats_lock:
+            for key, value in deltas.items():
+                self.stats[key] += value
+
+    def burst_remaining(self) -> float:
+        """Сколько секунд осталось до конца текущего всплеска 429 (0 — всплеска нет)"""
+        if self.burst_every <= 0 or self.burst_length <= 0:
+            return 0.0
+        phase = (time.monotonic() - self.started) % self.burst_every
+        # Первый всплеск — в конце первого периода, чтобы прогрев прошёл без ошибок
+        start = self.burst_every - self.burst_length
+        return self.burst_every - phase if phase >= start else 0.0
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: ReplayServer
+    protocol_version = "HTTP/1.1"
+    # Заголовки и тело пишутся отдельно: без TCP_NODELAY keep-alive упирается в delayed ACK (~40 мс)
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, headers: Optional[dict] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count(bytes_out=len(body))
+
+    def _error(self, status: int, message: str, headers: Optional[dict] = None):
+        self._send(status, json.dumps({"error": message}).encode("utf-8"), headers)
+
+    def _fault(self) -> bool:
+        """Применяет задержку и искусственные ошибки; True — ответ уже отправлен"""
+        server = self.server
+        delay = server.latency + (random.uniform(0, server.jitter) if server.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+        burst = server.burst_remaining()
+        if burst:
+            server.count(throttled=1, bursts=1)
+            self._error(429, "Too Many Requests", {"Retry-After": str(math.ceil(burst))})
+            return True
+        if not server.rate_window.allow():
+            server.count(throttled=1)
+            self._error(429, "Too Many Requests", {"Retry-After": "1"})
+            return True
+        if server.error_rate and random.random() < server.error_rate:
+            server.count(errors=1)
+            self._error(503, "Service Unavailable")
+            return True
+        return False
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        if parts.path == "/_stats":
+            with self.server.stats_lock:
+                stats = dict(self.server.stats)
+            self._send(200, json.dumps(stats).encode("utf-8"))
+            return
+
+        self.server.count(requests=1)
+        query = parse_qs(parts.query)
+        card = _CARD_RE.search(parts.path)
+        if card:
+            kind, key = "wb_card", card.group(1)
+        elif parts.path.endswith(_DETAIL_PATH) and query.get("nm"):
+            kind, key = "wb_detail", query["nm"][0]
+        elif parts.path.endswith(_COMPOSER_PATH) and _PRODUCT_RE.search(query.get("url", [""])[0]):
+            kind, key = "ozon", _PRODUCT_RE.search(query["url"][0]).group(1)
+        else:
+            self._error(404, "Not found")
+            return
+
+        self.server.count(**{kind: 1})
+        if self._fault():
+            return
+        if kind == "wb_card" and self.server.not_found_rate and random.random() < self.server.not_found_rate:
+            self.server.count(not_found=1)
+            self._error(404, "Not found")
+            return
+
+        data = self.server.data
+        body = {"wb_card": data.wb_card, "wb_detail": data.wb_detail, "ozon": data.ozon_page}[kind](key)
+        self.server.count(ok=1)
+        self._send(200, body)
+
+
+def start_server(host: str = "127.0.0.1", port: int = 0, fixtures=None, **options) -> ReplayServer:
+    """Запускает сервер в фоновом потоке (для нагрузочных прогонов внутри процесса)"""
+    server = ReplayServer((host, port), ReplayData(fixtures), **options)
+    threading.Thread(target=server.serve_forever, name="replay-server", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay-сервер API WB и Ozon")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--fixtures", default=str(DEFAULT_FIXTURES), help="папка с записанными ответами")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, сек")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, сек")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--not-found-rate", type=float, default=0.0, help="доля ответов 404 для card.json WB")
+    parser.add_argument("--max-rps", type=float, default=0.0, help="серверный лимит запросов в секунду (0 — нет)")
+    parser.add_argument("--burst-every", type=float, default=0.0, help="период всплесков 429, сек (0 — нет)")
+    parser.add_argument("--burst-length", type=float, default=0.0, help="длительность всплеска 429, сек")
+    args = parser.parse_args()
+
+    server = ReplayServer((args.host, args.port), ReplayData(args.fixtures), latency=args.latency,
+                          jitter=args.jitter, error_rate=args.error_rate, not_found_rate=args.not_found_rate,
+                          max_rps=args.max_rps, burst_every=args.burst_every, burst_length=args.burst_length)
+    print(f"Replay API: {server.base_url} (фикстуры: {args.fixtures})")
+    print(f"  WB_BASKET_URL_TEMPLATE={server.base_url}/basket-{{basket}}")
+    print(f"  WB_DETAIL_BASE_URL={server.base_url}")
+    print(f"  OZON_API_BASE_URL={server.base_url}")
+    print(f"Статистика: {server.base_url}/_stats")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Персистентный кэш вычисленных результатов (JSON-файл с TTL)
+"""
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional, Dict, Any
+
+import metrics
+
+logger = logging.getLogger("result_cache")
+
+
+def last_refresh_boundary(now: float, refresh_hour: int) -> float:
+    """Возвращает timestamp последнего ежедневного пересчёта данных (локальное время)"""
+    current = datetime.fromtimestamp(now)
+    boundary = current.replace(hour=refresh_hour, minute=0, second=0, microsecond=0)
+    if boundary > current:
+        boundary -= timedelta(days=1)
+    return boundary.timestamp()
+
+
+class ResultCache:
+    def __init__(self, path, ttl_seconds: float, refresh_hour: Optional[int] = None):
+        self.path = Path(path)
+        self.ttl_seconds = ttl_seconds
+        self.refresh_hour = refresh_hour
+        self.hits = 0
+        self.misses = 0
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0
+
+    def _load(self):
+        if not self.enabled or not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                self._entries = data
+        except (json.JSONDecodeError, OSError) as e:
+            logger.warning(f"Кэш {self.path.name} повреждён, начинаем с пустого: {e}")
+            self._entries = {}
+
+    def _is_fresh(self, entry: Dict[str, Any], now: float) -> bool:
+        ts = entry.get("ts", 0)
+        if now - ts >= self.ttl_seconds:
+            return False
+        if self.refresh_hour is not None and ts < last_refresh_boundary(now, self.refresh_hour):
+            return False
+        return True
+
+    def get(self, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and self._is_fresh(entry, time.time()):
+                self.hits += 1
+                metrics.inc("cache_requests_total", cache=self.path.stem, result="hit")
+                return entry.get("value")
+            self.misses += 1
+            metrics.inc("cache_requests_total", cache=self.path.stem, result="miss")
+            return None
+
+    def set(self, key: str, value: Any):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entries[key] = {"ts": time.time(), "value": value}
+            self._dirty = True
+
+    def save(self):
+        """Сохраняет кэш на диск (атомарно), выбрасывая устаревшие записи"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            now = time.time()
+            self._entries = {k: v for k, v in self._entries.items() if self._is_fresh(v, now)}
+            tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+            try:
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump(self._entries, f, ensure_ascii=False)
+                os.replace(tmp, self.path)
+                self._dirty = False
+            except OSError as e:
+                logger.warning(f"Не удалось сохранить кэш {self.path.name}: {e}")
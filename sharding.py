@@ -0,0 +1,535 @@
+"""
+Горизонтальное шардирование запуска на несколько машин.
+
+Координатор читает лист один раз, раскладывает задачи плана по шардам (хэш id товара)
+и хранит аренды шардов в SQLite. Воркеры на других хостах — каждый со своими прокси —
+берут шарды по HTTP, прогоняют движки wb / ozon / mpstats и отправляют результаты обратно.
+В таблицу пишет только координатор: одним батчем, когда все шарды обработаны.
+
+    python sharding.py coordinator --shards 16
+    python sharding.py worker --coordinator http://10.0.0.5:8780 --engines wb,ozon
+
+Аренда шарда продлевается, пока воркер жив; если воркер пропал, шард по истечении
+аренды достаётся другому воркеру (не более SHARD_MAX_ATTEMPTS попыток).
+"""
+import argparse
+import hmac
+import json
+import os
+import re
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+import requests
+
+import config
+import metrics
+from config import setup_logging
+from planner import Plan
+
+logger = setup_logging("sharding")
+
+ENGINES = ("wb", "ozon", "mpstats")
+TOKEN_HEADER = "X-Shard-Token"
+_DIGITS_RE = re.compile(r"\d+")
+
+
+def product_key(engine: str, task) -> str:
+    """Ключ шардирования: id товара (последняя группа цифр в пути ссылки), для MPStats — ссылка"""
+    if engine == "mpstats":
+        return task[1].strip()
+    value = task[1].strip()
+    ids = _DIGITS_RE.findall(urlsplit(value).path if value.lower().startswith("http") else value)
+    return ids[-1] if ids else value
+
+
+def shard_index(key: str, shards: int) -> int:
+    # crc32 стабилен между процессами и машинами, в отличие от hash()
+    return zlib.crc32(key.encode("utf-8")) % shards
+
+
+def split_plan(plan: Plan, shards: int) -> List[Dict]:
+    """Раскладывает задачи плана по шардам; пустые шарды не создаются"""
+    result = []
+    for engine, tasks in (("wb", plan.wb_tasks), ("ozon", plan.ozon_tasks), ("mpstats", plan.mpstat_tasks)):
+        buckets: Dict[int, list] = {}
+        for task in tasks:
+            buckets.setdefault(shard_index(product_key(engine, task), shards), []).append(list(task))
+        for idx in sorted(buckets):
+            result.append({"id": f"{engine}-{idx:03d}", "engine": engine, "tasks": buckets[idx]})
+    return result
+
+
+def engine_columns(engine: str) -> set:
+    """Колонки, в которые пишет движок: остальные обновления от воркера отбрасываются"""
+    from gsheets import col_letter_to_index
+
+    letters = {
+        "wb": (config.WB_PRICE_COLUMN, config.WB_RATING_REVIEWS_COLUMN, config.WB_DISPLAY_BATTERY_COLUMN,
+               config.WB_PROMO_COLUMN, config.WB_SELLER_COLUMN),
+        "ozon": (config.OZON_PRICE_COLUMN,),
+        "mpstats": (config.MPSTATS_AVG_PRICE_COLUMN, config.MPSTATS_SALES_COLUMN),
+    }.get(engine, ())
+    return {col_letter_to_index(letter) for letter in letters}
+
+
+def sanitize_result(engine: str, tasks: list, result) -> Dict:
+    """
+    Оставляет в результате шарда только ячейки его строк и колонок движка
+    (заливка — только колонка акций WB); остальное отбрасывается с предупреждением.
+    """
+    from gsheets import col_letter_to_index
+
+    if not isinstance(result, dict):
+        raise ValueError("result должен быть объектом")
+    rows = {task[0] for task in tasks}
+    columns = engine_columns(engine)
+    color_columns = {col_letter_to_index(config.WB_PROMO_COLUMN)} if engine == "wb" else set()
+
+    def allowed(cells, cols):
+        kept = []
+        for cell in cells if isinstance(cells, list) else []:
+            if (isinstance(cell, list) and len(cell) == 3 and isinstance(cell[0], int)
+                    and isinstance(cell[1], int) and cell[0] in rows and cell[1] in cols):
+                kept.append(cell)
+        return kept
+
+    updates = allowed(result.get("updates"), columns)
+    colors = [c for c in allowed(result.get("colors"), color_columns) if c[2] is None or isinstance(c[2], str)]
+    dropped = len(result.get("updates") or []) + len(result.get("colors") or []) - len(updates) - len(colors)
+    if dropped:
+        logger.warning(f"Отброшено {dropped} ячеек вне строк шарда или колонок движка {engine}")
+
+    def count(key):
+        value = result.get(key, 0)
+        return value if isinstance(value, int) and value >= 0 else 0
+
+    return {"updates": updates, "colors": colors, "parsed": count("parsed"), "errors": count("errors")}
+
+
+class ShardStore:
+    """Таблица шардов и аренд в SQLite: pending -> leased -> done | failed"""
+
+    def __init__(self, path, lease_seconds: Optional[int] = None, max_attempts: Optional[int] = None):
+        self.lease_seconds = lease_seconds if lease_seconds is not None else config.SHARD_LEASE_SECONDS
+        self.max_attempts = max_attempts if max_attempts is not None else config.SHARD_MAX_ATTEMPTS
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS shards (
+                id TEXT PRIMARY KEY,
+                engine TEXT NOT NULL,
+                tasks TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT
+            )
+        """)
+
+    def reset(self, shards: List[Dict]):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute("DELETE FROM shards")
+            self._conn.executemany(
+                "INSERT INTO shards (id, engine, tasks) VALUES (?, ?, ?)",
+                [(s["id"], s["engine"], json.dumps(s["tasks"], ensure_ascii=False)) for s in shards],
+            )
+            self._conn.execute("COMMIT")
+
+    def _expire(self, now: float):
+        # Просроченные аренды, исчерпавшие попытки, больше не выдаются
+        self._conn.execute(
+            "UPDATE shards SET status = 'failed', error = 'аренда истекла' "
+            "WHERE status = 'leased' AND lease_until < ? AND attempts >= ?",
+            (now, self.max_attempts),
+        )
+
+    def expire(self):
+        with self._lock:
+            self._expire(time.time())
+
+    def lease(self, worker: str, engines) -> Optional[Dict]:
+        """Выдаёт свободный шард (или шард с истёкшей арендой) одного из движков воркера"""
+        now = time.time()
+        placeholders = ",".join("?" * len(engines))
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._expire(now)
+                row = self._conn.execute(
+                    f"SELECT id, engine, tasks, attempts FROM shards "
+                    f"WHERE engine IN ({placeholders}) AND attempts < ? "
+                    f"AND (status = 'pending' OR (status = 'leased' AND lease_until < ?)) "
+                    f"ORDER BY attempts, id LIMIT 1",
+                    (*engines, self.max_attempts, now),
+                ).fetchone()
+                if row is None:
+                    self._conn.execute("COMMIT")
+                    return None
+                self._conn.execute(
+                    "UPDATE shards SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                    "WHERE id = ?",
+                    (worker, now + self.lease_seconds, row["id"]),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return {"id": row["id"], "engine": row["engine"], "tasks": json.loads(row["tasks"]),
+                "attempt": row["attempts"] + 1, "lease_seconds": self.lease_seconds}
+
+    def _update_owned(self, shard_id: str, worker: str, sql: str, params: tuple) -> bool:
+        with self._lock:
+            cur = self._conn.execute(
+                f"{sql} WHERE id = ? AND worker = ? AND status = 'leased'",
+                (*params, shard_id, worker),
+            )
+            return cur.rowcount == 1
+
+    def shard(self, shard_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT engine, tasks FROM shards WHERE id = ?", (shard_id,)).fetchone()
+        return {"engine": row["engine"], "tasks": json.loads(row["tasks"])} if row else None
+
+    def renew(self, shard_id: str, worker: str) -> bool:
+        return self._update_owned(shard_id, worker, "UPDATE shards SET lease_until = ?",
+                                  (time.time() + self.lease_seconds,))
+
+    def complete(self, shard_id: str, worker: str, result: Dict) -> bool:
+        return self._update_owned(shard_id, worker, "UPDATE shards SET status = 'done', result = ?",
+                                  (json.dumps(result, ensure_ascii=False),))
+
+    def fail(self, shard_id: str, worker: str, error: str) -> bool:
+        # Возвращаем шард в очередь; после max_attempts он помечается как failed
+        with self._lock:
+            cur = self._conn.execute(
+                "UPDATE shards SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "error = ?, worker = NULL, lease_until = NULL "
+                "WHERE id = ? AND worker = ? AND status = 'leased'",
+                (self.max_attempts, error[:500], shard_id, worker),
+            )
+            return cur.rowcount == 1
+
+    def progress(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS n FROM shards GROUP BY status").fetchall()
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        counts.update({row["status"]: row["n"] for row in rows})
+        return counts
+
+    def finished(self) -> bool:
+        counts = self.progress()
+        return counts["pending"] == 0 and counts["leased"] == 0
+
+    def results(self) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute("SELECT id, engine, result FROM shards WHERE status = 'done'").fetchall()
+        return [{"id": row["id"], "engine": row["engine"], **json.loads(row["result"])} for row in rows]
+
+    def failures(self) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute("SELECT id, error FROM shards WHERE status = 'failed'").fetchall()
+        return [dict(row) for row in rows]
+
+    def close(self):
+        self._conn.close()
+
+
+def _make_handler(store: ShardStore, token: str):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            logger.debug(f"HTTP {self.address_string()} {format % args}")
+
+        def _send(self, status: int, payload: Dict):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _authorized(self) -> bool:
+            if hmac.compare_digest(self.headers.get(TOKEN_HEADER, "").encode("utf-8"), token.encode("utf-8")):
+                return True
+            logger.warning(f"Запрос без верного токена от {self.address_string()}: {self.path}")
+            self._send(403, {"error": "forbidden"})
+            return False
+
+        def do_GET(self):
+            if not self._authorized():
+                return
+            if self.path.rstrip("/") == "/status":
+                self._send(200, store.progress())
+            else:
+                self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            if not self._authorized():
+                return
+            action = self.path.strip("/")
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                worker = str(body["worker"])
+                shard_id = str(body["id"]) if action in ("renew", "complete", "fail") else None
+                if action == "complete":
+                    shard = store.shard(shard_id)
+                    result = sanitize_result(shard["engine"], shard["tasks"], body["result"]) if shard else None
+            except (ValueError, KeyError, TypeError, AttributeError):
+                self._send(400, {"error": "bad request"})
+                return
+
+            if action == "lease":
+                shard = store.lease(worker, body.get("engines") or ENGINES)
+                if shard:
+                    logger.info(f"Шард {shard['id']} ({len(shard['tasks'])} задач) -> {worker}, "
+                                f"попытка {shard['attempt']}")
+                    self._send(200, shard)
+                else:
+                    self._send(200, {"id": None, "finished": store.finished()})
+            elif action == "renew":
+                self._send(200, {"ok": store.renew(shard_id, worker)})
+            elif action == "complete":
+                ok = result is not None and store.complete(shard_id, worker, result)
+                if ok:
+                    logger.info(f"Шард {shard_id} готов ({worker}): {store.progress()}")
+                else:
+                    logger.warning(f"Результат шарда {shard_id} от {worker} отклонён: аренда потеряна")
+                self._send(200, {"ok": ok})
+            elif action == "fail":
+                logger.warning(f"Шард {shard_id} не обработан на {worker}: {body.get('error')}")
+                self._send(200, {"ok": store.fail(shard_id, worker, str(body.get("error") or ""))})
+            else:
+                self._send(404, {"error": "not found"})
+
+    return Handler
+
+
+def merge_results(results: List[Dict]):
+    """Собирает обновления и заливку всех шардов для одной записи"""
+    updates, colors = [], []
+    for result in results:
+        updates.extend(tuple(u) for u in result.get("updates", []))
+        colors.extend(tuple(c) for c in result.get("colors", []))
+    return updates, colors
+
+
+def run_coordinator(shards: int, host: str, port: int, db_path=None, poll: float = 10.0,
+                    token: Optional[str] = None) -> bool:
+    from gsheets import get_sheet_client, write_values_and_colors
+    from planner import load_plan
+
+    token = token if token is not None else config.SHARD_TOKEN
+    if not token:
+        raise ValueError("Не задан SHARD_TOKEN: координатор не принимает запросы без общего секрета")
+
+    _, sheet = get_sheet_client()
+    plan = load_plan(sheet)
+    shard_list = split_plan(plan, shards)
+    if not shard_list:
+        logger.warning("Нет задач для распределения")
+        return True
+
+    store = ShardStore(db_path or config.SHARD_DB_FILE)
+    store.reset(shard_list)
+    server = ThreadingHTTPServer((host, port), _make_handler(store, token))
+    threading.Thread(target=server.serve_forever, name="shard-http", daemon=True).start()
+    logger.info(f"Координатор: http://{host}:{port}, шардов: {len(shard_list)} ({plan.summary()})")
+
+    try:
+        while not store.finished():
+            time.sleep(poll)
+            store.expire()
+            logger.info(f"Прогресс шардов: {store.progress()}")
+    except KeyboardInterrupt:
+        logger.warning("Прервано пользователем — записываем готовые шарды")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    results = store.results()
+    failures = store.failures()
+    store.close()
+
+    updates, colors = merge_results(results)
+    parsed = sum(r.get("parsed", 0) for r in results)
+    errors = sum(r.get("errors", 0) for r in results)
+    if updates or colors:
+        logger.info(f"Запись {len(updates)} обновлений из {len(results)} шардов...")
+        write_values_and_colors(sheet, updates, colors, snapshot=plan.snapshot)
+    for failure in failures:
+        logger.error(f"Шард {failure['id']} не обработан: {failure['error']}")
+    logger.info(f"Готово! Обработано: {parsed}, Ошибок: {errors}, потеряно шардов: {len(failures)}")
+    metrics.write_report("coordinator", {"shards": len(shard_list), "failed_shards": failures})
+    return not failures
+
+
+class ShardWorker:
+    """Выполняет шарды движками wb / ozon / mpstats; браузеры и куки живут между шардами"""
+
+    def __init__(self, coordinator_url: str, engines, worker_id: Optional[str] = None,
+                 token: Optional[str] = None):
+        from browser_pool import BrowserPool
+
+        self.url = coordinator_url.rstrip("/")
+        self.engines = list(engines)
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.browser_pool = BrowserPool()
+        self.http = requests.Session()
+        self.http.headers[TOKEN_HEADER] = token if token is not None else config.SHARD_TOKEN
+        self._cookies: Dict[str, dict] = {}
+
+    def _post(self, action: str, **payload) -> Dict:
+        response = self.http.post(f"{self.url}/{action}", json={"worker": self.worker_id, **payload}, timeout=60)
+        response.raise_for_status()
+        return response.json()
+
+    def _get_cookies(self, engine: str, module) -> dict:
+        from browser_pool import lease_driver
+
+        if engine not in self._cookies:
+            getter = module.get_cookies_from_wb if engine == "wb" else module.get_cookies_from_ozon
+            lease = lease_driver(self.browser_pool, engine, module.init_driver)
+            try:
+                cookies = getter(lease.driver)
+                lease.release(broken=not cookies)
+            finally:
+                lease.release()
+            if not cookies:
+                raise RuntimeError("не удалось получить куки")
+            self._cookies[engine] = cookies
+        return self._cookies[engine]
+
+    def execute(self, engine: str, tasks: list) -> Dict:
+        """Прогоняет задачи шарда и возвращает обновления без записи в таблицу"""
+        updates, colors = [], []
+        if engine == "wb":
+            import wb
+            from gsheets import col_letter_to_index
+
+            promo_cells = []
+            tasks = [tuple(t) for t in tasks]
+            parsed, errors = wb.process_tasks(tasks, self._get_cookies("wb", wb), updates, promo_cells)
+            colors = wb.build_color_cells(updates, promo_cells, col_letter_to_index(config.WB_PROMO_COLUMN))
+        elif engine == "ozon":
+            import ozon
+
+            tasks = [tuple(t) for t in tasks]
+            parsed, errors = ozon.process_tasks(tasks, self._get_cookies("ozon", ozon), updates)
+        elif engine == "mpstats":
+            import mpstat
+            from browser_pool import lease_driver
+
+            cache = mpstat.open_cache()
+            pending = mpstat.apply_cached([tuple(t) for t in tasks], cache, updates)
+            parsed, errors = len(tasks) - len(pending), 0
+            if pending:
+                lease = lease_driver(self.browser_pool, "mpstats", mpstat.setup_browser)
+                try:
+                    if not mpstat.check_and_login_mpstats(lease.driver):
+                        raise RuntimeError("не удалось авторизоваться в MPStats")
+                    done, errors = mpstat.process_tasks(lease.driver, pending, cache, updates)
+                    parsed += done
+                finally:
+                    cache.save()
+                    lease.release()
+        else:
+            raise ValueError(f"Неизвестный движок: {engine}")
+
+        # Шард, в котором не удалось ни одного товара, — повод обновить куки
+        if tasks and not parsed:
+            self._cookies.pop(engine, None)
+        return {"updates": updates, "colors": colors, "parsed": parsed, "errors": errors}
+
+    def _keep_lease(self, shard_id: str, interval: float, stop: threading.Event):
+        while not stop.wait(interval):
+            try:
+                if not self._post("renew", id=shard_id).get("ok"):
+                    logger.warning(f"Аренда шарда {shard_id} потеряна")
+                    return
+            except requests.RequestException as e:
+                logger.warning(f"Не удалось продлить аренду {shard_id}: {e}")
+
+    def run(self, poll: float = 5.0) -> bool:
+        logger.info(f"Воркер {self.worker_id}: движки {', '.join(self.engines)}, координатор {self.url}")
+        processed = 0
+        try:
+            while True:
+                try:
+                    shard = self._post("lease", engines=self.engines)
+                except requests.RequestException as e:
+                    if processed:
+                        # Координатор завершил запуск и остановил HTTP-сервер
+                        logger.info(f"Координатор недоступен ({e}), завершаем работу")
+                        return True
+                    raise
+                if not shard.get("id"):
+                    if shard.get("finished"):
+                        logger.info(f"Все шарды обработаны, воркер выполнил {processed}")
+                        return True
+                    time.sleep(poll)
+                    continue
+
+                stop = threading.Event()
+                keeper = threading.Thread(target=self._keep_lease, name="shard-lease", daemon=True,
+                                          args=(shard["id"], shard["lease_seconds"] / 3, stop))
+                keeper.start()
+                try:
+                    result = self.execute(shard["engine"], shard["tasks"])
+                except Exception as e:
+                    logger.error(f"Шард {shard['id']}: {e}", exc_info=True)
+                    self._post("fail", id=shard["id"], error=str(e))
+                    continue
+                finally:
+                    stop.set()
+                    keeper.join()
+                self._post("complete", id=shard["id"], result=result)
+                processed += 1
+        finally:
+            self.browser_pool.close()
+            metrics.write_report(f"worker-{self.worker_id}", {"shards": processed})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Распределённый запуск парсеров")
+    sub = parser.add_subparsers(dest="role", required=True)
+
+    coord = sub.add_parser("coordinator", help="читает лист, раздаёт шарды и пишет результаты")
+    coord.add_argument("--shards", type=int, default=config.SHARD_COUNT)
+    coord.add_argument("--host", default=config.SHARD_COORDINATOR_HOST)
+    coord.add_argument("--port", type=int, default=config.SHARD_COORDINATOR_PORT)
+    coord.add_argument("--db", default=str(config.SHARD_DB_FILE), help="файл SQLite с арендами шардов")
+
+    worker = sub.add_parser("worker", help="обрабатывает шарды на этой машине")
+    worker.add_argument("--coordinator", default=config.SHARD_COORDINATOR_URL)
+    worker.add_argument("--engines", default=",".join(ENGINES), help="wb,ozon,mpstats")
+    worker.add_argument("--id", default=None, help="имя воркера в логах координатора")
+
+    args = parser.parse_args()
+    if not config.SHARD_TOKEN:
+        parser.error("задайте SHARD_TOKEN в .env (общий секрет координатора и воркеров)")
+    if args.role == "coordinator":
+        ok = run_coordinator(args.shards, args.host, args.port, args.db)
+    else:
+        engines = [e.strip() for e in args.engines.split(",") if e.strip()]
+        unknown = set(engines) - set(ENGINES)
+        if unknown:
+            parser.error(f"неизвестные движки: {', '.join(sorted(unknown))}")
+        ok = ShardWorker(args.coordinator, engines, args.id).run()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
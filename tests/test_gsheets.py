@@ -0,0 +1,63 @@
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+import config
+import fake_sheets
+import gsheets
+
+
+class AuthCacheRoundTripTest(unittest.TestCase):
+    """
+    _restore_sheet собирает Spreadsheet из внутренностей gspread 6.x:
+    тест проверяет, что восстановленный лист работает и не запрашивает метаданные
+    """
+
+    def setUp(self):
+        self.server = fake_sheets.start_server(rows=10, sheet_gid=config.SHEET_GID)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.saved = (config.SHEETS_API_BASE_URL, config.SHEETS_AUTH_CACHE_FILE)
+        config.SHEETS_API_BASE_URL = self.server.base_url
+        config.SHEETS_AUTH_CACHE_FILE = Path(self.tmp.name) / "sheets_auth_cache.json"
+        self.client, self.sheet = gsheets._connect()
+
+    def tearDown(self):
+        config.SHEETS_API_BASE_URL, config.SHEETS_AUTH_CACHE_FILE = self.saved
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    @staticmethod
+    def _creds(expires_in: timedelta):
+        # google-auth хранит expiry как naive UTC
+        return SimpleNamespace(token="cached-token",
+                               expiry=datetime.now(timezone.utc).replace(tzinfo=None) + expires_in)
+
+    def test_restored_sheet_matches_and_skips_metadata(self):
+        gsheets._save_auth_cache(self._creds(timedelta(hours=1)), self.sheet.spreadsheet, self.sheet)
+        cached = gsheets._load_auth_cache()
+        self.assertIsNotNone(cached)
+        self.assertEqual(cached["token"], "cached-token")
+
+        requests_before = self.server.stats["requests"]
+        restored = gsheets._restore_sheet(self.client, cached)
+        self.assertEqual(self.server.stats["requests"], requests_before)
+
+        self.assertEqual(restored.id, self.sheet.id)
+        self.assertEqual(restored.title, self.sheet.title)
+        self.assertEqual(restored.spreadsheet.id, config.SPREADSHEET_ID)
+        self.assertEqual(restored.spreadsheet.title, self.sheet.spreadsheet.title)
+
+        # Значения (values API) и заливка (spreadsheets.batchUpdate) через восстановленные объекты
+        self.assertTrue(gsheets.write_values_and_colors(restored, [(2, 3, "123")], [(2, 3, "#FF0000")]))
+        self.assertEqual(self.sheet.get("C2"), [["123"]])
+
+    def test_expired_cache_is_ignored(self):
+        gsheets._save_auth_cache(self._creds(timedelta(seconds=30)), self.sheet.spreadsheet, self.sheet)
+        self.assertIsNone(gsheets._load_auth_cache())
+
+
+if __name__ == "__main__":
+    unittest.main()
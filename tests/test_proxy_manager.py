@@ -0,0 +1,78 @@
+import json
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import config
+import proxy_manager
+from proxy_manager import ProxyManager, ProxySessionPool
+
+
+class _EchoProxy(BaseHTTPRequestHandler):
+    """HTTP-прокси для теста: отвечает сам, возвращая свой порт и заголовок Cookie"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        body = json.dumps({"port": self.server.server_port, "cookie": self.headers.get("Cookie")}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ProxySessionPoolCookiesTest(unittest.TestCase):
+    URL = "http://api.example.test/item"
+
+    def setUp(self):
+        self.servers = []
+        for _ in range(2):
+            server = ThreadingHTTPServer(("127.0.0.1", 0), _EchoProxy)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+        self.tmp = tempfile.TemporaryDirectory()
+        proxy_file = Path(self.tmp.name) / "proxies.txt"
+        proxy_file.write_text("".join(f"127.0.0.1:{s.server_port}\n" for s in self.servers), encoding="utf-8")
+
+        self.manager = ProxyManager(str(proxy_file))
+        self.saved = (config.USE_PROXY, proxy_manager._shared_manager)
+        config.USE_PROXY = True
+        proxy_manager._shared_manager = self.manager
+        self.pool = ProxySessionPool("test")
+        self.with_cookies, self.without_cookies = self.manager.proxies
+        self.pool.bind_cookies(self.with_cookies, {"session": "browser"})
+
+    def tearDown(self):
+        config.USE_PROXY, proxy_manager._shared_manager = self.saved
+        self.pool.close()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.tmp.cleanup()
+
+    def _get_via(self, proxy):
+        self.manager.acquire = lambda keys=None: proxy
+        return self.pool.get(self.URL, cookies={"session": "explicit"}, timeout=5).json()
+
+    def test_proxy_with_browser_cookies_sends_its_own(self):
+        data = self._get_via(self.with_cookies)
+        self.assertEqual(data["port"], self.with_cookies["port"])
+        self.assertEqual(data["cookie"], "session=browser")
+
+    def test_proxy_without_cookies_keeps_explicit_ones(self):
+        data = self._get_via(self.without_cookies)
+        self.assertEqual(data["port"], self.without_cookies["port"])
+        self.assertEqual(data["cookie"], "session=explicit")
+
+    def test_requests_use_whole_pool(self):
+        ports = {self.pool.get(self.URL, cookies={"session": "explicit"}, timeout=5).json()["port"]
+                 for _ in range(50)}
+        self.assertEqual(ports, {s.server_port for s in self.servers})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,20 +1,141 @@
 """
 UC (Undetected Chrome) с прокси-туннелем от selenium-wire
+
+В одном процессе можно держать несколько экземпляров: у каждого свой туннель со своим
+upstream-прокси и свой каталог профиля. Если каталог уже занят другим экземпляром
+(или передан clone_profile=True), профиль копируется из базового во временный клон.
+Закрытие всех экземпляров при выходе и по Ctrl+C — через общий реестр процесса.
+
+MITM-туннель selenium-wire нужен только для прокси с логином и паролем (Chrome не умеет
+передавать их в --proxy-server) или для перехвата запросов. В остальных случаях браузер
+запускается напрямую: с нативным --proxy-server или без прокси.
+
+Перехваченные туннелем запросы хранятся в памяти с ограничениями (параметр capture):
+    {"scopes": [regex, ...], "max_entries": 200, "max_body": 262144}
+scopes — какие URL сохранять, max_entries — кольцевой буфер последних запросов,
+max_body — тела больше этого размера (байт) не сохраняются; capture=False — не сохранять ничего.
+
+Быстрый старт: версия Chrome кэшируется (в памяти и на диске, ключ — путь и mtime бинарника),
+пропатченный chromedriver сохраняется под версию Chrome и переиспользуется без скачивания
+и повторного патча; такие запуски не сериализуются.
 """
 import atexit
+import itertools
+import json
 import logging
+import os
+import re
+import shutil
 import signal
-import sys
-from typing import Optional, Dict
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Dict, Iterable, Iterator, Set, Union, TYPE_CHECKING
+from urllib.parse import urlsplit
 
-import undetected_chromedriver as uc
-from seleniumwire import backend
+# undetected_chromedriver и seleniumwire загружаются при первом запуске браузера:
+# вместе они добавляют к старту процесса больше полусекунды
+if TYPE_CHECKING:
+    import undetected_chromedriver as uc
 
 logger = logging.getLogger(__name__)
 
+# uc.Chrome патчит общий бинарник chromedriver — параллельные запуски сериализуем
+_driver_start_lock = threading.Lock()
+
+# Реестр процесса: живые туннели и занятые каталоги профилей
+_registry_lock = threading.RLock()
+_live_tunnels: Set["UCWithTunnel"] = set()
+_profiles_in_use: Set[str] = set()
+_clone_ids = itertools.count(1)
+_atexit_installed = False
+_sigint_installed = False
+_previous_sigint = None
+
+# Кэши и lock-файлы Chrome не копируются в клоны профиля
+_PROFILE_CACHES = ("Cache", "Code Cache", "GPUCache", "ShaderCache", "GrShaderCache", "DawnCache", "CacheStorage",
+                   "Crashpad", "BrowserMetrics")
+_PROFILE_SKIP = ("SingletonLock", "SingletonSocket", "SingletonCookie", "lockfile") + _PROFILE_CACHES
+
+# Кэш версий Chrome: ключ — путь к бинарнику и его mtime (обновление Chrome меняет mtime)
+_chrome_versions: Dict[str, int] = {}
+_chrome_versions_lock = threading.Lock()
+# Последний проверенный Preferences каждого профиля: (mtime_ns, размер)
+_checked_prefs: Dict[str, tuple] = {}
+
+
+# Шаблоны Network.setBlockedURLs: страницам, с которых нужны только куки или выгрузка,
+# картинки, шрифты, видео и счётчики не нужны
+BLOCK_MEDIA = ("*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.avif", "*.svg", "*.ico",
+               "*.woff", "*.woff2", "*.ttf", "*.otf", "*.eot",
+               "*.mp4", "*.webm", "*.m3u8", "*.mp3")
+BLOCK_ANALYTICS = ("*mc.yandex.ru*", "*yandex.ru/metrika*", "*google-analytics.com*",
+                   "*googletagmanager.com*", "*doubleclick.net*", "*top-fwz1.mail.ru*",
+                   "*vk.com/rtrg*", "*facebook.net*", "*hotjar.com*")
+BLOCK_DEFAULT = BLOCK_MEDIA + BLOCK_ANALYTICS
+
+
+def close_all(blocking: bool = True):
+    """Закрывает все живые туннели процесса (atexit, Ctrl+C); blocking=False пропускает уже закрывающиеся"""
+    with _registry_lock:
+        tunnels = list(_live_tunnels)
+    for tunnel in tunnels:
+        tunnel.close(blocking=blocking)
+
+
+def _handle_sigint(sig, frame):
+    logger.info("Получен сигнал прерывания, закрываю туннели...")
+    # Сигнал мог прийти внутри close() этого же потока: ждать его блокировку нельзя
+    close_all(blocking=False)
+    # Дальше — прежний обработчик (по умолчанию KeyboardInterrupt), чтобы парсеры успели записать собранное
+    if callable(_previous_sigint):
+        _previous_sigint(sig, frame)
+    else:
+        raise KeyboardInterrupt
+
+
+def _install_cleanup():
+    """atexit и SIGINT регистрируются один раз на процесс, а не на каждый экземпляр"""
+    global _atexit_installed, _sigint_installed, _previous_sigint
+    with _registry_lock:
+        if not _atexit_installed:
+            atexit.register(close_all)
+            _atexit_installed = True
+        # Обработчик сигнала можно установить только из главного потока
+        if not _sigint_installed and threading.current_thread() is threading.main_thread():
+            _previous_sigint = signal.getsignal(signal.SIGINT)
+            signal.signal(signal.SIGINT, _handle_sigint)
+            _sigint_installed = True
 
-def _detect_chrome_major_version() -> Optional[int]:
-    """Определяет major-версию Chrome (упрощённо)"""
+
+def _clone_profile(base: Path) -> Path:
+    target = base.parent / f"{base.name}-clones" / f"{os.getpid()}-{next(_clone_ids)}"
+    shutil.rmtree(target, ignore_errors=True)
+    if base.exists():
+        shutil.copytree(base, target, ignore=shutil.ignore_patterns(*_PROFILE_SKIP), dirs_exist_ok=True)
+    else:
+        target.mkdir(parents=True)
+    return target
+
+
+def _driver_cache_dir() -> Path:
+    """Каталог с пропатченными chromedriver рядом с данными undetected_chromedriver"""
+    from undetected_chromedriver.patcher import Patcher
+    return Path(Patcher.data_path) / "patched"
+
+
+def _version_from_binary(path: str) -> Optional[int]:
+    try:
+        out = subprocess.run([path, "--version"], capture_output=True, text=True, timeout=15).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    match = re.search(r"(\d+)\.\d+\.\d+", out)
+    return int(match.group(1)) if match else None
+
+
+def _detect_chrome_major_version(browser_path: Optional[str] = None) -> Optional[int]:
+    """Определяет major-версию Chrome: реестр на Windows, `chrome --version` на Linux и Mac"""
     try:
         import winreg
         for root in [winreg.HKEY_CURRENT_USER, winreg.HKEY_LOCAL_MACHINE]:
@@ -26,20 +147,83 @@ def _detect_chrome_major_version() -> Optional[int]:
                 continue
     except ImportError:
         pass
-    return None
 
+    if not browser_path:
+        from undetected_chromedriver import find_chrome_executable
+        browser_path = find_chrome_executable()
+    if not browser_path:
+        return None
+    try:
+        real = os.path.realpath(browser_path)
+        key = f"{real}:{os.stat(real).st_mtime_ns}"
+    except OSError:
+        return None
+
+    with _chrome_versions_lock:
+        if key in _chrome_versions:
+            return _chrome_versions[key]
+        cache_file = _driver_cache_dir() / "chrome_versions.json"
+        try:
+            cached = json.loads(cache_file.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            cached = {}
+        version = cached.get(key) or _version_from_binary(browser_path)
+        if version:
+            _chrome_versions[key] = version
+            if cached.get(key) != version:
+                try:
+                    cache_file.parent.mkdir(parents=True, exist_ok=True)
+                    cache_file.write_text(json.dumps(dict(cached, **{key: version})), encoding="utf-8")
+                except OSError:
+                    pass
+        return version
 
-def _sanitize_chrome_profile(user_data_dir: str) -> None:
-    """Проверяет целостность профиля Chrome (Preferences)"""
-    import json
-    import time
-    from pathlib import Path
 
+def _patched_driver_path(version: int) -> Path:
+    name = "chromedriver.exe" if os.name == "nt" else "chromedriver"
+    return _driver_cache_dir() / f"{version}-{name}"
+
+
+def _store_patched_driver(driver, target: Path):
+    """Сохраняет пропатченный uc бинарник, чтобы следующие запуски не скачивали и не патчили его"""
+    try:
+        source = driver.patcher.executable_path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+        shutil.copy2(source, tmp)
+        os.chmod(tmp, 0o755)
+        # Атомарная замена: параллельные процессы не увидят недописанный файл
+        os.replace(tmp, target)
+        logger.info(f"Пропатченный chromedriver сохранён: {target}")
+    except Exception as e:
+        logger.debug(f"Не удалось сохранить chromedriver: {e}")
+
+
+def _prepare_profile(user_data_dir: str, template: Optional[str] = None, slim: bool = False):
+    """Новый профиль создаётся из шаблона; slim — перед запуском удаляются кэши Chrome"""
+    path = Path(user_data_dir)
+    if template and Path(template).is_dir() and not (path / "Default").exists():
+        shutil.copytree(template, path, ignore=shutil.ignore_patterns(*_PROFILE_SKIP), dirs_exist_ok=True)
+        logger.info(f"Профиль {path.name} создан из шаблона {template}")
+    if slim:
+        for base in (path, path / "Default", path / "Default" / "Service Worker"):
+            for name in _PROFILE_CACHES:
+                if (base / name).is_dir():
+                    shutil.rmtree(base / name, ignore_errors=True)
+
+
+def _sanitize_chrome_profile(user_data_dir: str) -> None:
+    """Проверяет целостность профиля Chrome (Preferences); неизменённый файл повторно не разбирается"""
+    prefs = Path(user_data_dir) / "Default" / "Preferences"
     try:
-        prefs = Path(user_data_dir) / "Default" / "Preferences"
         if prefs.exists():
+            stat = prefs.stat()
+            signature = (stat.st_mtime_ns, stat.st_size)
+            if _checked_prefs.get(str(prefs)) == signature:
+                return
             with open(prefs, 'r', encoding='utf-8') as f:
                 json.load(f)
+            _checked_prefs[str(prefs)] = signature
     except (json.JSONDecodeError, FileNotFoundError):
         # Создаём бэкап и новый пустой Preferences
         backup = prefs.with_suffix(f".corrupt.{int(time.time())}")
@@ -55,49 +239,125 @@ def _sanitize_chrome_profile(user_data_dir: str) -> None:
         pass
 
 
+class _CappedStorage:
+    """Обёртка хранилища selenium-wire: тела больше max_body не сохраняются"""
+
+    def __init__(self, storage, max_body: int):
+        self._storage = storage
+        self.max_body = max_body
+
+    def _trim(self, message):
+        if self.max_body and len(message.body) > self.max_body:
+            message.headers["X-Capture-Truncated"] = str(len(message.body))
+            message.body = b""
+
+    def save_request(self, request):
+        # Браузеру уходит исходный запрос mitmproxy, обрезается только сохраняемая копия
+        self._trim(request)
+        self._storage.save_request(request)
+
+    def save_response(self, request_id, response):
+        self._trim(response)
+        self._storage.save_response(request_id, response)
+
+    def __getattr__(self, name):
+        return getattr(self._storage, name)
+
+
+def _native_proxy(proxy_config: Dict) -> Optional[str]:
+    """Адрес прокси для --proxy-server без туннеля; None — прокси с авторизацией"""
+    url = proxy_config.get("https") or proxy_config.get("http")
+    if not url:
+        return ""
+    parts = urlsplit(url if "://" in url else f"http://{url}")
+    if parts.username or parts.password:
+        return None
+    return f"{parts.scheme}://{parts.hostname}:{parts.port}" if parts.port else f"{parts.scheme}://{parts.hostname}"
+
+
 class UCWithTunnel:
-    def __init__(self, proxy_config: Optional[Dict] = None):
+    def __init__(self, proxy_config: Optional[Dict] = None, intercept: Optional[bool] = None,
+                 capture: Union[Dict, bool, None] = None):
+        # upstream-прокси этого экземпляра: у каждого туннеля свой
         self.proxy_config = proxy_config or {}
+        # capture=None — без ограничений (как раньше), False — запросы не сохраняются
+        self.capture = {} if capture in (None, True) else capture
+        # intercept=None — MITM только если без него нельзя (прокси с авторизацией)
+        native = _native_proxy(self.proxy_config)
+        self.intercept = native is None if intercept is None else intercept
+        if not self.intercept and native is None:
+            logger.warning("Прокси с авторизацией недоступен без туннеля, включаю MITM")
+            self.intercept = True
+        self.native_proxy = native or None
         self.backend = None
         self.local_proxy_address = None
         self.is_active = False
-        # Регистрируем закрытие при выходе
-        atexit.register(self.close)
-        # Обработка Ctrl+C
-        signal.signal(signal.SIGINT, self._signal_handler)
+        self.driver = None
+        self.user_data_dir: Optional[str] = None
+        self._profile_key: Optional[str] = None
+        self._profile_clone: Optional[Path] = None
+        self._close_lock = threading.Lock()
+        _install_cleanup()
+        with _registry_lock:
+            _live_tunnels.add(self)
 
-    def _signal_handler(self, sig, frame):
-        logger.info("Получен сигнал прерывания, закрываю туннель...")
-        self.close()
-        sys.exit(0)
+    def _claim_profile(self, user_data_dir: str, clone: bool) -> str:
+        """Занимает каталог профиля; занятый другим экземпляром (или clone=True) — клонирует"""
+        base = Path(user_data_dir).resolve()
+        with _registry_lock:
+            if not clone and str(base) not in _profiles_in_use:
+                _profiles_in_use.add(str(base))
+                self._profile_key = str(base)
+                return str(base)
+        self._profile_clone = _clone_profile(base)
+        logger.info(f"Профиль {base.name} занят или запрошен клон, используется копия {self._profile_clone}")
+        return str(self._profile_clone)
 
     def _start_proxy_backend(self):
         if self.is_active:
             return self.local_proxy_address
 
+        from seleniumwire import backend
+
         logger.info("Запуск прокси-туннеля...")
-        self.backend = backend.create(
-            addr='127.0.0.1',
-            port=0,
-            options={
-                'proxy': self.proxy_config,
-                'disable_encoding': False,
-                'verify_ssl': False,
-            }
-        )
+        options = {
+            'proxy': self.proxy_config,
+            'disable_encoding': False,
+            'verify_ssl': False,
+        }
+        capture = self.capture
+        if capture is False:
+            options['disable_capture'] = True
+        elif capture.get('max_entries'):
+            # Кольцевой буфер в памяти вместо каталога на диске без ограничения
+            options['request_storage'] = 'memory'
+            options['request_storage_max_size'] = int(capture['max_entries'])
+        self.backend = backend.create(addr='127.0.0.1', port=0, options=options)
+        if capture:
+            if capture.get('scopes'):
+                self.backend.scopes = list(capture['scopes'])
+            if capture.get('max_body'):
+                self.backend.storage = _CappedStorage(self.backend.storage, int(capture['max_body']))
         addr = self.backend.address()
         self.local_proxy_address = f"{addr[0]}:{addr[1]}"
         self.is_active = True
         logger.info(f"Туннель запущен на {self.local_proxy_address}")
         return self.local_proxy_address
 
-    def create_driver(self, headless: bool = False, **uc_kwargs) -> uc.Chrome:
-        local_proxy = self._start_proxy_backend()
+    def create_driver(self, headless: bool = False, clone_profile: bool = False,
+                      block_resources: Optional[Iterable[str]] = None, profile_template: Optional[str] = None,
+                      slim_profile: bool = False, **uc_kwargs) -> "uc.Chrome":
+        import undetected_chromedriver as uc
 
         options = uc.ChromeOptions()
-        options.add_argument(f'--proxy-server=http://{local_proxy}')
+        if self.intercept:
+            local_proxy = self._start_proxy_backend()
+            options.add_argument(f'--proxy-server=http://{local_proxy}')
+            options.add_argument('--ignore-certificate-errors')
+        elif self.native_proxy:
+            options.add_argument(f'--proxy-server={self.native_proxy}')
+            options.add_argument('--proxy-bypass-list=localhost;127.0.0.1')
         options.add_argument('--disable-blink-features=AutomationControlled')
-        options.add_argument('--ignore-certificate-errors')
         options.add_argument('--disable-dev-shm-usage')
         options.add_argument('--no-sandbox')
         options.add_argument('--disable-gpu')
@@ -115,47 +375,126 @@ class UCWithTunnel:
 
         user_data_dir = uc_kwargs.get("user_data_dir")
         if user_data_dir:
-            _sanitize_chrome_profile(str(user_data_dir))
+            _prepare_profile(str(user_data_dir), profile_template)
+            user_data_dir = self._claim_profile(str(user_data_dir), clone_profile)
+            if slim_profile and not self._profile_clone:
+                _prepare_profile(user_data_dir, slim=True)
+            uc_kwargs["user_data_dir"] = user_data_dir
+            self.user_data_dir = user_data_dir
+            _sanitize_chrome_profile(user_data_dir)
 
         if 'version_main' not in uc_kwargs:
-            detected = _detect_chrome_major_version()
+            detected = _detect_chrome_major_version(uc_kwargs.get('browser_executable_path'))
             if detected:
                 uc_kwargs['version_main'] = detected
                 logger.info(f"Определена версия Chrome: {detected}")
 
-        driver = uc.Chrome(options=options, **uc_kwargs)
+        # Пропатченный ранее chromedriver этой версии: uc не скачивает и не патчит его заново
+        patched = None
+        if uc_kwargs.get('version_main') and 'driver_executable_path' not in uc_kwargs:
+            patched = _patched_driver_path(uc_kwargs['version_main'])
+            if patched.exists():
+                uc_kwargs['driver_executable_path'] = str(patched)
+        reuse = patched is not None and 'driver_executable_path' in uc_kwargs
 
-        # Добавляем метод для получения запросов (может пригодиться)
-        def get_requests():
-            try:
-                if self.backend and self.backend.storage:
-                    return list(self.backend.storage.iter_requests())
-                return []
-            except Exception:
-                return []
+        start = time.perf_counter()
+        try:
+            if reuse:
+                driver = uc.Chrome(options=options, **uc_kwargs)
+            else:
+                with _driver_start_lock:
+                    driver = uc.Chrome(options=options, **uc_kwargs)
+        except Exception:
+            # Не оставляем туннель и занятый профиль за неудачным запуском
+            self.close()
+            raise
+        self.driver = driver
+        logger.info(f"Chrome запущен за {time.perf_counter() - start:.1f} с"
+                    f"{' (кэшированный chromedriver)' if reuse else ''}")
+        if patched is not None and not reuse:
+            _store_patched_driver(driver, patched)
 
-        driver.get_requests = get_requests
+        driver.iter_requests = self.iter_requests
+        driver.clear_requests = self.clear_requests
 
         driver.set_page_load_timeout(15)
         driver.implicitly_wait(3)
 
+        if block_resources:
+            self.block_urls(block_resources)
+
         if not headless:
             try:
                 driver.minimize_window()
             except Exception:
                 pass
 
-        logger.info("UC драйвер создан с прокси-туннелем")
+        if self.intercept:
+            logger.info("UC драйвер создан с прокси-туннелем")
+        else:
+            logger.info(f"UC драйвер создан без туннеля ({'прокси ' + self.native_proxy if self.native_proxy else 'без прокси'})")
         return driver
 
-    def close(self):
-        if self.backend and self.is_active:
-            try:
-                self.backend.shutdown()
-                self.is_active = False
-                logger.info("Прокси-туннель закрыт")
-            except Exception as e:
-                logger.warning(f"Ошибка при закрытии туннеля: {e}")
+    def iter_requests(self, pattern: Optional[str] = None) -> Iterator:
+        """Перехваченные запросы по одному, от старых к новым; pattern — regex по URL"""
+        if not (self.backend and self.backend.storage):
+            return
+        regex = re.compile(pattern) if pattern else None
+        try:
+            for request in self.backend.storage.iter_requests():
+                if regex is None or regex.search(request.url):
+                    yield request
+        except Exception as e:
+            logger.debug(f"Ошибка чтения перехваченных запросов: {e}")
+
+    def clear_requests(self):
+        if self.backend and self.backend.storage:
+            self.backend.storage.clear_requests()
+
+    def block_urls(self, patterns: Iterable[str]):
+        """Блокирует загрузку ресурсов по шаблонам (CDP Network.setBlockedURLs); пустой список снимает блокировку"""
+        if self.driver is None:
+            return
+        patterns = list(patterns)
+        try:
+            self.driver.execute_cdp_cmd("Network.enable", {})
+            self.driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": patterns})
+            logger.debug(f"Заблокировано шаблонов URL: {len(patterns)}")
+        except Exception as e:
+            logger.warning(f"Не удалось установить блокировку ресурсов: {e}")
+
+    def close(self, blocking: bool = True) -> bool:
+        """
+        Закрывает браузер, туннель и освобождает профиль (клон удаляется); повторный вызов безопасен.
+        blocking=False — не ждать, если экземпляр уже закрывается (возвращает False).
+        """
+        if not self._close_lock.acquire(blocking=blocking):
+            return False
+        try:
+            driver, self.driver = self.driver, None
+            if driver is not None:
+                try:
+                    driver.quit()
+                except Exception as e:
+                    logger.debug(f"Ошибка при закрытии драйвера: {e}")
+            if self.backend and self.is_active:
+                try:
+                    self.backend.shutdown()
+                    self.is_active = False
+                    logger.info("Прокси-туннель закрыт")
+                except Exception as e:
+                    logger.warning(f"Ошибка при закрытии туннеля: {e}")
+            with _registry_lock:
+                if self._profile_key:
+                    _profiles_in_use.discard(self._profile_key)
+                    self._profile_key = None
+                _live_tunnels.discard(self)
+            if self._profile_clone:
+                shutil.rmtree(self._profile_clone, ignore_errors=True)
+                self._profile_clone = None
+        finally:
+            self._close_lock.release()
+        return True
 
     def __del__(self):
         self.close()
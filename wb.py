@@ -1,26 +1,38 @@
+import argparse
+import sys
 import time
 import random
 import re
 import json
 import csv
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, List, Tuple
 import requests
 from tqdm import tqdm
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
-from openpyxl import Workbook
 from datetime import datetime
 
+# WebDriverWait и expected_conditions импортируются внутри функций: selenium.webdriver.support
+# подтягивает весь remote webdriver, а запуску без браузера (кэш, --resume) он не нужен
 from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException
 from selenium.webdriver.common.action_chains import ActionChains
 
 import config
+import metrics
+import profiling
 from config import setup_logging
-from uc_wire_tunnel import UCWithTunnel
-from proxy_manager import ProxyManager
-from gsheets import safe_batch_update, col_letter_to_index, apply_cell_colors, get_sheet_client, col_index_to_letter
+from uc_wire_tunnel import BLOCK_DEFAULT, UCWithTunnel
+from proxy_manager import ProxySessionPool, attach_proxy, get_proxy_manager, proxy_key, proxy_of
+from planner import Plan, load_plan
+from browser_pool import BrowserPool, lease_driver
+from checkpoint import Checkpoint, raise_if_stopped
+from rate_limit import TokenBucket, throttled_get
+from gsheets import safe_batch_update, col_letter_to_index, write_values_and_colors, get_sheet_client, col_index_to_letter
+
+# Общий пул сессий: соединения с API переиспользуются между запросами и запусками (в режиме демона);
+# с USE_PROXY у каждого прокси своя сессия с куками, полученными через него
+http_session = ProxySessionPool("wb", pool_size=max(10, config.WB_CONCURRENCY))
 
 logger = setup_logging("wb_parser")
 
@@ -31,19 +43,6 @@ def random_delay(min_sec=None, max_sec=None):
     time.sleep(random.uniform(min_sec, max_sec))
 
 
-def detect_link_type(url: str) -> str:
-    v = url.strip()
-    if v.isdigit():
-        return 'wb'
-    if not v.lower().startswith('http'):
-        return 'skip'
-    if 'wildberries' in v.lower() or 'wb.ru' in v.lower():
-        return 'wb'
-    if 'ozon.ru' in v.lower() or 'ozon.by' in v.lower():
-        return 'ozon'
-    return 'skip'
-
-
 def build_wb_url(value: str) -> str:
     value = value.strip()
     if value.startswith("http"):
@@ -146,21 +145,31 @@ def init_driver(headless=None):
         headless = config.HEADLESS_MODE
     logger.info("Инициализация драйвера для WB...")
     proxy_config = None
+    proxy = None
     if config.USE_PROXY:
-        pm = ProxyManager(str(config.PROXY_FILE))
-        if pm.has_proxies():
-            proxy = pm.get_first()
-            if proxy:
-                proxy_config = pm.format_for_selenium_wire(proxy)
-    tunnel = UCWithTunnel(proxy_config=proxy_config)
-    driver = tunnel.create_driver(headless=headless, user_data_dir=str(config.CHROME_PROFILE_WB))
+        pm = get_proxy_manager()
+        proxy = pm.acquire()
+        if proxy:
+            proxy_config = pm.format_for_selenium_wire(proxy)
+            logger.info(f"Использование прокси: {proxy_key(proxy)}")
+    tunnel = UCWithTunnel(proxy_config=proxy_config, intercept=config.BROWSER_INTERCEPT,
+                          capture=config.BROWSER_CAPTURE)
+    driver = tunnel.create_driver(headless=headless, user_data_dir=str(config.CHROME_PROFILE_WB),
+                                  block_resources=BLOCK_DEFAULT if config.BLOCK_RESOURCES else None,
+                                  profile_template=config.CHROME_PROFILE_TEMPLATE,
+                                  slim_profile=config.CHROME_SLIM_PROFILE)
+    attach_proxy(driver, proxy)
     driver.set_page_load_timeout(config.PAGE_LOAD_TIMEOUT)
     driver.implicitly_wait(config.IMPLICIT_WAIT)
     return driver, tunnel
 
 
+@metrics.timed("stage_seconds", parser="wb", stage="cookies")
 def get_cookies_from_wb(driver, max_attempts=3) -> Optional[dict]:
     """Загружает главную страницу и возвращает словарь кук, с повторными попытками"""
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+
     for attempt in range(1, max_attempts + 1):
         try:
             logger.info(f"Загружаем wildberries.ru (попытка {attempt})...")
@@ -189,6 +198,7 @@ def get_cookies_from_wb(driver, max_attempts=3) -> Optional[dict]:
             logger.info(f"Получено кук: {len(cookies)}")
             
             if cookies:
+                http_session.bind_cookies(proxy_of(driver), cookies)
                 return cookies
             else:
                 logger.warning(f"Куки не получены, повтор через 2 сек...")
@@ -205,13 +215,15 @@ def get_cookies_from_wb(driver, max_attempts=3) -> Optional[dict]:
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=2, max=10),
     retry=retry_if_exception_type((requests.RequestException, json.JSONDecodeError)),
+    before_sleep=metrics.count_retry("wb"),
     reraise=True
 )
-def fetch_wb_card(nm_id: str, cookies: dict) -> dict:
+def fetch_wb_card(nm_id: str, cookies: dict, limiter: Optional[TokenBucket] = None) -> dict:
     basket, vol, part = get_sku_url_data(nm_id)
-    url = f"https://basket-{basket}.wbbasket.ru/vol{vol}/part{part}/{nm_id}/info/ru/card.json"
+    base = config.WB_BASKET_URL_TEMPLATE.format(basket=basket)
+    url = f"{base}/vol{vol}/part{part}/{nm_id}/info/ru/card.json"
     headers = {'User-Agent': random.choice(config.USER_AGENTS)}
-    resp = requests.get(url, headers=headers, cookies=cookies, timeout=15)
+    resp = throttled_get(http_session, url, limiter, "wb", headers=headers, cookies=cookies, timeout=15)
     resp.raise_for_status()
     return resp.json()
 
@@ -220,20 +232,22 @@ def fetch_wb_card(nm_id: str, cookies: dict) -> dict:
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=2, max=10),
     retry=retry_if_exception_type((requests.RequestException, json.JSONDecodeError)),
+    before_sleep=metrics.count_retry("wb"),
     reraise=True
 )
-def fetch_wb_detail(nm_id: str, cookies: dict) -> dict:
-    url = f"https://www.wildberries.ru/__internal/u-card/cards/v4/detail?appType=1&curr=rub&dest=-1257786&spp=30&hide_vflags=4294967296&hide_dtype=9;11&ab_testing=false&lang=ru&nm={nm_id}"
+def fetch_wb_detail(nm_id: str, cookies: dict, limiter: Optional[TokenBucket] = None) -> dict:
+    url = f"{config.WB_DETAIL_BASE_URL}/__internal/u-card/cards/v4/detail?appType=1&curr=rub&dest=-1257786&spp=30&hide_vflags=4294967296&hide_dtype=9;11&ab_testing=false&lang=ru&nm={nm_id}"
     headers = {
         'User-Agent': random.choice(config.USER_AGENTS),
         'X-Requested-With': 'XMLHttpRequest',
     }
-    resp = requests.get(url, headers=headers, cookies=cookies, timeout=15)
+    resp = throttled_get(http_session, url, limiter, "wb", headers=headers, cookies=cookies, timeout=15)
     resp.raise_for_status()
     return resp.json()
 
 
-def parse_wb_product(nm_id: str, cookies: dict) -> dict:
+def extract_wb_product(card: dict, detail: dict) -> dict:
+    """Извлекает поля товара из card.json и ответа detail (без сетевых запросов)"""
     result = {
         "price": "",
         "rating_reviews": "",
@@ -242,16 +256,8 @@ def parse_wb_product(nm_id: str, cookies: dict) -> dict:
         "promo": "",
         "has_promo": False,
         "seller": "",
-        "error": None
     }
 
-    try:
-        card = fetch_wb_card(nm_id, cookies)
-        detail = fetch_wb_detail(nm_id, cookies)
-    except Exception as e:
-        result["error"] = str(e)[:200]
-        return result
-
     products = detail.get("products", [])
     if products:
         p = products[0]
@@ -299,6 +305,30 @@ def parse_wb_product(nm_id: str, cookies: dict) -> dict:
     return result
 
 
+def parse_wb_product(nm_id: str, cookies: dict, limiter: Optional[TokenBucket] = None) -> dict:
+    try:
+        with metrics.timer("stage_seconds", parser="wb", stage="fetch"):
+            card = fetch_wb_card(nm_id, cookies, limiter)
+            detail = fetch_wb_detail(nm_id, cookies, limiter)
+    except Exception as e:
+        result = extract_wb_product({}, {})
+        result["error"] = str(e)[:200]
+        return result
+
+    with metrics.timer("stage_seconds", parser="wb", stage="parse"):
+        result = extract_wb_product(card, detail)
+    result["error"] = None
+    return result
+
+
+def build_color_cells(updates, promo_cells, col_promo) -> List[Tuple[int, int, Optional[str]]]:
+    """Заливка для акционных ячеек и сброс цвета у остальных обработанных строк"""
+    promo_rows = {row for row, _, _ in promo_cells}
+    processed_rows = {row for row, col, _ in updates if col == col_promo}
+    clear = [(row, col_promo, None) for row in sorted(processed_rows - promo_rows)]
+    return list(promo_cells) + clear
+
+
 def save_to_local_files(updates, promo_cells, sheet):
     """Сохраняет данные в локальные CSV и XLSX файлы при ошибке записи в Google Sheets."""
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -332,6 +362,8 @@ def save_to_local_files(updates, promo_cells, sheet):
 
     # Сохраняем XLSX
     try:
+        from openpyxl import Workbook
+
         wb = Workbook()
         ws = wb.active
         ws.title = "WB Results"
@@ -346,72 +378,43 @@ def save_to_local_files(updates, promo_cells, sheet):
         logger.error(f"Ошибка сохранения XLSX: {e}")
 
 
-def main():
-    logger.info("=" * 70)
-    logger.info("🚀 ЗАПУСК WILDBERRIES PARSER (STANDALONE)")
-    logger.info("=" * 70)
-
-    _, sheet = get_sheet_client()
-    driver, tunnel = init_driver()
-    all_updates = []
-    promo_cells = []
+def process_tasks(tasks, cookies: dict, all_updates: list, promo_cells: list,
+                  checkpoint: Optional[Checkpoint] = None, concurrency: Optional[int] = None,
+                  rate_limit: Optional[float] = None):
+    """
+    Парсит задачи (row, значение ячейки) и дописывает результаты в all_updates / promo_cells.
+    Списки передаются снаружи, чтобы при прерывании уже собранное можно было записать.
+    Каждая завершённая задача фиксируется в checkpoint. Возвращает (parsed, errors).
+    concurrency и rate_limit (запросов в секунду) по умолчанию берутся из WB_CONCURRENCY / WB_RATE_LIMIT.
+    """
+    col_price = col_letter_to_index(config.WB_PRICE_COLUMN)   # M
+    col_rating = col_letter_to_index(config.WB_RATING_REVIEWS_COLUMN)  # Y
+    col_display_battery = col_letter_to_index(config.WB_DISPLAY_BATTERY_COLUMN)  # H
+    col_promo = col_letter_to_index(config.WB_PROMO_COLUMN)   # AD
+    col_seller = col_letter_to_index(config.WB_SELLER_COLUMN) # I
+
+    parsed = 0
+    errors = 0
+
+    concurrency = concurrency or config.WB_CONCURRENCY
+    rate_limit = config.WB_RATE_LIMIT if rate_limit is None else rate_limit
+    limiter = TokenBucket(rate_limit, period=1.0, target="wb") if rate_limit > 0 else None
+
+    def fetch(task):
+        _, raw = task
+        nm_id = extract_nm_id(raw) or (raw if raw.isdigit() else None)
+        return nm_id, parse_wb_product(nm_id, cookies, limiter) if nm_id else None
+
+    # Запросы выполняются в пуле, а результаты разбираются здесь по порядку задач:
+    # списки обновлений и журнал меняются только из этого потока
+    pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="wb-fetch") if concurrency > 1 else None
+    results = pool.map(fetch, tasks) if pool else map(fetch, tasks)
+    pbar = tqdm(total=len(tasks), desc="Парсинг WB", unit="товаров", colour="green")
 
     try:
-        cookies = get_cookies_from_wb(driver)
-        if not cookies:
-            logger.error("Не удалось получить куки после нескольких попыток")
-            driver.quit()
-            tunnel.close()
-            return
-
-        all_values = sheet.get_all_values()
-        if len(all_values) < 2:
-            logger.warning("Нет данных")
-            driver.quit()
-            tunnel.close()
-            return
-
-        col_wb = col_letter_to_index(config.WB_SKU_COLUMN)        # K
-        col_ozon = col_letter_to_index(config.OZON_INPUT_COLUMN)  # K (по конфигу)
-        col_price = col_letter_to_index(config.WB_PRICE_COLUMN)   # M
-        col_rating = col_letter_to_index(config.WB_RATING_REVIEWS_COLUMN)  # Y
-        col_display_battery = col_letter_to_index(config.WB_DISPLAY_BATTERY_COLUMN)  # H
-        col_promo = col_letter_to_index(config.WB_PROMO_COLUMN)   # AD
-        col_seller = col_letter_to_index(config.WB_SELLER_COLUMN) # I
-
-        wb_tasks = []
-
-        for row_idx in range(2, len(all_values) + 1):
-            row = all_values[row_idx - 1]
-
-            if len(row) >= col_wb:
-                val = row[col_wb - 1].strip()
-                if val and detect_link_type(val) == 'wb':
-                    wb_tasks.append((row_idx, val))
-
-            if len(row) >= col_ozon:
-                val = row[col_ozon - 1].strip()
-                if val and detect_link_type(val) == 'wb':
-                    wb_tasks.append((row_idx, val))
-
-        wb_tasks = list(dict.fromkeys(wb_tasks))
-
-        if not wb_tasks:
-            logger.warning("Нет WB ссылок")
-            driver.quit()
-            tunnel.close()
-            return
-
-        total = len(wb_tasks)
-        parsed = 0
-        errors = 0
-
-        logger.info(f"Найдено WB ссылок: {total}")
-
-        pbar = tqdm(total=total, desc="Парсинг WB", unit="товаров", colour="green")
-
-        for row_idx, raw in wb_tasks:
-            nm_id = extract_nm_id(raw) or (raw if raw.isdigit() else None)
+        for (row_idx, raw), (nm_id, data) in zip(tasks, results):
+            raise_if_stopped()
+            start, promo_start = len(all_updates), len(promo_cells)
             if not nm_id:
                 errors += 1
                 all_updates.extend([
@@ -421,12 +424,12 @@ def main():
                     (row_idx, col_promo, ""),
                     (row_idx, col_seller, "")
                 ])
+                if checkpoint:
+                    checkpoint.record((row_idx, raw), all_updates[start:])
                 pbar.update(1)
                 continue
 
             pbar.set_postfix_str(f"{raw[:20]}...")
-            data = parse_wb_product(nm_id, cookies)
-
             if data.get("error"):
                 errors += 1
                 err = data["error"][:20]
@@ -446,39 +449,110 @@ def main():
                 if data.get("has_promo"):
                     promo_cells.append((row_idx, col_promo, "#b7e1cd"))
 
+            # Ошибки не журналируются: при --resume такие товары запрашиваются снова
+            if checkpoint and not data.get("error"):
+                checkpoint.record((row_idx, raw), all_updates[start:], promo_cells[promo_start:])
             pbar.update(1)
-
+    finally:
         pbar.close()
+        if pool:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    metrics.inc("items_total", parsed, parser="wb", result="ok")
+    metrics.inc("items_total", errors, parser="wb", result="error")
+    return parsed, errors
+
+
+def run(sheet=None, plan: Optional[Plan] = None, browser_pool: Optional[BrowserPool] = None,
+        resume: bool = False) -> bool:
+    """
+    Полный цикл парсинга WB. Возвращает False, если запуск завершился ошибкой.
+    sheet и plan передаёт оркестратор, чтобы лист читался один раз на все парсеры,
+    browser_pool — чтобы переиспользовать тёплый браузер.
+    resume — пропустить задачи, уже выполненные прерванным запуском (по журналу).
+    """
+    logger.info("=" * 70)
+    logger.info("🚀 ЗАПУСК WILDBERRIES PARSER (STANDALONE)")
+    logger.info("=" * 70)
+
+    if sheet is None:
+        _, sheet = get_sheet_client()
+    if plan is None:
+        plan = load_plan(sheet)
+
+    all_values = plan.snapshot
+    if len(all_values) < 2:
+        logger.warning("Нет данных")
+        return True
+
+    wb_tasks = plan.wb_tasks
+    if not wb_tasks:
+        logger.warning("Нет WB ссылок")
+        return True
+
+    checkpoint = Checkpoint("wb", resume=resume)
+    all_updates = []
+    promo_cells = []
+    col_promo = col_letter_to_index(config.WB_PROMO_COLUMN)
+    pending = checkpoint.restore(wb_tasks, all_updates, promo_cells)
+    lease = lease_driver(browser_pool, "wb", init_driver) if pending else None
+
+    try:
+        parsed, errors = 0, 0
+        if pending:
+            cookies = get_cookies_from_wb(lease.driver)
+            # Браузер нужен только для получения кук — сразу возвращаем его в пул
+            lease.release(broken=not cookies)
+            if not cookies:
+                logger.error("Не удалось получить куки после нескольких попыток")
+                return False
+
+            logger.info(f"Найдено WB ссылок: {len(wb_tasks)}, к обработке: {len(pending)}")
+            parsed, errors = process_tasks(pending, cookies, all_updates, promo_cells, checkpoint)
 
         if all_updates:
             logger.info(f"Запись {len(all_updates)} обновлений в Google Sheets...")
             try:
-                safe_batch_update(sheet, all_updates)
-                if promo_cells:
-                    logger.info(f"Заливка {len(promo_cells)} ячеек цветом")
-                    apply_cell_colors(sheet, promo_cells)
+                color_cells = build_color_cells(all_updates, promo_cells, col_promo)
+                write_values_and_colors(sheet, all_updates, color_cells, snapshot=all_values)
             except Exception as e:
                 logger.error(f"Не удалось записать в Google Sheets: {e}")
                 # Сохраняем результаты локально
                 save_to_local_files(all_updates, promo_cells, sheet)
+                return False
         else:
             logger.info("Нет данных для записи.")
 
+        checkpoint.clear()
         logger.info(f"Готово! Обработано: {parsed}, Ошибок: {errors}")
+        return True
 
     except KeyboardInterrupt:
         logger.warning("\nПрервано пользователем")
         if all_updates:
-            safe_batch_update(sheet, all_updates)
-            if promo_cells:
-                apply_cell_colors(sheet, promo_cells)
+            color_cells = build_color_cells(all_updates, promo_cells, col_promo)
+            write_values_and_colors(sheet, all_updates, color_cells, snapshot=all_values)
+        return False
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}", exc_info=True)
         if all_updates:
-            safe_batch_update(sheet, all_updates)
+            safe_batch_update(sheet, all_updates, snapshot=all_values)
+        return False
     finally:
-        driver.quit()
-        tunnel.close()
+        checkpoint.close()
+        if lease:
+            lease.release()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Парсер Wildberries")
+    parser.add_argument("--resume", action="store_true", help="продолжить прерванный запуск по журналу")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    with profiling.profile_run("wb", args.profile, args.profile_out):
+        ok = run(resume=args.resume)
+    metrics.write_report("wb", {"ok": ok})
+    sys.exit(0 if ok else 1)
 
 
 if __name__ == "__main__":